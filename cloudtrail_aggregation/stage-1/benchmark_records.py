@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+""" Compares the two ways that the Lambdas extract records from a log file: copying
+    the original text of each record (extract_records, which uses the fallback if a
+    file isn't in the expected form) and parsing the file then serializing each
+    record (the fallback). Reports records per second and CPU milliseconds per
+    file for each; decompression is excluded, since both paths pay for it.
+
+    Invocation:
+
+        ./benchmark_records.py PATH [PATH ...]
+
+    Where each PATH is a CloudTrail log file (optionally GZipped), or a directory
+    that's searched for them. To create a corpus, see cloudtrail_generator.py in
+    the cloudtrail_to_elasticsearch project.
+    """
+
+import gzip
+import json
+import os
+import pathlib
+import sys
+import time
+
+# the Lambda reads its configuration at import; none of it is used here
+for name in ('SRC_BUCKET', 'SRC_PREFIX', 'DST_BUCKET', 'DST_PREFIX'):
+    os.environ.setdefault(name, "unused")
+os.environ.setdefault('AWS_DEFAULT_REGION', "us-east-1")
+
+import concurrent_lambda
+
+
+def full_parse(data):
+    return [json.dumps(rec).encode('utf-8') for rec in json.loads(data)['Records']]
+
+
+def load_files(paths):
+    result = []
+    for path in [pathlib.Path(p) for p in paths]:
+        files = sorted(f for f in path.rglob("*.json*") if f.is_file()) if path.is_dir() else [path]
+        for f in files:
+            data = f.read_bytes()
+            result.append(gzip.decompress(data) if data.startswith(b'\x1f\x8b') else data)
+    return result
+
+
+def measure(fn, files, repeat=3):
+    """ Returns the best of several runs, as (records, CPU seconds).
+        """
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        count = sum(len(fn(data)) for data in files)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    files = load_files(sys.argv[1:])
+    if not files:
+        print("no files found")
+        sys.exit(1)
+    fallbacks = sum(1 for data in files if concurrent_lambda.split_records(data) is None)
+    total_bytes = sum(len(data) for data in files)
+    print(f"{len(files)} files, {total_bytes / 1024 / 1024:.1f} MB uncompressed; {fallbacks} would use the fallback")
+    print()
+    print(f"{'path':<12} {'records':>10} {'records/s':>12} {'CPU ms/file':>12}")
+    results = {}
+    for name, fn in (("full parse", full_parse), ("raw spans", concurrent_lambda.extract_records)):
+        records, elapsed = measure(fn, files)
+        results[name] = elapsed
+        print(f"{name:<12} {records:>10} {records / elapsed:>12.0f} {elapsed * 1000 / len(files):>12.2f}")
+    print()
+    print(f"speedup: {results['full parse'] / results['raw spans']:.2f}x")
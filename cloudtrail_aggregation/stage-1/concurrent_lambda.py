@@ -6,36 +6,76 @@
 
     The Lambda is triggered with a JSON payload that contains fields "month",
     "day", and "year".
+
+    Accounts, regions, and files are listed concurrently, using LISTING_CONCURRENCY
+    threads (default 16), and files are downloaded as soon as they're listed.
+
+    If TOPOLOGY_CACHE is set (to s3://BUCKET/KEY or a local path), the regions for
+    each account are remembered there, and only new accounts have their regions
+    listed. The cache is discarded, and all regions listed again, once it's older
+    than TOPOLOGY_REFRESH_HOURS (default 168, one week).
+
+    Files are downloaded concurrently, but only while the total size of the files
+    that have been downloaded (or are being downloaded) and not yet written is less
+    than MAX_INFLIGHT_BYTES (default 256 MB); records are written to the current
+    output file as each download completes. This keeps memory usage predictable no
+    matter how many files there are for a day.
+
+    Output files are compressed as records are written, and uploaded as a multipart
+    upload in PART_SIZE parts (default 8 MB), concurrently with aggregation.
     """
 
 import boto3
+import botocore.config
+import botocore.exceptions
+import collections
 import concurrent.futures
 import gzip
-import io
 import json
 import logging
 import os
+import queue
+import re
+import threading
 
 from datetime import datetime, timedelta, timezone
 
 
-s3_client = boto3.client('s3')
-
 src_bucket = os.environ['SRC_BUCKET']
 src_prefix = os.environ['SRC_PREFIX']
 dst_bucket = os.environ['DST_BUCKET']
 dst_prefix = os.environ['DST_PREFIX']
+max_inflight_bytes = int(os.environ.get('MAX_INFLIGHT_BYTES', 256 * 1024 * 1024))
+listing_concurrency = int(os.environ.get('LISTING_CONCURRENCY', 16))
+topology_cache = os.environ.get('TOPOLOGY_CACHE')
+topology_refresh_hours = float(os.environ.get('TOPOLOGY_REFRESH_HOURS', 168))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
 threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
+# output files are uploaded in parts of this size (the minimum is 5 MB), with at
+# most this many parts in flight per file
+part_size = int(os.environ.get('PART_SIZE', 8 * 1024 * 1024))
+max_part_uploads = int(os.environ.get('MAX_PART_UPLOADS', 2))
+
+# if set, each record is parsed and re-serialized, rather than copied
+validate_records = os.environ.get('VALIDATE_RECORDS', '').lower() in ('1', 'true', 'yes')
+
+upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_part_uploads)
+
+listing_pool = concurrent.futures.ThreadPoolExecutor(max_workers=listing_concurrency)
+
+# the client is shared by all of the pools, so needs a connection for each thread
+s3_client = boto3.client('s3', config=botocore.config.Config(max_pool_connections=4 + max_part_uploads + listing_concurrency))
+
 
 def lambda_handler(event, context):
     month, day, year = extract_trigger_message(event)
-    all_files = retrieve_file_list(month, day, year)
-    aggregate_and_output(all_files, month, day, year)
+    topology = Topology(topology_cache, timedelta(hours=topology_refresh_hours)) if topology_cache else None
+    discovery = FileDiscovery(month, day, year, topology)
+    aggregate_and_output(discovery, month, day, year)
 
 
 def extract_trigger_message(event):
@@ -52,21 +92,183 @@ def extract_trigger_message(event):
         return message["month"], message["day"], message["year"]
 
 
-def retrieve_file_list(month, day, year):
-    """ Retrieves the list of all files for the given date, for all accounts and regions.
+class FileDiscovery:
+    """ Lists the files for the given date, for all accounts and regions. Listing
+        runs on a thread pool: one task per account to find its regions, and one per
+        account and region to list its files for the day. Lists of (key, size)
+        tuples are put on a queue as each listing completes, followed by None once
+        all listings are done (or an exception, if one fails).
+
+        If given a Topology, regions are only listed for accounts that it doesn't
+        know about, and it's saved once all listings are done.
         """
-    logger.info(f"retrieving files for {year:04d}-{month:02d}-{day:02d}")
-    all_files = []
-    for account in retrieve_accounts():
-        for region in retrieve_regions_for_account(account):
-            files = retrieve_file_list_for_account_region_and_date(account, region, month, day, year)
-            logger.debug(f"{len(files)} files for account {account}, region {region}")
-            all_files += files
-    logger.info(f"{len(all_files)} total files")
-    return all_files
+
+    def __init__(self, month, day, year, topology=None):
+        self.month = month
+        self.day = day
+        self.year = year
+        self.topology = topology
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.file_count = 0
+        self.failed = False
+        logger.info(f"retrieving files for {year:04d}-{month:02d}-{day:02d}")
+        self.submit(self.list_accounts)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.outstanding += 1
+        listing_pool.submit(self.run, fn, *args)
+
+    def run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as ex:
+            with self.lock:
+                self.failed = True
+            self.queue.put(ex)
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                finished = self.outstanding == 0 and not self.failed
+            if finished:
+                logger.info(f"{self.file_count} total files")
+                if self.topology:
+                    self.topology.save()
+                self.queue.put(None)
+
+    def list_accounts(self):
+        accounts = retrieve_accounts()
+        if self.topology:
+            self.topology.retain(accounts)
+        for account in accounts:
+            if self.failed:
+                return
+            regions = self.topology.regions(account) if self.topology else None
+            if regions is None:
+                self.submit(self.list_regions, account)
+            else:
+                self.submit_files(account, regions)
+
+    def list_regions(self, account):
+        regions = retrieve_regions_for_account(account)
+        if self.topology:
+            self.topology.update(account, regions)
+        self.submit_files(account, regions)
+
+    def submit_files(self, account, regions):
+        for region in regions:
+            if self.failed:
+                return
+            self.submit(self.list_files, account, region)
+
+    def list_files(self, account, region):
+        files = retrieve_file_list_for_account_region_and_date(account, region, self.month, self.day, self.year)
+        logger.debug(f"{len(files)} files for account {account}, region {region}")
+        if files:
+            with self.lock:
+                self.file_count += len(files)
+            self.queue.put(files)
+
+
+class Topology:
+    """ A cache of the regions for each account, stored as a JSON manifest on S3 or
+        the local filesystem. If the manifest is missing, unreadable, malformed, or
+        older than the refresh interval, it starts out empty, so that all regions
+        are listed.
+
+        Regions that are added to a known account won't be seen until the manifest
+        is refreshed.
+        """
+
+    def __init__(self, location, refresh_interval):
+        self.location = location
+        self.lock = threading.Lock()
+        self.changed = False
+        manifest = self.load()
+        if manifest and datetime.now(timezone.utc) - manifest[0] < refresh_interval:
+            refreshed, self.accounts = manifest
+            self.refreshed = refreshed
+            logger.info(f"using topology from {location}: {len(self.accounts)} accounts, refreshed {refreshed.isoformat()}")
+        else:
+            logger.info(f"refreshing topology at {location}")
+            self.refreshed = datetime.now(timezone.utc)
+            self.accounts = {}
+            self.changed = True
+
+    def regions(self, account):
+        with self.lock:
+            return self.accounts.get(account)
+
+    def update(self, account, regions):
+        with self.lock:
+            self.accounts[account] = list(regions)
+            self.changed = True
+
+    def retain(self, accounts):
+        """ Forgets any accounts that aren't in the provided list.
+            """
+        with self.lock:
+            for account in set(self.accounts) - set(accounts):
+                del self.accounts[account]
+                self.changed = True
+
+    def load(self):
+        """ Reads and validates the manifest, returning a tuple of its refresh time
+            and accounts, or None if it doesn't exist or can't be used.
+            """
+        try:
+            if self.location.startswith("s3://"):
+                bucket, key = self.location[5:].split("/", 1)
+                with s3_client.get_object(Bucket=bucket, Key=key)['Body'] as body:
+                    manifest = json.loads(body.read())
+            else:
+                with open(self.location) as f:
+                    manifest = json.load(f)
+            refreshed = datetime.fromisoformat(manifest['refreshed'])
+            if refreshed.tzinfo is None:
+                raise ValueError(f"refresh time has no timezone: {manifest['refreshed']}")
+            accounts = manifest['accounts']
+            if not isinstance(accounts, dict) or not all(isinstance(regions, list) and all(isinstance(region, str) for region in regions)
+                                                          for regions in accounts.values()):
+                raise ValueError("accounts must map account IDs to lists of regions")
+            return refreshed, accounts
+        except FileNotFoundError:
+            return None
+        except botocore.exceptions.ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                logger.warning(f"unable to read topology from {self.location}: {ex}")
+            return None
+        except Exception as ex:
+            logger.warning(f"unable to read topology from {self.location}: {ex}")
+            return None
+
+    def save(self):
+        """ Writes the manifest if it has changed. Failure is logged but otherwise
+            ignored; the next run will simply list all regions.
+            """
+        with self.lock:
+            if not self.changed:
+                return
+            data = json.dumps({'refreshed': self.refreshed.isoformat(), 'accounts': self.accounts}, indent=2, sort_keys=True)
+            self.changed = False
+        logger.info(f"writing topology to {self.location}: {len(self.accounts)} accounts")
+        try:
+            if self.location.startswith("s3://"):
+                bucket, key = self.location[5:].split("/", 1)
+                s3_client.put_object(Bucket=bucket, Key=key, Body=data.encode('utf-8'))
+            else:
+                with open(self.location, "w") as f:
+                    f.write(data)
+        except Exception as ex:
+            logger.warning(f"unable to write topology to {self.location}: {ex}")
 
 
 def retrieve_file_list_for_account_region_and_date(account_id, region, month, day, year):
+    """ Returns a list of (key, size) tuples for the files with the given account,
+        region, and date.
+        """
     result = []
     prefix = f"{src_prefix}{account_id}/CloudTrail/{region}/{year:04d}/{month:02d}/{day:02d}/"
     logger.debug(f"listing files for prefix {prefix}")
@@ -77,7 +279,7 @@ def retrieve_file_list_for_account_region_and_date(account_id, region, month, da
     while True:
         resp = s3_client.list_objects_v2(**req_args)
         for item in resp.get('Contents', []):
-            result.append(item['Key'])
+            result.append((item['Key'], item['Size']))
         if not resp.get('IsTruncated'):
             return result
         req_args['ContinuationToken'] = resp['NextContinuationToken']
@@ -95,46 +297,167 @@ def retrieve_child_prefixes(parent_prefix):
     """ Returns all child prefix components for a given parent prefix, sans trailing slashes.
         """
     logger.debug(f"retrieving child prefixes for {parent_prefix}")
-    resp = s3_client.list_objects_v2(Bucket=src_bucket, Prefix=parent_prefix, Delimiter="/")
+    req_args = {
+        "Bucket": src_bucket,
+        "Prefix": parent_prefix,
+        "Delimiter": "/"
+    }
     result = []
-    for prefix in [x['Prefix'] for x in resp.get('CommonPrefixes', [])]:
-        trimmed = prefix.replace(parent_prefix, "").replace("/", "")
-        result.append(trimmed)
-    return result
+    while True:
+        resp = s3_client.list_objects_v2(**req_args)
+        for prefix in [x['Prefix'] for x in resp.get('CommonPrefixes', [])]:
+            trimmed = prefix.replace(parent_prefix, "").replace("/", "")
+            result.append(trimmed)
+        if not resp.get('IsTruncated'):
+            return result
+        req_args['ContinuationToken'] = resp['NextContinuationToken']
 
 
-def aggregate_and_output(file_list, month, day, year, desired_uncompressed_size = 64 * 1024 * 1024):
+def aggregate_and_output(discovery, month, day, year, desired_uncompressed_size = 64 * 1024 * 1024):
     """ Reads all of the input files, aggregates them into chunks based on the
         desired size (in reality, it's likely to be much smaller), and writes
         them to the destination bucket and prefix.
+
+        If anything fails, the current output file's upload is aborted, so that
+        its parts aren't retained.
         """
     file_number = 0
-    cur_recs = []
-    cur_size = 0
-    for rec in retrieve_log_records(file_list):
-        cur_recs.append(rec)
-        cur_size += len(rec)
-        if cur_size >= desired_uncompressed_size:
-            write_file(cur_recs, month, day, year, file_number)
-            file_number += 1
-            cur_recs = []
-            cur_size = 0
-    if len(cur_recs) > 0:
-        write_file(cur_recs, month, day, year, file_number)
-
-
-def retrieve_log_records(file_list):
-    """ A generator function that reads CloudTrail log files, extracts the records,
-        and the individual records from those files.
+    out = None
+    try:
+        for rec in retrieve_log_records(discovery):
+            if out is None:
+                out = OutputFile(month, day, year, file_number)
+            out.write(rec)
+            if out.uncompressed_size >= desired_uncompressed_size:
+                out.close()
+                file_number += 1
+                out = None
+        if out is not None:
+            out.close()
+    except Exception:
+        if out is not None:
+            out.abort()
+        raise
+
+
+def retrieve_log_records(discovery, max_inflight=None):
+    """ A generator function that reads CloudTrail log files and yields their
+        individual records (see extract_records()). Files are downloaded as they're
+        discovered, concurrently, and their records are yielded as each download
+        completes; a new download is only started if the bytes held by outstanding
+        downloads, and by the file currently being consumed, are below the limit.
+        At least one file is always in progress, so a file larger than the limit
+        will still be read.
+
+        Downloads are reserved at their listed (compressed) size, multiplied by the
+        compression ratio seen so far, and corrected once their real size is known.
+        """
+    max_inflight = max_inflight or max_inflight_bytes
+    pending = collections.deque()
+    listing_done = False
+    inflight = {}
+    inflight_bytes = 0
+    compressed_total = 0
+    uncompressed_total = 0
+    while pending or inflight or not listing_done:
+        while not listing_done:
+            try:
+                # only block if there's nothing else to do
+                files = discovery.queue.get(block=not (pending or inflight))
+            except queue.Empty:
+                break
+            if files is None:
+                listing_done = True
+            elif isinstance(files, Exception):
+                raise files
+            else:
+                pending.extend(files)
+        ratio = uncompressed_total / compressed_total if compressed_total else 10
+        while pending and (not inflight or inflight_bytes + pending[0][1] * ratio <= max_inflight):
+            key, size = pending.popleft()
+            future = threadpool.submit(read_file, key)
+            inflight[future] = (size, size * ratio)
+            inflight_bytes += size * ratio
+        if not inflight:
+            continue
+        # if we're waiting for files to be discovered, check for them periodically
+        timeout = 0.1 if not (pending or listing_done) else None
+        done, _ = concurrent.futures.wait(inflight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            size, reserved = inflight.pop(future)
+            data = future.result()
+            inflight_bytes += len(data) - reserved
+            compressed_total += size
+            uncompressed_total += len(data)
+            yield from extract_records(data)
+            inflight_bytes -= len(data)
+            del data
+
+
+def extract_records(data):
+    """ Returns the records from a CloudTrail log file, as a list of UTF-8 encoded
+        JSON objects. Normally these are the original bytes of each record, found by
+        split_records(); if that can't make sense of the file, or VALIDATE_RECORDS is
+        set, the file is parsed and each record re-serialized (which will fail if
+        the file isn't valid JSON).
+        """
+    records = None if validate_records else split_records(data)
+    if records is None:
+        records = [json.dumps(rec).encode('utf-8') for rec in json.loads(data)['Records']]
+    return records
+
+
+# the start of a log file, up to the first record
+RECORDS_START = re.compile(r'\s*\{\s*"Records"\s*:\s*\[\s*')
+
+# between records
+RECORDS_SEPARATOR = re.compile(r'\s*,\s*')
+
+# the end of a log file, after the last record
+RECORDS_END = re.compile(r'\s*\]\s*\}\s*')
+
+decoder = json.JSONDecoder()
+
+
+def split_records(data):
+    """ Splits a log file into the original text of its records, so that they can be
+        written without being re-serialized. This uses the JSON decoder to find the
+        end of each record (which also validates it), because that's implemented in
+        C, and is several times faster than scanning in Python.
+
+        Returns None if the file doesn't have the expected structure: a single object,
+        whose only field is an array of objects. Records that span multiple lines are
+        re-serialized, since the output is newline-delimited.
         """
-    gathered = [parsed for parsed in threadpool.map(read_file, file_list)]
-    for parsed in gathered:
-        for rec in parsed['Records']:
-            yield json.dumps(rec)
+    text = data.decode('utf-8')
+    m = RECORDS_START.match(text)
+    if not m:
+        return None
+    pos = m.end()
+    if RECORDS_END.fullmatch(text, pos):
+        return []
+    records = []
+    while True:
+        try:
+            rec, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            return None
+        if not isinstance(rec, dict):
+            return None
+        raw = text[pos:end]
+        if "\n" in raw or "\r" in raw:
+            records.append(json.dumps(rec).encode('utf-8'))
+        else:
+            records.append(raw.encode('utf-8'))
+        m = RECORDS_SEPARATOR.match(text, end)
+        if not m:
+            return records if RECORDS_END.fullmatch(text, end) else None
+        pos = m.end()
 
 
 def read_file(key):
-    """ Reads a source file from S3, uncompresses it if appropriate, and returns the contents.
+    """ Reads a source file from S3, uncompresses it if appropriate, and returns the
+        (unparsed) contents.
         """
     logger.debug(f"reading s3://{src_bucket}/{key}")
     resp = s3_client.get_object(Bucket=src_bucket, Key=key)
@@ -142,17 +465,116 @@ def read_file(key):
         data = body.read()
     if data.startswith(b'\x1f\x8b'):
         data = gzip.decompress(data)
-    return json.loads(data)
+    return data
+
+
+class OutputFile:
+    """ A destination file, which compresses records as they're written.
+        """
+
+    def __init__(self, month, day, year, file_number):
+        self.upload = MultipartUpload(f"{dst_prefix}{year:04d}/{month:02d}/{day:02d}/{file_number:06d}.ndjson.gz")
+        self.gzip = gzip.GzipFile(fileobj=self.upload, mode="wb")
+        self.records = 0
+        self.uncompressed_size = 0
+
+    def write(self, rec):
+        data = rec + b"\n"
+        self.gzip.write(data)
+        self.records += 1
+        self.uncompressed_size += len(data)
+
+    def close(self):
+        logger.info(f"writing {self.records} records to s3://{dst_bucket}/{self.upload.key}")
+        try:
+            self.gzip.close()
+        except Exception:
+            self.upload.abort()
+            raise
+        self.upload.close()
+
+    def abort(self):
+        """ Abandons the file. The upload is aborted first, so that closing the
+            compressor doesn't send anything more.
+            """
+        self.upload.abort()
+        self.gzip.close()
 
 
-def write_file(records, month, day, year, file_number):
-    """ Writes records to a destination file, compressing them along the way.
+class MultipartUpload:
+    """ A write-only file-like object that uploads its contents to the destination
+        bucket in parts, concurrently with further writes, so that only a few parts
+        are held in memory. If the total size is less than one part, it's uploaded
+        with a single PUT when closed.
         """
-    out = io.StringIO()
-    for rec in records:
-        print(rec, file=out)
-    data = out.getvalue().encode('utf-8')
-    data = gzip.compress(data)
-    key = f"{dst_prefix}{year:04d}/{month:02d}/{day:02d}/{file_number:06d}.ndjson.gz"
-    logger.info(f"writing {len(records)} records to s3://{dst_bucket}/{key}")
-    s3_client.put_object(Bucket=dst_bucket, Key=key, Body=data)
+
+    def __init__(self, key):
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            return len(data)
+        self.buffer += data
+        if len(self.buffer) >= part_size:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.upload_id:
+                self.upload_part()
+                parts = [{'PartNumber': number, 'ETag': future.result()} for number, future in self.parts]
+                logger.debug(f"completing upload of s3://{dst_bucket}/{self.key} ({len(parts)} parts)")
+                s3_client.complete_multipart_upload(Bucket=dst_bucket, Key=self.key, UploadId=self.upload_id,
+                                                    MultipartUpload={'Parts': parts})
+            else:
+                s3_client.put_object(Bucket=dst_bucket, Key=self.key, Body=bytes(self.buffer))
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """ Abandons a multipart upload, so that its parts aren't retained (and billed).
+            Anything written afterward is discarded.
+            """
+        self.aborted = True
+        self.buffer = bytearray()
+        if self.upload_id:
+            for _, future in self.parts:
+                future.cancel()
+            concurrent.futures.wait([future for _, future in self.parts])
+            upload_id, self.upload_id = self.upload_id, None
+            try:
+                s3_client.abort_multipart_upload(Bucket=dst_bucket, Key=self.key, UploadId=upload_id)
+            except Exception as ex:
+                # don't hide the exception that caused the abort
+                logger.warning(f"unable to abort upload of s3://{dst_bucket}/{self.key}: {ex}")
+
+    def upload_part(self):
+        """ Starts uploading the buffered data as the next part, first waiting if too
+            many parts are already being uploaded.
+            """
+        if not self.upload_id:
+            self.upload_id = s3_client.create_multipart_upload(Bucket=dst_bucket, Key=self.key)['UploadId']
+        outstanding = [future for _, future in self.parts if not future.done()]
+        if len(outstanding) >= max_part_uploads:
+            concurrent.futures.wait(outstanding, return_when=concurrent.futures.FIRST_COMPLETED)
+        for _, future in self.parts:
+            if future.done():
+                future.result()  # raises if the part failed
+        number = len(self.parts) + 1
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.parts.append((number, upload_pool.submit(upload_part, self.key, self.upload_id, number, data)))
+
+
+def upload_part(key, upload_id, number, data):
+    logger.debug(f"uploading part {number} of s3://{dst_bucket}/{key} ({len(data)} bytes)")
+    return s3_client.upload_part(Bucket=dst_bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)['ETag']
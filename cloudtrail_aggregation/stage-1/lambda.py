@@ -6,14 +6,18 @@
 
     The Lambda is triggered with a JSON payload that contains fields "month",
     "day", and "year".
+
+    Output files are compressed as records are written, and uploaded as a multipart
+    upload in PART_SIZE parts (default 8 MB), concurrently with aggregation.
     """
 
 import boto3
+import concurrent.futures
 import gzip
-import io
 import json
 import logging
 import os
+import re
 
 from datetime import datetime, timedelta, timezone
 
@@ -25,6 +29,16 @@ dst_prefix = os.environ['DST_PREFIX']
 
 s3_client = boto3.client('s3')
 
+# output files are uploaded in parts of this size (the minimum is 5 MB), with at
+# most this many parts in flight per file
+part_size = int(os.environ.get('PART_SIZE', 8 * 1024 * 1024))
+max_part_uploads = int(os.environ.get('MAX_PART_UPLOADS', 2))
+
+# if set, each record is parsed and re-serialized, rather than copied
+validate_records = os.environ.get('VALIDATE_RECORDS', '').lower() in ('1', 'true', 'yes')
+
+upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_part_uploads)
+
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
@@ -92,42 +106,116 @@ def retrieve_child_prefixes(parent_prefix):
     """ Returns all child prefix components for a given parent prefix, sans trailing slashes.
         """
     logger.debug(f"retrieving child prefixes for s3://{src_bucket}/{parent_prefix}")
-    resp = s3_client.list_objects_v2(Bucket=src_bucket, Prefix=parent_prefix, Delimiter="/")
+    req_args = {
+        "Bucket": src_bucket,
+        "Prefix": parent_prefix,
+        "Delimiter": "/"
+    }
     result = []
-    for prefix in [x['Prefix'] for x in resp.get('CommonPrefixes', [])]:
-        trimmed = prefix.replace(parent_prefix, "").replace("/", "")
-        result.append(trimmed)
-    return result
+    while True:
+        resp = s3_client.list_objects_v2(**req_args)
+        for prefix in [x['Prefix'] for x in resp.get('CommonPrefixes', [])]:
+            trimmed = prefix.replace(parent_prefix, "").replace("/", "")
+            result.append(trimmed)
+        if not resp.get('IsTruncated'):
+            return result
+        req_args['ContinuationToken'] = resp['NextContinuationToken']
 
 
 def aggregate_and_output(file_list, month, day, year, desired_uncompressed_size = 64 * 1024 * 1024):
     """ Reads all of the input files, aggregates them into chunks based on the
         desired size (in reality, it's likely to be much smaller), and writes
         them to the destination bucket and prefix.
+
+        If anything fails, the current output file's upload is aborted, so that
+        its parts aren't retained.
         """
     file_number = 0
-    cur_recs = []
-    cur_size = 0
-    for rec in retrieve_log_records(file_list):
-        cur_recs.append(rec)
-        cur_size += len(rec)
-        if cur_size >= desired_uncompressed_size:
-            write_file(cur_recs, month, day, year, file_number)
-            file_number += 1
-            cur_recs = []
-            cur_size = 0
-    if len(cur_recs) > 0:
-        write_file(cur_recs, month, day, year, file_number)
+    out = None
+    try:
+        for rec in retrieve_log_records(file_list):
+            if out is None:
+                out = OutputFile(month, day, year, file_number)
+            out.write(rec)
+            if out.uncompressed_size >= desired_uncompressed_size:
+                out.close()
+                file_number += 1
+                out = None
+        if out is not None:
+            out.close()
+    except Exception:
+        if out is not None:
+            out.abort()
+        raise
 
 
 def retrieve_log_records(file_list):
-    """ A generator function that reads CloudTrail log files, extracts the records,
-        and the individual records from those files.
+    """ A generator function that reads CloudTrail log files and yields their
+        individual records (see extract_records()).
         """
     for file in file_list:
-        parsed = json.loads(read_file(file))
-        for rec in parsed['Records']:
-            yield json.dumps(rec)
+        yield from extract_records(read_file(file))
+
+
+def extract_records(data):
+    """ Returns the records from a CloudTrail log file, as a list of UTF-8 encoded
+        JSON objects. Normally these are the original bytes of each record, found by
+        split_records(); if that can't make sense of the file, or VALIDATE_RECORDS is
+        set, the file is parsed and each record re-serialized (which will fail if
+        the file isn't valid JSON).
+        """
+    records = None if validate_records else split_records(data)
+    if records is None:
+        records = [json.dumps(rec).encode('utf-8') for rec in json.loads(data)['Records']]
+    return records
+
+
+# the start of a log file, up to the first record
+RECORDS_START = re.compile(r'\s*\{\s*"Records"\s*:\s*\[\s*')
+
+# between records
+RECORDS_SEPARATOR = re.compile(r'\s*,\s*')
+
+# the end of a log file, after the last record
+RECORDS_END = re.compile(r'\s*\]\s*\}\s*')
+
+decoder = json.JSONDecoder()
+
+
+def split_records(data):
+    """ Splits a log file into the original text of its records, so that they can be
+        written without being re-serialized. This uses the JSON decoder to find the
+        end of each record (which also validates it), because that's implemented in
+        C, and is several times faster than scanning in Python.
+
+        Returns None if the file doesn't have the expected structure: a single object,
+        whose only field is an array of objects. Records that span multiple lines are
+        re-serialized, since the output is newline-delimited.
+        """
+    text = data.decode('utf-8')
+    m = RECORDS_START.match(text)
+    if not m:
+        return None
+    pos = m.end()
+    if RECORDS_END.fullmatch(text, pos):
+        return []
+    records = []
+    while True:
+        try:
+            rec, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            return None
+        if not isinstance(rec, dict):
+            return None
+        raw = text[pos:end]
+        if "\n" in raw or "\r" in raw:
+            records.append(json.dumps(rec).encode('utf-8'))
+        else:
+            records.append(raw.encode('utf-8'))
+        m = RECORDS_SEPARATOR.match(text, end)
+        if not m:
+            return records if RECORDS_END.fullmatch(text, end) else None
+        pos = m.end()
 
 
 def read_file(key):
@@ -142,14 +230,113 @@ def read_file(key):
     return data
 
 
-def write_file(records, month, day, year, file_number):
-    """ Writes records to a destination file, compressing them along the way.
+class OutputFile:
+    """ A destination file, which compresses records as they're written.
+        """
+
+    def __init__(self, month, day, year, file_number):
+        self.upload = MultipartUpload(f"{dst_prefix}{year:04d}/{month:02d}/{day:02d}/{file_number:06d}.ndjson.gz")
+        self.gzip = gzip.GzipFile(fileobj=self.upload, mode="wb")
+        self.records = 0
+        self.uncompressed_size = 0
+
+    def write(self, rec):
+        data = rec + b"\n"
+        self.gzip.write(data)
+        self.records += 1
+        self.uncompressed_size += len(data)
+
+    def close(self):
+        logger.info(f"writing {self.records} records to s3://{dst_bucket}/{self.upload.key}")
+        try:
+            self.gzip.close()
+        except Exception:
+            self.upload.abort()
+            raise
+        self.upload.close()
+
+    def abort(self):
+        """ Abandons the file. The upload is aborted first, so that closing the
+            compressor doesn't send anything more.
+            """
+        self.upload.abort()
+        self.gzip.close()
+
+
+class MultipartUpload:
+    """ A write-only file-like object that uploads its contents to the destination
+        bucket in parts, concurrently with further writes, so that only a few parts
+        are held in memory. If the total size is less than one part, it's uploaded
+        with a single PUT when closed.
         """
-    out = io.StringIO()
-    for rec in records:
-        print(rec, file=out)
-    data = out.getvalue().encode('utf-8')
-    data = gzip.compress(data)
-    key = f"{dst_prefix}{year:04d}/{month:02d}/{day:02d}/{file_number:06d}.ndjson.gz"
-    logger.info(f"writing {len(records)} records to s3://{dst_bucket}/{key}")
-    s3_client.put_object(Bucket=dst_bucket, Key=key, Body=data)
+
+    def __init__(self, key):
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            return len(data)
+        self.buffer += data
+        if len(self.buffer) >= part_size:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.upload_id:
+                self.upload_part()
+                parts = [{'PartNumber': number, 'ETag': future.result()} for number, future in self.parts]
+                logger.debug(f"completing upload of s3://{dst_bucket}/{self.key} ({len(parts)} parts)")
+                s3_client.complete_multipart_upload(Bucket=dst_bucket, Key=self.key, UploadId=self.upload_id,
+                                                    MultipartUpload={'Parts': parts})
+            else:
+                s3_client.put_object(Bucket=dst_bucket, Key=self.key, Body=bytes(self.buffer))
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """ Abandons a multipart upload, so that its parts aren't retained (and billed).
+            Anything written afterward is discarded.
+            """
+        self.aborted = True
+        self.buffer = bytearray()
+        if self.upload_id:
+            for _, future in self.parts:
+                future.cancel()
+            concurrent.futures.wait([future for _, future in self.parts])
+            upload_id, self.upload_id = self.upload_id, None
+            try:
+                s3_client.abort_multipart_upload(Bucket=dst_bucket, Key=self.key, UploadId=upload_id)
+            except Exception as ex:
+                # don't hide the exception that caused the abort
+                logger.warning(f"unable to abort upload of s3://{dst_bucket}/{self.key}: {ex}")
+
+    def upload_part(self):
+        """ Starts uploading the buffered data as the next part, first waiting if too
+            many parts are already being uploaded.
+            """
+        if not self.upload_id:
+            self.upload_id = s3_client.create_multipart_upload(Bucket=dst_bucket, Key=self.key)['UploadId']
+        outstanding = [future for _, future in self.parts if not future.done()]
+        if len(outstanding) >= max_part_uploads:
+            concurrent.futures.wait(outstanding, return_when=concurrent.futures.FIRST_COMPLETED)
+        for _, future in self.parts:
+            if future.done():
+                future.result()  # raises if the part failed
+        number = len(self.parts) + 1
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.parts.append((number, upload_pool.submit(upload_part, self.key, self.upload_id, number, data)))
+
+
+def upload_part(key, upload_id, number, data):
+    logger.debug(f"uploading part {number} of s3://{dst_bucket}/{key} ({len(data)} bytes)")
+    return s3_client.upload_part(Bucket=dst_bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)['ETag']
@@ -0,0 +1,13 @@
+# The Lambdas read their configuration, and create their clients, when imported,
+# so these must be set before any test imports them.
+
+import os
+import sys
+
+os.environ.setdefault('SRC_BUCKET', "src-bucket")
+os.environ.setdefault('SRC_PREFIX', "AWSLogs/")
+os.environ.setdefault('DST_BUCKET', "dst-bucket")
+os.environ.setdefault('DST_PREFIX', "daily/")
+os.environ.setdefault('AWS_DEFAULT_REGION', "us-east-1")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,97 @@
+import io
+import queue
+import threading
+
+import botocore.exceptions
+
+from botocore.response import StreamingBody
+
+
+class FakeS3Client:
+    """ Implements the S3 operations used by the Lambdas, against an in-memory
+        dict of (bucket, key) to bytes. Listings return at most page_size items,
+        and every call is recorded. If fail_part is set, that part number fails.
+        """
+
+    def __init__(self, objects=None, page_size=1000, fail_part=None):
+        self.objects = dict(objects or {})
+        self.page_size = page_size
+        self.fail_part = fail_part
+        self.calls = []
+        self.uploads = {}
+        self.aborted = []
+        self.lock = threading.Lock()
+
+    def record(self, name, **kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+
+    def count(self, name):
+        return len([call for call in self.calls if call[0] == name])
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        self.record('list_objects_v2', Prefix=Prefix, Delimiter=Delimiter)
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        if Delimiter:
+            items = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]})
+        else:
+            items = keys
+        start = int(ContinuationToken or 0)
+        page = items[start:start + self.page_size]
+        resp = {'IsTruncated': start + self.page_size < len(items)}
+        if resp['IsTruncated']:
+            resp['NextContinuationToken'] = str(start + self.page_size)
+        if Delimiter:
+            resp['CommonPrefixes'] = [{'Prefix': prefix} for prefix in page]
+        else:
+            resp['Contents'] = [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in page]
+        return resp
+
+    def get_object(self, Bucket, Key):
+        self.record('get_object', Key=Key)
+        data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': StreamingBody(io.BytesIO(data), len(data))}
+
+    def put_object(self, Bucket, Key, Body):
+        self.record('put_object', Key=Key)
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.record('create_multipart_upload', Key=Key)
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.record('upload_part', Key=Key, PartNumber=PartNumber)
+        if PartNumber == self.fail_part:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InternalError'}}, 'UploadPart')
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"etag-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.record('complete_multipart_upload', Key=Key)
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        if numbers != sorted(parts):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidPart'}}, 'CompleteMultipartUpload')
+        self.objects[(Bucket, Key)] = b"".join(parts[number] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.record('abort_multipart_upload', Key=Key)
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(Key)
+
+
+class StaticDiscovery:
+    """ Stands in for concurrent_lambda.FileDiscovery, with a fixed list of
+        (key, size) tuples.
+        """
+
+    def __init__(self, files):
+        self.queue = queue.Queue()
+        if files:
+            self.queue.put(list(files))
+        self.queue.put(None)
@@ -0,0 +1,43 @@
+import importlib
+import unittest
+
+from unittest.mock import patch
+
+from fake_s3 import FakeS3Client
+
+
+# modules under test
+import concurrent_lambda
+serial_lambda = importlib.import_module("lambda")
+
+
+ACCOUNTS = ["111111111111", "222222222222", "333333333333", "444444444444", "555555555555"]
+
+
+class TestListing(unittest.TestCase):
+
+    def client(self, module):
+        """ Returns a fake client holding one log file for each account, with a page
+            size small enough that listing the accounts takes several requests.
+            """
+        objects = {}
+        for account in ACCOUNTS:
+            key = f"{module.src_prefix}{account}/CloudTrail/us-east-1/2024/03/01/{account}_CloudTrail.json.gz"
+            objects[("src-bucket", key)] = b""
+        return FakeS3Client(objects, page_size=2)
+
+
+    def test_retrieve_child_prefixes_is_paginated(self):
+        for module in (concurrent_lambda, serial_lambda):
+            with self.subTest(module=module.__name__):
+                s3 = self.client(module)
+                with patch.object(module, 's3_client', s3):
+                    self.assertEqual(ACCOUNTS, module.retrieve_accounts())
+                self.assertEqual(3, s3.count('list_objects_v2'))
+
+
+    def test_retrieve_regions(self):
+        for module in (concurrent_lambda, serial_lambda):
+            with self.subTest(module=module.__name__):
+                with patch.object(module, 's3_client', self.client(module)):
+                    self.assertEqual(["us-east-1"], module.retrieve_regions_for_account(ACCOUNTS[2]))
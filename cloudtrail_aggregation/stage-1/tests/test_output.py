@@ -0,0 +1,88 @@
+import gzip
+import importlib
+import json
+import os
+import unittest
+
+from unittest.mock import patch
+
+import botocore.exceptions
+
+from fake_s3 import FakeS3Client, StaticDiscovery
+
+
+# modules under test
+import concurrent_lambda
+serial_lambda = importlib.import_module("lambda")
+
+
+def records(count, size=100):
+    # random content doesn't compress, so that we can control the number of parts
+    return [json.dumps({"eventID": str(n), "data": os.urandom(size).hex()}).encode('utf-8') for n in range(count)]
+
+
+def log_file(recs):
+    return b'{"Records":[' + b",".join(recs) + b']}'
+
+
+class TestOutput(unittest.TestCase):
+
+    def aggregate(self, module, recs, part_size):
+        """ Aggregates a single source file containing the given records, returning
+            the fake client.
+            """
+        data = log_file(recs)
+        s3 = FakeS3Client({("src-bucket", "AWSLogs/source.json"): data})
+        files = StaticDiscovery([("AWSLogs/source.json", len(data))]) if module is concurrent_lambda else ["AWSLogs/source.json"]
+        with patch.object(module, 's3_client', s3), patch.object(module, 'part_size', part_size):
+            module.aggregate_and_output(files, 3, 1, 2024)
+        return s3
+
+
+    def output(self, s3):
+        return gzip.decompress(s3.objects[("dst-bucket", "daily/2024/03/01/000000.ndjson.gz")]).splitlines()
+
+
+    def test_single_put(self):
+        recs = records(10)
+        for module in (concurrent_lambda, serial_lambda):
+            s3 = self.aggregate(module, recs, 1024 * 1024)
+            self.assertEqual(1, s3.count('put_object'))
+            self.assertEqual(0, s3.count('create_multipart_upload'))
+            self.assertEqual(recs, self.output(s3))
+
+
+    def test_multipart(self):
+        recs = records(500)
+        for module in (concurrent_lambda, serial_lambda):
+            s3 = self.aggregate(module, recs, 4096)
+            self.assertEqual(0, s3.count('put_object'))
+            self.assertEqual(1, s3.count('complete_multipart_upload'))
+            self.assertGreater(s3.count('upload_part'), 2)
+            self.assertEqual(recs, self.output(s3))
+
+
+    def test_part_failure_aborts_upload(self):
+        for module in (concurrent_lambda, serial_lambda):
+            s3 = FakeS3Client(fail_part=1)
+            with patch.object(module, 's3_client', s3), patch.object(module, 'part_size', 4096):
+                with patch.object(module, 'retrieve_log_records', return_value=iter(records(500))):
+                    with self.assertRaises(botocore.exceptions.ClientError):
+                        module.aggregate_and_output([], 3, 1, 2024)
+            self.assertEqual(["daily/2024/03/01/000000.ndjson.gz"], s3.aborted)
+            self.assertEqual(0, s3.count('complete_multipart_upload'))
+
+
+    def test_read_failure_aborts_upload(self):
+        def failing_records(files):
+            # enough that the upload has started
+            yield from records(500)
+            raise IOError("download failed")
+        for module in (concurrent_lambda, serial_lambda):
+            s3 = FakeS3Client()
+            with patch.object(module, 's3_client', s3), patch.object(module, 'part_size', 4096):
+                with patch.object(module, 'retrieve_log_records', failing_records):
+                    with self.assertRaises(IOError):
+                        module.aggregate_and_output([], 3, 1, 2024)
+            self.assertEqual(["daily/2024/03/01/000000.ndjson.gz"], s3.aborted)
+            self.assertEqual({}, s3.uploads)
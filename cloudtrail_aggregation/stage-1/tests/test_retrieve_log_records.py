@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+import unittest
+
+from unittest.mock import patch
+
+from fake_s3 import StaticDiscovery
+
+
+# module under test
+import concurrent_lambda
+
+
+class FileTracker:
+    """ Replaces read_file(), recording the bytes held by each download from when
+        it starts until the test has consumed all of its records.
+        """
+
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+        self.held = {}
+        self.remaining = {key: len(json.loads(data)['Records']) for key, data in files.items()}
+        self.max_held_bytes = 0
+        self.max_held_files = 0
+        self.violations = []
+
+    def read_file(self, key):
+        with self.lock:
+            self.held[key] = len(self.files[key])
+            self.max_held_bytes = max(self.max_held_bytes, sum(self.held.values()))
+            self.max_held_files = max(self.max_held_files, len(self.held))
+        time.sleep(0.01)
+        return self.files[key]
+
+    def consumed(self, rec):
+        key = json.loads(rec)['key']
+        with self.lock:
+            self.remaining[key] -= 1
+            if not self.remaining[key]:
+                del self.held[key]
+
+
+def make_files(count, size):
+    """ Creates uncompressed log files of approximately the given size, each
+        containing ten records that identify their file.
+        """
+    files = {}
+    for n in range(count):
+        key = f"file-{n:03d}.json"
+        pad = "x" * (size // 10)
+        files[key] = json.dumps({"Records": [{"key": key, "n": i, "pad": pad} for i in range(10)]}).encode('utf-8')
+    return files
+
+
+class TestRetrieveLogRecords(unittest.TestCase):
+
+    def retrieve(self, files, max_inflight):
+        tracker = FileTracker(files)
+        discovery = StaticDiscovery((key, len(data)) for key, data in files.items())
+        with patch.object(concurrent_lambda, 'read_file', tracker.read_file):
+            for rec in concurrent_lambda.retrieve_log_records(discovery, max_inflight):
+                tracker.consumed(rec)
+        self.assertEqual({}, tracker.held)
+        self.assertTrue(all(count == 0 for count in tracker.remaining.values()))
+        return tracker
+
+
+    def test_window_is_bounded(self):
+        files = make_files(20, 10000)
+        file_size = max(len(data) for data in files.values())
+        tracker = self.retrieve(files, file_size * 3)
+        self.assertLessEqual(tracker.max_held_bytes, file_size * 3)
+        # the window allowed concurrency, once the compression ratio was known
+        self.assertGreater(tracker.max_held_files, 1)
+
+
+    def test_oversize_files_read_one_at_a_time(self):
+        files = make_files(5, 10000)
+        tracker = self.retrieve(files, 1000)
+        self.assertEqual(1, tracker.max_held_files)
+
+
+    def test_no_files(self):
+        self.retrieve({}, 1000)
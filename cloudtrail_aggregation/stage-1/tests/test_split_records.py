@@ -0,0 +1,85 @@
+import importlib
+import json
+import unittest
+
+from unittest.mock import patch
+
+
+# modules under test
+import concurrent_lambda
+serial_lambda = importlib.import_module("lambda")
+
+
+RECORDS = [
+    {"eventID": "1", "requestParameters": {"policy": "{\"Statement\": [{\"Effect\": \"Allow\"}]}", "quote": "a\"b\\c"}},
+    {"eventID": "2", "resources": [{"ARN": "arn:aws:s3:::bucket"}, []], "userAgent": "café ☃"},
+    {},
+    {"eventID": "4", "nested": {"a": {"b": {"c": [1, 2.5, True, False, None]}}}},
+]
+
+
+class TestSplitRecords(unittest.TestCase):
+
+    def assertParity(self, data):
+        """ Asserts that both paths produce the same records, and returns the result
+            of split_records().
+            """
+        expected = json.loads(data)['Records']
+        for module in (concurrent_lambda, serial_lambda):
+            split = module.split_records(data)
+            self.assertIsNotNone(split)
+            self.assertEqual(expected, [json.loads(rec) for rec in split])
+            self.assertTrue(all(b"\n" not in rec for rec in split))
+        return split
+
+
+    def test_compact(self):
+        data = json.dumps({"Records": RECORDS}, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+        split = self.assertParity(data)
+        # the original text is copied, not re-serialized
+        self.assertEqual([json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode('utf-8') for rec in RECORDS], split)
+
+
+    def test_whitespace(self):
+        self.assertParity(b' \n{ "Records" : [ {"eventID": "1"} ,\n {"eventID": "2"} ] }\n')
+
+
+    def test_multiline_records_are_reserialized(self):
+        data = json.dumps({"Records": RECORDS}, indent=2).encode('utf-8')
+        split = self.assertParity(data)
+        self.assertEqual(json.dumps(RECORDS[0]).encode('utf-8'), split[0])
+
+
+    def test_empty(self):
+        self.assertEqual([], self.assertParity(b'{"Records": []}'))
+
+
+    def test_unexpected_structure_falls_back(self):
+        for data in [b'{"Other": [], "Records": [{"eventID": "1"}]}',
+                     b'{"Records": [{"eventID": "1"}], "Other": 1}',
+                     b'{"Records": [{"eventID": "1"}, 2]}']:
+            with self.subTest(data=data):
+                expected = [json.dumps(rec).encode('utf-8') for rec in json.loads(data)['Records']]
+                for module in (concurrent_lambda, serial_lambda):
+                    self.assertIsNone(module.split_records(data))
+                    self.assertEqual(expected, module.extract_records(data))
+
+
+    def test_invalid_json_raises(self):
+        for data in [b'{"Records": [{"eventID": "1"}',
+                     b'{"Records": [{"eventID": "1"]}',
+                     b'{"Records": [{"eventID": "1"} {"eventID": "2"}]}']:
+            with self.subTest(data=data):
+                for module in (concurrent_lambda, serial_lambda):
+                    self.assertIsNone(module.split_records(data))
+                    with self.assertRaises(ValueError):
+                        module.extract_records(data)
+
+
+    def test_validate_records(self):
+        data = json.dumps({"Records": RECORDS}, separators=(",", ":")).encode('utf-8')
+        with patch.object(concurrent_lambda, 'split_records') as split_records, \
+                patch.object(concurrent_lambda, 'validate_records', True):
+            result = concurrent_lambda.extract_records(data)
+        split_records.assert_not_called()
+        self.assertEqual([json.dumps(rec).encode('utf-8') for rec in RECORDS], result)
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from fake_s3 import FakeS3Client
+
+
+# module under test
+import concurrent_lambda
+from concurrent_lambda import FileDiscovery, Topology
+
+
+ACCOUNTS = {
+    "111111111111": ["us-east-1", "us-west-2"],
+    "222222222222": ["us-east-1"],
+}
+
+REFRESH_INTERVAL = timedelta(hours=24)
+
+
+def source_objects():
+    objects = {}
+    for account, regions in ACCOUNTS.items():
+        for region in regions:
+            objects[("src-bucket", f"AWSLogs/{account}/CloudTrail/{region}/2024/03/01/file.json.gz")] = b"x"
+    return objects
+
+
+def region_listings(s3):
+    return len([call for call in s3.calls if call[0] == 'list_objects_v2' and call[1]['Prefix'].endswith("/CloudTrail/")])
+
+
+class TestTopology(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "topology.json")
+        self.s3 = FakeS3Client(source_objects())
+        patcher = patch.object(concurrent_lambda, 's3_client', self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def write_manifest(self, content):
+        with open(self.path, "w") as f:
+            f.write(content if isinstance(content, str) else json.dumps(content))
+
+
+    def read_manifest(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+
+    def discover(self, topology):
+        """ Runs discovery to completion, returning the listed keys.
+            """
+        discovery = FileDiscovery(3, 1, 2024, topology)
+        keys = []
+        while True:
+            files = discovery.queue.get(timeout=10)
+            if files is None:
+                return sorted(key for key, _ in keys)
+            if isinstance(files, Exception):
+                raise files
+            keys += files
+
+
+    def test_miss(self):
+        keys = self.discover(Topology(self.path, REFRESH_INTERVAL))
+        self.assertEqual(3, len(keys))
+        self.assertEqual(2, region_listings(self.s3))
+        self.assertEqual(ACCOUNTS, self.read_manifest()['accounts'])
+
+
+    def test_miss_on_s3(self):
+        location = "s3://dst-bucket/topology.json"
+        self.discover(Topology(location, REFRESH_INTERVAL))
+        self.assertEqual(2, region_listings(self.s3))
+        self.assertIn(("dst-bucket", "topology.json"), self.s3.objects)
+        # the second run uses the manifest
+        self.assertEqual(3, len(self.discover(Topology(location, REFRESH_INTERVAL))))
+        self.assertEqual(2, region_listings(self.s3))
+
+
+    def test_hit(self):
+        refreshed = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+        self.write_manifest({'refreshed': refreshed, 'accounts': ACCOUNTS})
+        mtime = os.stat(self.path).st_mtime_ns
+        keys = self.discover(Topology(self.path, REFRESH_INTERVAL))
+        self.assertEqual(3, len(keys))
+        self.assertEqual(0, region_listings(self.s3))
+        # unchanged, so not rewritten
+        self.assertEqual(mtime, os.stat(self.path).st_mtime_ns)
+
+
+    def test_hit_with_new_and_removed_accounts(self):
+        refreshed = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+        self.write_manifest({'refreshed': refreshed, 'accounts': {"111111111111": ["us-east-1", "us-west-2"], "999999999999": ["eu-west-1"]}})
+        keys = self.discover(Topology(self.path, REFRESH_INTERVAL))
+        self.assertEqual(3, len(keys))
+        self.assertEqual(1, region_listings(self.s3))
+        manifest = self.read_manifest()
+        self.assertEqual(ACCOUNTS, manifest['accounts'])
+        self.assertEqual(refreshed, manifest['refreshed'])
+
+
+    def test_stale(self):
+        refreshed = (datetime.now(timezone.utc) - timedelta(hours=25)).isoformat()
+        self.write_manifest({'refreshed': refreshed, 'accounts': {"111111111111": ["us-east-1"], "222222222222": ["us-east-1"]}})
+        keys = self.discover(Topology(self.path, REFRESH_INTERVAL))
+        self.assertEqual(3, len(keys))
+        self.assertEqual(2, region_listings(self.s3))
+        manifest = self.read_manifest()
+        self.assertEqual(ACCOUNTS, manifest['accounts'])
+        self.assertGreater(datetime.fromisoformat(manifest['refreshed']), datetime.fromisoformat(refreshed))
+
+
+    def test_malformed(self):
+        refreshed = datetime.now(timezone.utc).isoformat()
+        for content in ["{\"refreshed\": ",
+                        [],
+                        {'accounts': ACCOUNTS},
+                        {'refreshed': refreshed},
+                        {'refreshed': "yesterday", 'accounts': ACCOUNTS},
+                        {'refreshed': 12345, 'accounts': ACCOUNTS},
+                        {'refreshed': datetime.now().isoformat(), 'accounts': ACCOUNTS},
+                        {'refreshed': refreshed, 'accounts': ["111111111111"]},
+                        {'refreshed': refreshed, 'accounts': {"111111111111": "us-east-1"}}]:
+            with self.subTest(content=content):
+                self.s3.calls = []
+                self.write_manifest(content)
+                keys = self.discover(Topology(self.path, REFRESH_INTERVAL))
+                self.assertEqual(3, len(keys))
+                self.assertEqual(2, region_listings(self.s3))
+                self.assertEqual(ACCOUNTS, self.read_manifest()['accounts'])
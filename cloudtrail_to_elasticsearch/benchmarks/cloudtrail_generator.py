@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" CloudTrail Generator
+
+    This program creates a corpus of synthetic CloudTrail files, using the same
+    layout and naming as a real trail:
+
+        DESTINATION/AWSLogs/ACCOUNT_ID/CloudTrail/REGION/YYYY/MM/DD/ACCOUNT_ID_CloudTrail_REGION_YYYYMMDDTHHMMZ_XXXXXXXXXXXXXXXX.json.gz
+
+    Invocation:
+
+        ./cloudtrail_generator.py DESTINATION NUM_ACCOUNTS NUM_REGIONS START_DATE NUM_DAYS FILES_PER_HOUR EVENTS_PER_FILE [SHAPE [NUM_PROCESSES]]
+
+    Where:
+
+        DESTINATION      - a local directory, or an S3 location in the form s3://BUCKET/PREFIX
+        NUM_ACCOUNTS     - number of (imaginary) AWS accounts
+        NUM_REGIONS      - number of regions per account (up to 16)
+        START_DATE       - the first date to generate, in the form YYYY-MM-DD
+        NUM_DAYS         - the number of days to generate
+        FILES_PER_HOUR   - number of files per account, region, and hour
+        EVENTS_PER_FILE  - average number of events in each file (actual counts vary by 50%)
+        SHAPE            - the kind of events to generate:
+                              simple     - small events, like most read-only API calls
+                              deep       - nested requestParameters and responseElements,
+                                           like RunInstances or CreateStack
+                              resources  - large resources arrays, like S3 DeleteObjects
+                              mixed      - mostly simple, with some of the others (default)
+        NUM_PROCESSES    - number of concurrent processes (default is the number of CPUs)
+
+    The total number of events is approximately:
+
+        NUM_ACCOUNTS * NUM_REGIONS * NUM_DAYS * 24 * FILES_PER_HOUR * EVENTS_PER_FILE
+
+    So 4 accounts, 4 regions, 7 days, 4 files per hour, and 100 events per file will
+    produce a little over a million events.
+
+    Output is repeatable: the same arguments produce the same events. To write to a
+    local S3 stand-in, set the environment variable AWS_ENDPOINT_URL_S3.
+    """
+
+import boto3
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import string
+import sys
+import uuid
+
+from datetime import date, datetime, timedelta
+
+
+REGIONS = [
+    "us-east-1", "us-east-2", "us-west-1", "us-west-2",
+    "ca-central-1", "eu-west-1", "eu-west-2", "eu-central-1",
+    "eu-north-1", "ap-south-1", "ap-northeast-1", "ap-northeast-2",
+    "ap-southeast-1", "ap-southeast-2", "sa-east-1", "af-south-1",
+]
+
+SHAPES = {
+    'simple':       [('simple', 1)],
+    'deep':         [('deep', 1)],
+    'resources':    [('resources', 1)],
+    'mixed':        [('simple', 85), ('deep', 10), ('resources', 5)],
+}
+
+SIMPLE_CALLS = [
+    ("s3.amazonaws.com",         "GetBucketLocation",   lambda rnd, account: {"bucketName": f"bucket-{rnd.randrange(50)}", "location": ""}),
+    ("ec2.amazonaws.com",        "DescribeInstances",   lambda rnd, account: {"instancesSet": {}, "filterSet": {}}),
+    ("logs.amazonaws.com",       "DescribeLogStreams",  lambda rnd, account: {"logGroupName": f"/aws/lambda/function-{rnd.randrange(20)}", "descending": True}),
+    ("kms.amazonaws.com",        "Decrypt",             lambda rnd, account: {"encryptionAlgorithm": "SYMMETRIC_DEFAULT"}),
+    ("sts.amazonaws.com",        "AssumeRole",          lambda rnd, account: {"roleArn": f"arn:aws:iam::{account}:role/role-{rnd.randrange(10)}", "roleSessionName": f"session-{rnd.randrange(1000)}"}),
+    ("dynamodb.amazonaws.com",   "DescribeTable",       lambda rnd, account: {"tableName": f"table-{rnd.randrange(30)}"}),
+]
+
+
+class Counters:
+    """ A utility class for tracking metrics.
+        """
+
+    def __init__(self):
+        self.counts = {}
+
+    def increment(self, name, amount=1):
+        if name:
+            value = self.counts.get(name, 0)
+            self.counts[name] = value + amount
+
+    def merge(self, other):
+        for name, value in other.items():
+            self.increment(name, value)
+
+
+class Writer:
+    """ Writes gzipped files to either the local filesystem or S3.
+        """
+
+    def __init__(self, destination):
+        if destination.startswith("s3://"):
+            bucket, _, prefix = destination[5:].partition("/")
+            self._s3_client = boto3.client('s3', endpoint_url=os.environ.get('AWS_ENDPOINT_URL_S3'))
+            self._s3_bucket = bucket
+            self._base = prefix.rstrip("/") + "/" if prefix else ""
+        else:
+            self._s3_client = None
+            self._base = destination.rstrip("/") + "/"
+        self.counters = Counters()
+
+    def write(self, key, records):
+        body = gzip.compress(json.dumps({"Records": records}, separators=(',', ':')).encode('utf-8'))
+        self.counters.increment("files")
+        self.counters.increment("events", len(records))
+        self.counters.increment("bytes", len(body))
+        if self._s3_client:
+            self._s3_client.put_object(Bucket=self._s3_bucket, Key=self._base + key, Body=body)
+        else:
+            path = self._base + key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(body)
+
+
+class EventFactory:
+    """ Creates events for a single account and region. All randomness comes from
+        the provided generator, so that output is repeatable.
+        """
+
+    def __init__(self, rnd, account, region, shape):
+        self.rnd = rnd
+        self.account = account
+        self.region = region
+        self.kinds, self.weights = zip(*SHAPES[shape])
+        self.principals = [self._principal(ii) for ii in range(5)]
+
+    def create(self, timestamp, counters):
+        kind = self.rnd.choices(self.kinds, self.weights)[0]
+        if kind == "deep":
+            event_source, event_name, request, response, resources = self._deep()
+        elif kind == "resources":
+            event_source, event_name, request, response, resources = self._resources()
+        else:
+            event_source, event_name, request_fn = self.rnd.choice(SIMPLE_CALLS)
+            request = request_fn(self.rnd, self.account)
+            response, resources = None, None
+        counters.increment(event_name)
+        event = {
+            "eventVersion": "1.08",
+            "userIdentity": self.rnd.choice(self.principals),
+            "eventTime": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "eventSource": event_source,
+            "eventName": event_name,
+            "awsRegion": self.region,
+            "sourceIPAddress": f"10.{self.rnd.randrange(256)}.{self.rnd.randrange(256)}.{self.rnd.randrange(256)}",
+            "userAgent": self.rnd.choice(["aws-cli/2.13.0", "Boto3/1.28.0", "console.amazonaws.com", "aws-sdk-java/2.20.0"]),
+            "requestParameters": request,
+            "responseElements": response,
+            "requestID": self._uuid(),
+            "eventID": self._uuid(),
+            "readOnly": response is None,
+            "eventType": "AwsApiCall",
+            "managementEvent": kind != "resources",
+            "recipientAccountId": self.account,
+            "eventCategory": "Management" if kind != "resources" else "Data",
+        }
+        if resources:
+            event["resources"] = resources
+        return event
+
+    def _deep(self):
+        instances = []
+        for ii in range(self.rnd.randrange(1, 20)):
+            instances.append({
+                "instanceId": f"i-{self.rnd.getrandbits(68):017x}",
+                "imageId": f"ami-{self.rnd.getrandbits(68):017x}",
+                "instanceState": {"code": 0, "name": "pending"},
+                "privateIpAddress": f"10.0.{self.rnd.randrange(256)}.{self.rnd.randrange(256)}",
+                "instanceType": self.rnd.choice(["t3.micro", "m5.large", "c6g.xlarge"]),
+                "placement": {"availabilityZone": f"{self.region}{self.rnd.choice('abc')}", "tenancy": "default"},
+                "networkInterfaceSet": {"items": [{
+                    "networkInterfaceId": f"eni-{self.rnd.getrandbits(68):017x}",
+                    "groupSet": {"items": [{"groupId": f"sg-{self.rnd.getrandbits(68):017x}", "groupName": "default"}]},
+                    "privateIpAddressesSet": {"item": [{"privateIpAddress": "10.0.0.1", "primary": True}]},
+                }]},
+                "blockDeviceMapping": {},
+                "tagSet": {"items": [{"key": f"tag-{jj}", "value": f"value-{self.rnd.randrange(100)}"} for jj in range(self.rnd.randrange(5))]},
+            })
+        request = {
+            "instancesSet": {"items": [{"imageId": instances[0]["imageId"], "minCount": 1, "maxCount": len(instances)}]},
+            "instanceType": instances[0]["instanceType"],
+            "blockDeviceMapping": {"items": [{"deviceName": "/dev/xvda", "ebs": {"volumeSize": 8 * self.rnd.randrange(1, 10), "deleteOnTermination": True, "volumeType": "gp3"}}]},
+            "tagSpecificationSet": {"items": [{"resourceType": "instance", "tags": [{"key": "Name", "value": f"server-{self.rnd.randrange(100)}"}]}]},
+            "launchTemplate": {"launchTemplateId": f"lt-{self.rnd.getrandbits(68):017x}", "version": str(self.rnd.randrange(1, 10))},
+        }
+        response = {
+            "requestId": self._uuid(),
+            "reservationId": f"r-{self.rnd.getrandbits(68):017x}",
+            "ownerId": self.account,
+            "groupSet": {},
+            "instancesSet": {"items": instances},
+        }
+        return "ec2.amazonaws.com", "RunInstances", request, response, None
+
+    def _resources(self):
+        bucket = f"bucket-{self.rnd.randrange(50)}"
+        keys = [f"data/{self.rnd.randrange(1000)}/{self._uuid()}.parquet" for ii in range(self.rnd.randrange(50, 500))]
+        request = {"bucketName": bucket, "Host": f"{bucket}.s3.amazonaws.com", "delete": "", "Delete": {"Quiet": "true", "Object": [{"Key": key} for key in keys]}}
+        resources = [{"type": "AWS::S3::Object", "ARN": f"arn:aws:s3:::{bucket}/{key}"} for key in keys]
+        resources.append({"accountId": self.account, "type": "AWS::S3::Bucket", "ARN": f"arn:aws:s3:::{bucket}"})
+        return "s3.amazonaws.com", "DeleteObjects", request, None, resources
+
+    def _principal(self, ii):
+        role = f"role-{ii}"
+        principal_id = "AROA" + "".join(self.rnd.choices(string.ascii_uppercase + string.digits, k=17))
+        return {
+            "type": "AssumedRole",
+            "principalId": f"{principal_id}:session-{ii}",
+            "arn": f"arn:aws:sts::{self.account}:assumed-role/{role}/session-{ii}",
+            "accountId": self.account,
+            "accessKeyId": "ASIA" + "".join(self.rnd.choices(string.ascii_uppercase + string.digits, k=16)),
+            "sessionContext": {
+                "sessionIssuer": {
+                    "type": "Role",
+                    "principalId": principal_id,
+                    "arn": f"arn:aws:iam::{self.account}:role/{role}",
+                    "accountId": self.account,
+                    "userName": role
+                },
+                "webIdFederationData": {},
+                "attributes": {"creationDate": "2023-01-01T00:00:00Z", "mfaAuthenticated": "false"}
+            }
+        }
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self.rnd.getrandbits(128), version=4))
+
+
+def account_id(ii):
+    return f"{100000000000 + ii * 111111111:012d}"
+
+
+def generate_day(destination, account, region, day, files_per_hour, events_per_file, shape):
+    """ Writes all of the files for a single account, region, and day; this is the
+        unit of work for a worker process. Returns the counters as a dict.
+        """
+    rnd = random.Random(f"{account}/{region}/{day}/{shape}")
+    writer = Writer(destination)
+    factory = EventFactory(rnd, account, region, shape)
+    start = datetime(day.year, day.month, day.day)
+    for file_num in range(24 * files_per_hour):
+        file_start = start + timedelta(hours=1) * file_num / files_per_hour
+        num_events = max(1, int(events_per_file * rnd.uniform(0.5, 1.5)))
+        offsets = sorted(rnd.uniform(0, 3600 / files_per_hour) for ii in range(num_events))
+        records = [factory.create(file_start + timedelta(seconds=offset), writer.counters) for offset in offsets]
+        suffix = "".join(rnd.choices(string.ascii_letters + string.digits, k=16))
+        key = (f"AWSLogs/{account}/CloudTrail/{region}/{day:%Y/%m/%d}/"
+               f"{account}_CloudTrail_{region}_{file_start:%Y%m%dT%H%M}Z_{suffix}.json.gz")
+        writer.write(key, records)
+    print(f"wrote {account} {region} {day}")
+    return writer.counters.counts
+
+
+def main(destination, num_accounts, num_regions, start_date, num_days, files_per_hour, events_per_file, shape="mixed", num_processes=None):
+    if shape not in SHAPES:
+        print(f"invalid shape: {shape}; must be one of {', '.join(SHAPES.keys())}")
+        sys.exit(1)
+    start = date.fromisoformat(start_date)
+    work = [(destination, account_id(aa), region, start + timedelta(days=dd), files_per_hour, events_per_file, shape)
+            for dd in range(num_days)
+            for aa in range(num_accounts)
+            for region in REGIONS[:num_regions]]
+    counters = Counters()
+    with multiprocessing.Pool(num_processes) as pool:
+        for counts in pool.starmap(generate_day, work):
+            counters.merge(counts)
+    print("totals:")
+    for k in ["files", "events", "bytes"]:
+        print(f"   {k} = {counters.counts.pop(k, 0)}")
+    print("events by name:")
+    for k,v in sorted(counters.counts.items()):
+        print(f"   {k} = {v}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 8 or len(sys.argv) > 10:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], int(sys.argv[5]), int(sys.argv[6]), int(sys.argv[7]),
+         sys.argv[8] if len(sys.argv) > 8 else "mixed",
+         int(sys.argv[9]) if len(sys.argv) > 9 else None)
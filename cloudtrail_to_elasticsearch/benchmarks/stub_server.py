@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" A local stand-in for an OpenSearch cluster, implementing just the parts of
+    the API that the loader uses: index GET and PUT, field mapping GET, and _bulk.
+    Documents are parsed and counted, but not stored.
+
+    It can inject latency, throttling (429), and request-too-large (413) responses,
+    so that the loader's retry and batch-splitting paths can be measured.
+
+    Used by throughput.py, or can be run on its own:
+
+        python benchmarks/stub_server.py [--port N] [--latency MS] [--throttle-rate FRACTION] [--max-request-size BYTES]
+
+    Then run bulk_upload with ES_HOSTNAME=localhost:PORT and --plain-http.
+    """
+
+import argparse
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """ The server, holding configuration and statistics for the handler.
+        """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, throttle_rate=0.0, max_request_size=None, seed=None):
+        """
+            port              The port to listen on; 0 picks a free port.
+            latency           Seconds to wait before responding to each _bulk request.
+            throttle_rate     The fraction of _bulk requests that are rejected with 429.
+            max_request_size  If provided, _bulk requests with a larger body (as sent,
+                              so compressed if the request is compressed) are
+                              rejected with 413.
+            seed              Seed for the random number generator that selects
+                              throttled requests, for repeatable runs.
+        """
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_request_size = max_request_size
+        self.random = random.Random(seed)
+        self.indexes = set()
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'bulk_requests': 0,
+            'throttled': 0,
+            'too_large': 0,
+            'documents': 0,
+            'request_bytes': 0,
+            'uncompressed_bytes': 0,
+        }
+
+
+    def start(self):
+        """ Runs the server on a background thread, returning it.
+            """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+    def increment(self, **kwargs):
+        with self.lock:
+            for name, value in kwargs.items():
+                self.stats[name] += value
+
+
+    def statistics(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        self.read_body()
+        self.server.increment(requests=1)
+        path, _, query = self.path.partition("?")
+        names = path.strip("/").split("/")[0].split(",")
+        existing = [name for name in names if name in self.server.indexes]
+        if "/_mapping/field/" in path:
+            self.respond(200, {name: {"mappings": {}} for name in existing})
+        elif query or len(names) > 1:
+            self.respond(200, {name: {"settings": {"index": {"uuid": name}}} for name in existing})
+        elif existing:
+            self.respond(200, {names[0]: {}})
+        else:
+            self.respond(404, {"error": {"type": "index_not_found_exception"}, "status": 404})
+
+
+    def do_PUT(self):
+        self.read_body()
+        self.server.increment(requests=1)
+        index = self.path.partition("?")[0].strip("/").split("/")[0]
+        with self.server.lock:
+            self.server.indexes.add(index)
+        self.respond(200, {"acknowledged": True, "index": index})
+
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.increment(requests=1, bulk_requests=1, request_bytes=len(body))
+        if self.path != "/_bulk":
+            self.respond(404, {"error": "unsupported path", "status": 404})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.max_request_size and len(body) > self.server.max_request_size:
+            self.server.increment(too_large=1)
+            self.respond(413, {"message": "Request size exceeded"})
+            return
+        with self.server.lock:
+            throttled = self.server.random.random() < self.server.throttle_rate
+        if throttled:
+            self.server.increment(throttled=1)
+            self.respond(429, {"error": {"type": "es_rejected_execution_exception"}, "status": 429})
+            return
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        items = []
+        lines = body.splitlines()
+        for action in lines[0::2]:
+            index = json.loads(action)['index']['_index']
+            items.append({"index": {"_index": index, "status": 201}})
+        self.server.increment(documents=len(items), uncompressed_bytes=len(body))
+        self.respond(200, {"took": 1, "errors": False, "items": items})
+
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+    def respond(self, status, rsp):
+        data = json.dumps(rsp).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Runs a local stand-in for an OpenSearch cluster")
+    arg_parser.add_argument("--port", type=int, default=9200)
+    arg_parser.add_argument("--latency", type=float, default=0, metavar="MS",
+                            help="Milliseconds to wait before responding to each _bulk request")
+    arg_parser.add_argument("--throttle-rate", type=float, default=0, metavar="FRACTION", dest='throttle_rate',
+                            help="Fraction of _bulk requests that are rejected with 429")
+    arg_parser.add_argument("--max-request-size", type=int, metavar="BYTES", dest='max_request_size',
+                            help="_bulk requests with larger bodies are rejected with 413")
+    args = arg_parser.parse_args()
+    server = StubServer(args.port, args.latency / 1000, args.throttle_rate, args.max_request_size)
+    print(f"listening on 127.0.0.1:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"statistics: {server.statistics()}")
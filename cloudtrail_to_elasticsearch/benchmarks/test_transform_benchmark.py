@@ -0,0 +1,243 @@
+""" Benchmarks for event parsing and transformation, using pytest-benchmark. Run
+    from the project directory:
+
+        python -m pytest benchmarks
+
+    Each benchmark of the current code is paired with one of the implementation
+    that it replaced (reference_transform_event(), below), in the same group, and
+    both check that they produce the same output before they're timed.
+
+    To compare against a previous run, add --benchmark-autosave to the baseline
+    run and --benchmark-compare to the later one.
+    """
+
+import copy
+import gzip
+import io
+import json
+import uuid
+
+import pytest
+
+from cloudtrail_to_elasticsearch import processor
+from cloudtrail_to_elasticsearch.event_reader import EventReader, open_stream
+
+
+EVENTS_PER_FILE = 1000
+
+
+def load_fixture(name):
+    with open(f"tests/resources/{name}.json") as f:
+        return json.load(f)
+
+
+def many_resources(template, count=200):
+    """ An event like those produced by bulk S3 or KMS operations, with a large
+        resources array.
+        """
+    event = copy.deepcopy(template)
+    event['resources'] = [{"ARN": f"arn:aws:s3:::example-bucket/key-{ii}", "type": "AWS::S3::Object", "accountId": "123456789012"}
+                          for ii in range(count)]
+    return event
+
+
+def deep_request_parameters(template, depth=6, width=4):
+    """ An event like RunInstances or CreateStack, with nested request parameters
+        and arrays of objects at every level.
+        """
+    def build(level):
+        if level == depth:
+            return {"value": f"leaf-{level}", "count": level, "enabled": True}
+        return {f"items{level}": [build(level + 1) for ii in range(width if level < 3 else 1)], f"name{level}": f"n-{level}"}
+    event = copy.deepcopy(template)
+    event['requestParameters'] = build(0)
+    event['responseElements'] = {"instancesSet": {"items": [{"instanceId": f"i-{ii:017x}", "state": {"code": 0, "name": "pending"}} for ii in range(20)]}}
+    return event
+
+
+EVENTS = {
+    'simple':                 load_fixture("simple_event"),
+    'request_parameters':     load_fixture("event_with_request_parameters"),
+    'many_resources':         many_resources(load_fixture("event_with_request_parameters")),
+    'deep_request_parameters': deep_request_parameters(load_fixture("event_with_request_parameters")),
+}
+
+
+def cloudtrail_file(template):
+    records = []
+    for ii in range(EVENTS_PER_FILE):
+        event = copy.deepcopy(template)
+        event['eventID'] = str(uuid.uuid4())
+        records.append(event)
+    return gzip.compress(json.dumps({"Records": records}, separators=(',', ':')).encode('utf-8'))
+
+
+# the flatten/transform implementation that was replaced by processor.flatten_value(),
+# kept as a reference for speed and output
+
+def reference_transform_events(events):
+    return [reference_transform_event(event) for event in events]
+
+
+def reference_transform_event(event):
+    reference_flatten(event, 'requestParameters')
+    reference_flatten(event, 'responseElements')
+    reference_flatten(event, 'resources')
+    reference_flatten(event, 'serviceEventDetails')
+    return event
+
+
+def reference_flatten(event, key):
+    src = event.pop(key, None);
+    if not src:
+        return
+    if isinstance(src, dict):
+        dst = reference_flatten_dict(src, {})
+    elif isinstance(src, list):
+        dst = reference_flatten_list(key, src, {})
+    else:
+        # this is something that doesn't need to be flattened; put it back
+        event[key] = src
+        return
+    event[key + "_raw"] = json.dumps(src)
+    event[key + "_flattened"] = reference_transform_flattened_elements(dst)
+
+
+def reference_flatten_dict(src, dst):
+    for key in src.keys():
+        # CloudTrail events sometimes contains blank keys; we'll skip those
+        if key:
+            reference_flatten_item(key, src[key], dst)
+    return dst
+
+
+def reference_flatten_list(key, val, dst):
+    for item in val:
+        reference_flatten_item(key, item, dst)
+    return dst
+
+
+def reference_flatten_item(key, val, dst):
+    if isinstance(val, dict):
+        reference_flatten_dict(val, dst)
+    elif isinstance(val, list):
+        reference_flatten_list(key, val, dst)
+    else:
+        if not key in dst:
+            dst[key] = set()
+        dst[key].add(val)
+    return dst
+
+
+def reference_transform_flattened_elements(src):
+    dst = {}
+    for (k, v) in src.items():
+        # Elasticsearch doesn't like keys that have dots in them
+        k = k.replace(".", "_")
+        # json.dumps() doesn't like sets
+        if isinstance(v, set):
+            tmp = v
+            v = list()
+            for item in tmp:
+                v.append(str(item))
+        dst[k] = v
+    return dst
+
+
+def reference_parse_and_transform(content):
+    stream = open_stream(io.BufferedReader(io.BytesIO(content)))
+    return reference_transform_events(EventReader(stream))
+
+
+def assert_parity(expected, actual):
+    """ Asserts that two lists of transformed events are the same. The reference
+        implementation collects values in a set, so their order is arbitrary; the
+        values themselves must be identical.
+        """
+    assert len(expected) == len(actual)
+    for exp, act in zip(expected, actual):
+        exp = dict(exp)
+        act = dict(act)
+        for key in processor.FLATTENED_KEYS:
+            if key + "_raw" in exp or key + "_raw" in act:
+                assert json.loads(exp.pop(key + "_raw")) == json.loads(act.pop(key + "_raw")), key
+                exp_flattened = exp.pop(key + "_flattened")
+                act_flattened = act.pop(key + "_flattened")
+                assert list(exp_flattened.keys()) == list(act_flattened.keys()), key
+                for field, values in exp_flattened.items():
+                    assert sorted(values) == sorted(act_flattened[field]), f"{key}: {field}"
+                    assert len(set(act_flattened[field])) == len(act_flattened[field]), f"{key}: {field}"
+        assert exp == act
+
+
+@pytest.fixture(params=list(EVENTS.keys()))
+def event_name(request):
+    return request.param
+
+
+def test_transform_event(benchmark, event_name):
+    """ Transforms a single parsed event, serializing the flattened sections.
+        """
+    template = EVENTS[event_name]
+    assert_parity([reference_transform_event(copy.deepcopy(template))], [processor.transform_event(copy.deepcopy(template))])
+    benchmark.group = f"transform_event-{event_name}"
+    benchmark(lambda: processor.transform_event(copy.deepcopy(template)))
+
+
+def test_reference_transform_event(benchmark, event_name):
+    """ As above, using the reference implementation.
+        """
+    template = EVENTS[event_name]
+    assert_parity([reference_transform_event(copy.deepcopy(template))], [processor.transform_event(copy.deepcopy(template))])
+    benchmark.group = f"transform_event-{event_name}"
+    benchmark(lambda: reference_transform_event(copy.deepcopy(template)))
+
+
+def test_deepcopy_baseline(benchmark, event_name):
+    """ The cost of copying the event, which is included in both of the above.
+        """
+    template = EVENTS[event_name]
+    benchmark.group = f"transform_event-{event_name}"
+    benchmark(lambda: copy.deepcopy(template))
+
+
+def test_parse_and_transform_file(benchmark, event_name):
+    """ Decompresses, parses, and transforms a file of events, reusing the source
+        text of the flattened sections. This is the path used by bulk_upload.
+        """
+    content = cloudtrail_file(EVENTS[event_name])
+    assert_parity(reference_parse_and_transform(content), processor.parse_and_transform(content))
+    benchmark.group = f"parse_and_transform-{event_name}"
+    result = benchmark(processor.parse_and_transform, content)
+    assert len(result) == EVENTS_PER_FILE
+
+
+def test_parse_and_transform_file_without_raw(benchmark, event_name):
+    """ As above, but re-serializing the flattened sections.
+        """
+    content = cloudtrail_file(EVENTS[event_name])
+    def run():
+        stream = open_stream(io.BufferedReader(io.BytesIO(content)))
+        return [processor.transform_event(event) for event in EventReader(stream)]
+    assert_parity(reference_parse_and_transform(content), run())
+    benchmark.group = f"parse_and_transform-{event_name}"
+    result = benchmark(run)
+    assert len(result) == EVENTS_PER_FILE
+
+
+def test_reference_parse_and_transform_file(benchmark, event_name):
+    """ As above, using the reference implementation.
+        """
+    content = cloudtrail_file(EVENTS[event_name])
+    benchmark.group = f"parse_and_transform-{event_name}"
+    result = benchmark(reference_parse_and_transform, content)
+    assert len(result) == EVENTS_PER_FILE
+
+
+def test_json_loads_baseline(benchmark, event_name):
+    """ The cost of decompressing and parsing a file with the standard library,
+        without transformation.
+        """
+    content = cloudtrail_file(EVENTS[event_name])
+    benchmark.group = f"parse_and_transform-{event_name}"
+    benchmark(lambda: json.loads(gzip.decompress(content))['Records'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" End-to-end throughput benchmark: runs bulk_upload --local against the stub
+    server in stub_server.py, and reports events/second, bytes/second, request
+    counts, and peak memory. Run from the project directory:
+
+        python benchmarks/throughput.py [--corpus DIR | --files N --events N] [--latency MS] [--throttle-rate FRACTION] [--max-request-size BYTES] [--label LABEL] [--output FILE] [BULK_UPLOAD_OPTIONS...]
+
+    Any options that aren't recognized (eg, --workers 4 --compress) are passed to
+    bulk_upload. If --corpus isn't provided, a corpus is generated in a temporary
+    directory from the events in tests/resources.
+
+    With --output, results are appended to the named file as a JSON line, so that
+    runs can be compared from one release to the next.
+    """
+
+import argparse
+import copy
+import datetime
+import gzip
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from stub_server import StubServer
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEMPLATES = ["simple_event", "event_with_request_parameters"]
+
+
+def generate_corpus(directory, num_files, events_per_file, seed=None):
+    """ Writes CloudTrail files to the directory, spread over two months so that
+        more than one index is involved. Returns the total number of events.
+        """
+    rnd = random.Random(seed)
+    templates = []
+    for name in TEMPLATES:
+        with open(os.path.join(PROJECT_DIR, "tests", "resources", f"{name}.json")) as f:
+            templates.append(json.load(f))
+    start = datetime.datetime(2021, 1, 15)
+    interval = datetime.timedelta(days=30) / num_files
+    for ii in range(num_files):
+        timestamp = start + interval * ii
+        records = []
+        for jj in range(events_per_file):
+            event = copy.deepcopy(rnd.choice(templates))
+            event['eventID'] = str(uuid.UUID(int=rnd.getrandbits(128)))
+            event['eventTime'] = (timestamp + datetime.timedelta(seconds=jj)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            records.append(event)
+        filename = f"123456789012_CloudTrail_us-east-1_{timestamp:%Y%m%dT%H%M}Z_{ii:016x}.json.gz"
+        subdir = os.path.join(directory, "AWSLogs", "123456789012", "CloudTrail", "us-east-1", f"{timestamp:%Y/%m/%d}")
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, filename), "wb") as f:
+            f.write(gzip.compress(json.dumps({"Records": records}).encode('utf-8')))
+    return num_files * events_per_file
+
+
+def run_upload(server, corpus, upload_args):
+    """ Runs bulk_upload as a child process, returning elapsed seconds and its
+        peak resident set size in megabytes.
+        """
+    env = dict(os.environ)
+    env['ES_HOSTNAME'] = f"127.0.0.1:{server.server_port}"
+    cmd = [sys.executable, "-m", "cloudtrail_to_elasticsearch.bulk_upload", "--local", corpus, "--plain-http"] + upload_args
+    print(f"running: {' '.join(cmd[1:])}")
+    start = time.monotonic()
+    subprocess.run(cmd, env=env, cwd=PROJECT_DIR, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.monotonic() - start
+    # ru_maxrss is kilobytes on Linux, bytes on MacOS
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak_rss_mb = maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+    return elapsed, peak_rss_mb
+
+
+def report(label, upload_args, elapsed, peak_rss_mb, stats):
+    result = {
+        'label':              label,
+        'timestamp':          datetime.datetime.now().isoformat(timespec='seconds'),
+        'upload_args':        upload_args,
+        'elapsed_seconds':    round(elapsed, 3),
+        'events':             stats['documents'],
+        'events_per_second':  round(stats['documents'] / elapsed, 1),
+        'mb_per_second':      round(stats['request_bytes'] / elapsed / (1024 * 1024), 3),
+        'request_bytes':      stats['request_bytes'],
+        'uncompressed_bytes': stats['uncompressed_bytes'],
+        'requests':           stats['requests'],
+        'bulk_requests':      stats['bulk_requests'],
+        'throttled':          stats['throttled'],
+        'too_large':          stats['too_large'],
+        'peak_rss_mb':        round(peak_rss_mb, 1),
+    }
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value}")
+    return result
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Measures bulk_upload throughput against a local stub server")
+    arg_parser.add_argument("--corpus", metavar="DIR",
+                            help="An existing directory of CloudTrail files; if omitted, one is generated")
+    arg_parser.add_argument("--files", type=int, default=50,
+                            help="Number of files to generate (default 50)")
+    arg_parser.add_argument("--events", type=int, default=1000,
+                            help="Number of events per generated file (default 1000)")
+    arg_parser.add_argument("--latency", type=float, default=0, metavar="MS",
+                            help="Milliseconds that the server waits before responding to each _bulk request")
+    arg_parser.add_argument("--throttle-rate", type=float, default=0, metavar="FRACTION", dest='throttle_rate',
+                            help="Fraction of _bulk requests that the server rejects with 429")
+    arg_parser.add_argument("--max-request-size", type=int, metavar="BYTES", dest='max_request_size',
+                            help="The server rejects _bulk requests with larger bodies with 413")
+    arg_parser.add_argument("--seed", type=int, default=42,
+                            help="Seed for generated events and throttling, for repeatable runs")
+    arg_parser.add_argument("--label", default="",
+                            help="A label for this run (eg, a release or commit)")
+    arg_parser.add_argument("--output", metavar="FILE",
+                            help="Appends the results to this file as a JSON line")
+    args, upload_args = arg_parser.parse_known_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = args.corpus
+        if not corpus:
+            corpus = tmpdir
+            print(f"generating {args.files} files with {args.events} events each")
+            generate_corpus(corpus, args.files, args.events, args.seed)
+        server = StubServer(0, args.latency / 1000, args.throttle_rate, args.max_request_size, args.seed).start()
+        try:
+            elapsed, peak_rss_mb = run_upload(server, corpus, upload_args)
+        finally:
+            server.stop()
+        result = report(args.label, upload_args, elapsed, peak_rss_mb, server.statistics())
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
@@ -0,0 +1,101 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Adjusts the size of _bulk requests based on how the cluster responds to them.
+    """
+
+
+import collections
+
+
+class AdaptiveBatchSizer:
+    """ Uses additive-increase/multiplicative-decrease to find the largest batch
+        size that the cluster can sustain: as long as requests complete within the
+        target latency, the batch size grows by a fixed step; if a request is
+        rejected as too large, is throttled, or takes too long, it shrinks by a
+        factor. Sizes are always kept within the configured bounds.
+
+        The limit on number of records per batch is scaled along with the size, so
+        that it stays proportional to the initial limits.
+
+        This object is called from whichever threads are making requests; it does
+        not do its own locking.
+    """
+
+    def __init__(self, initial_size, min_size, max_size, initial_docs=None,
+                 target_latency=2.0, step=256 * 1024, decrease_factor=0.5,
+                 throttle_window=20, max_throttle_rate=0.1):
+        """
+            initial_size      The starting batch size, in bytes.
+            min_size          The lower bound for batch size, in bytes.
+            max_size          The upper bound for batch size, in bytes.
+            initial_docs      If provided, the starting limit on number of records in a
+                              batch; by default there's no limit.
+            target_latency    The number of seconds that a request should take, measured
+                              both by the client and by the cluster's "took" value.
+            step              The number of bytes added after each successful request.
+            decrease_factor   The multiplier applied when a request fails.
+            throttle_window   The number of recent requests used to calculate the
+                              throttling rate.
+            max_throttle_rate The fraction of recent requests that may be throttled
+                              before the size is reduced.
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.batch_size = self.clamp(initial_size)
+        self.docs_per_byte = initial_docs / initial_size if initial_docs else None
+        self.target_latency = target_latency
+        self.step = step
+        self.decrease_factor = decrease_factor
+        self.recent_throttles = collections.deque(maxlen=throttle_window)
+        self.max_throttle_rate = max_throttle_rate
+
+
+    @property
+    def max_docs(self):
+        if self.docs_per_byte is None:
+            return None
+        return max(1, int(self.batch_size * self.docs_per_byte))
+
+
+    def record(self, status, request_size, elapsed, took=None, throttled=False):
+        """ Updates the batch size based on the result of a request.
+
+            status        The HTTP status code of the request.
+            request_size  The size of the request body, in bytes.
+            elapsed       The number of seconds that the request took.
+            took          The "took" value from the response, in milliseconds.
+            throttled     True if any records in the response were throttled.
+        """
+        throttled = throttled or status == 429
+        self.recent_throttles.append(throttled)
+        throttle_rate = sum(self.recent_throttles) / len(self.recent_throttles)
+        if status == 413:
+            # the request that failed might have been smaller than the current size
+            self.batch_size = self.clamp(min(self.batch_size, request_size) * self.decrease_factor)
+        elif throttled and throttle_rate > self.max_throttle_rate:
+            self.batch_size = self.clamp(self.batch_size * self.decrease_factor)
+        elif status == 200:
+            server_latency = (took or 0) / 1000.0
+            if max(elapsed, server_latency) > self.target_latency:
+                self.batch_size = self.clamp(self.batch_size * self.decrease_factor)
+            elif not throttled and request_size >= self.batch_size * 0.5:
+                # only grow if we're actually filling batches
+                self.batch_size = self.clamp(self.batch_size + self.step)
+
+
+    def clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
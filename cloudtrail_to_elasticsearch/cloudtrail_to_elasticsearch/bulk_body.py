@@ -0,0 +1,188 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Builds the body of a _bulk request as UTF-8 bytes.
+    """
+
+
+import json
+import zlib
+
+# the compressor is flushed after this many bytes of input, so that the compressed
+# size stays close to accurate
+COMPRESSION_FLUSH_INTERVAL = 64 * 1024
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_json(value):
+    """ Serializes the passed value to compact UTF-8 JSON. Uses orjson if it's
+        installed, falling back to the standard library for anything that it
+        can't handle (such as integers larger than 64 bits). Strings containing
+        lone surrogates, which json.loads() accepts but UTF-8 can't represent, are
+        written as escapes.
+        """
+    if orjson:
+        try:
+            return orjson.dumps(value)
+        except (orjson.JSONEncodeError, TypeError):
+            pass
+    try:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class BulkBody:
+    """ Accumulates action and document lines in a single buffer, recording the
+        offset at which each item starts, so that individual items can be extracted
+        to resubmit or report failures. The size of the body is exact, in bytes.
+
+        The buffer can't grow while a view of it exists, so callers should release
+        the view returned by view() (by using it in a "with" statement) before
+        adding more items.
+
+        If given a compression level, items are also fed to a gzip compressor as
+        they're added. The compressed size is approximate until the body is
+        finished, because the compressor holds back some data; to limit this, it's
+        flushed at intervals.
+        """
+
+    def __init__(self, compression_level=None):
+        """
+            compression_level  If provided, the zlib compression level (1-9) used to
+                               produce a gzipped body.
+        """
+        self.buf = bytearray()
+        self.offsets = []
+        self.item_indexes = []
+        self.compression_level = compression_level
+        self.compressor = None
+        self.compressed_size = None
+        self.gzipped = None
+        if compression_level is not None:
+            self.start_compression()
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    @property
+    def size(self):
+        return len(self.buf)
+
+
+    def add(self, index, event):
+        """ Appends an "index" action and the event itself.
+            """
+        start = len(self.buf)
+        self.offsets.append(start)
+        self.item_indexes.append(index)
+        self.gzipped = None
+        self.buf += b'{"index":{"_index":'
+        self.buf += encode_json(index)
+        self.buf += b',"_id":'
+        self.buf += encode_json(event['eventID'])
+        self.buf += b'}}\n'
+        self.buf += encode_json(event)
+        self.buf += b'\n'
+        if self.compression_level is not None:
+            self.feed(memoryview(self.buf)[start:])
+
+
+    def add_item(self, item, index):
+        """ Appends an item that was retrieved from another body.
+            """
+        self.offsets.append(len(self.buf))
+        self.item_indexes.append(index)
+        self.gzipped = None
+        self.buf += item
+        if self.compression_level is not None:
+            self.feed(item)
+
+
+    def start_compression(self):
+        self.compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.compressed_chunks = []
+        self.compressed_size = 0
+        self.unflushed = 0
+
+
+    def feed(self, data):
+        if not self.compressor:
+            # items were added after the body was compressed, so start again
+            self.start_compression()
+            data = self.buf
+        chunk = self.compressor.compress(data)
+        self.unflushed += len(data)
+        if self.unflushed >= COMPRESSION_FLUSH_INTERVAL:
+            chunk += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.unflushed = 0
+        if chunk:
+            self.compressed_chunks.append(chunk)
+            self.compressed_size += len(chunk)
+
+
+    def gzip(self):
+        """ Finishes compression and returns the compressed body. If more items are
+            added after this is called, the body is recompressed.
+            """
+        if self.gzipped is None:
+            self.compressed_chunks.append(self.compressor.flush())
+            self.gzipped = b''.join(self.compressed_chunks)
+            self.compressed_size = len(self.gzipped)
+            self.compressor = None
+            self.compressed_chunks = None
+        return self.gzipped
+
+
+    def indexes(self):
+        """ Returns the names of the indexes used by this body's items, in sorted order.
+            """
+        return sorted(set(self.item_indexes))
+
+
+    def item(self, idx):
+        """ Returns the bytes (action and document lines) for a single item.
+            """
+        end = self.offsets[idx + 1] if idx + 1 < len(self.offsets) else len(self.buf)
+        return bytes(self.buf[self.offsets[idx]:end])
+
+
+    def subset(self, indexes):
+        """ Returns a new body containing only the items at the specified positions.
+            """
+        result = BulkBody(self.compression_level)
+        for idx in indexes:
+            result.add_item(self.item(idx), self.item_indexes[idx])
+        return result
+
+
+    def split(self):
+        """ Returns two bodies, each containing half of this body's items.
+            """
+        half = len(self) // 2
+        return self.subset(range(half)), self.subset(range(half, len(self)))
+
+
+    def view(self):
+        """ Returns a view of the buffer, suitable for use as a request body.
+            """
+        return memoryview(self.buf)
@@ -20,20 +20,34 @@
 
     Intended to be invoked from the command-line, using one of these forms:
 
-        python -m cloudtrail_to_elasticsearch.bulk_upload [--dates START_DATE END_DATE] --s3 BUCKET_NAME [PREFIX]
-        python -m cloudtrail_to_elasticsearch.bulk_upload [--dates START_DATE END_DATE] --local FILE_OR_DIRECTORY
+        python -m cloudtrail_to_elasticsearch.bulk_upload [--dates START_DATE END_DATE] [--workers N [--inflight-bulk M]] --s3 BUCKET_NAME [PREFIX]
+        python -m cloudtrail_to_elasticsearch.bulk_upload [--dates START_DATE END_DATE] [--workers N [--inflight-bulk M]] --local FILE_OR_DIRECTORY
+
+    Add --checkpoint FILE to record progress, and --resume to continue an upload
+    that was interrupted. Run with --help for other options.
 
     Must have the following environment variables set:
 """
 
 import argparse
+import datetime
+import functools
 import os
 import pathlib
 import re
 import sys
 
 from cloudtrail_to_elasticsearch import processor
+from cloudtrail_to_elasticsearch import retry
+from cloudtrail_to_elasticsearch.batch_sizer import AdaptiveBatchSizer
+from cloudtrail_to_elasticsearch.checkpoint import Checkpoint
+from cloudtrail_to_elasticsearch.dedup_filter import BLOOM, DEFAULT_MAX_MEMORY, LRU, DedupFilter
+from cloudtrail_to_elasticsearch.es_helper import DEFAULT_BATCH_SIZE
+from cloudtrail_to_elasticsearch.field_policy import FieldPolicy
+from cloudtrail_to_elasticsearch.metrics import Metrics, summary_table, write_prometheus
+from cloudtrail_to_elasticsearch.pipeline import Pipeline
 from cloudtrail_to_elasticsearch.s3_helper import S3Helper
+from cloudtrail_to_elasticsearch.s3_listing import list_cloudtrail_keys
 
 
 ##
@@ -73,17 +87,134 @@ arg_parser.add_argument("--s3",
                                 formatted "YYYY-MM-DD"; use dummy values (eg, "9999-12-31") to bound on one
                                 side only.
                                 """)
-args = arg_parser.parse_args()
-
-args.date_range = args.date_range or ("0000-01-01", "9999-12-31")
-args.date_start = args.date_range[0].replace("-", "")
-args.date_finish = args.date_range[1].replace("-", "")
+arg_parser.add_argument("--workers",
+                        type=int,
+                        default=0,
+                        metavar="N",
+                        help="""If provided, files are processed by a pipeline with N threads to
+                                retrieve files and N processes to transform their events. By
+                                default, files are processed one at a time.
+                                """)
+arg_parser.add_argument("--inflight-bulk",
+                        type=int,
+                        default=1,
+                        metavar="M",
+                        dest='inflight_bulk',
+                        help="""When using --workers, the number of concurrent _bulk requests
+                                (default 1).
+                                """)
+arg_parser.add_argument("--dead-letter",
+                        metavar="LOCATION",
+                        dest='dead_letter',
+                        help="""A local file, or S3 location in the form s3://BUCKET/PREFIX, that
+                                receives events that could not be written to Elasticsearch.
+                                """)
+arg_parser.add_argument("--adaptive-batch",
+                        nargs=2,
+                        type=float,
+                        metavar=("MIN_MB", "MAX_MB"),
+                        dest='adaptive_batch',
+                        help="""Adjusts the size of _bulk requests between the given bounds
+                                (in megabytes), based on how quickly the cluster responds and
+                                whether it throttles or rejects requests.
+                                """)
+arg_parser.add_argument("--checkpoint",
+                        metavar="FILE",
+                        dest='checkpoint',
+                        help="""A local file that records the files (and events within files) that
+                                have been written, so that an interrupted upload can be resumed.
+                                """)
+arg_parser.add_argument("--resume",
+                        action='store_true',
+                        help="""With --checkpoint, skips files and events that were written by a
+                                previous run; otherwise the checkpoint file is reset.
+                                """)
+arg_parser.add_argument("--max-batch-age",
+                        type=float,
+                        metavar="SECONDS",
+                        dest='max_batch_age',
+                        help="""Writes a batch once it's this old, even if it isn't full.
+                                """)
+arg_parser.add_argument("--field-allow",
+                        nargs="+",
+                        metavar="PATTERN",
+                        dest='field_allow',
+                        help="""Glob patterns for flattened fields that may be indexed individually
+                                (eg, "requestParameters_flattened.bucketName"); other flattened
+                                fields are folded into a per-section "_overflow" field.
+                                """)
+arg_parser.add_argument("--field-deny",
+                        nargs="+",
+                        metavar="PATTERN",
+                        dest='field_deny',
+                        help="""Glob patterns for flattened fields that are not indexed at all.
+                                """)
+arg_parser.add_argument("--field-budget",
+                        type=int,
+                        metavar="N",
+                        dest='field_budget',
+                        help="""The maximum number of distinct flattened fields in an index; once
+                                reached, new fields are folded into a per-section "_overflow" field.
+                                """)
+arg_parser.add_argument("--dedup",
+                        nargs="?",
+                        type=float,
+                        const=DEFAULT_MAX_MEMORY // (1024 * 1024),
+                        metavar="MB",
+                        help="""Drops events whose eventID has already been seen in the same index,
+                                remembering recent IDs in up to MB megabytes of memory (default
+                                %(const)s). CloudTrail may deliver an event more than once, and
+                                organization and account trails may overlap.
+                                """)
+arg_parser.add_argument("--dedup-bloom",
+                        action='store_true',
+                        dest='dedup_bloom',
+                        help="""Uses a bloom filter for --dedup, rather than an LRU. This remembers
+                                far more IDs, but may (rarely) drop an event that isn't a duplicate.
+                                """)
+arg_parser.add_argument("--compress",
+                        nargs="?",
+                        type=int,
+                        const=6,
+                        metavar="LEVEL",
+                        dest='compression_level',
+                        help="""Gzips _bulk requests, at the given level (1-9, default 6).
+                                """)
+arg_parser.add_argument("--limit-compressed",
+                        action='store_true',
+                        dest='limit_compressed',
+                        help="""With --compress, applies the batch size limit to the compressed
+                                size of a request rather than its uncompressed size.
+                                """)
+arg_parser.add_argument("--metrics",
+                        nargs="?",
+                        const="",
+                        metavar="FILE",
+                        help="""Records the time spent in each stage of processing, and prints a
+                                summary table at the end of the run. If FILE is provided, the
+                                metrics are also written to it in Prometheus text format.
+                                """)
+arg_parser.add_argument("--parquet",
+                        metavar="LOCATION",
+                        help="""Also writes the transformed events as Parquet files, partitioned
+                                by month, to LOCATION: a local directory or s3://BUCKET/PREFIX.
+                                Requires pyarrow. Checkpoints only track Elasticsearch, so
+                                a resumed run does not rewrite events from earlier runs.
+                                """)
+arg_parser.add_argument("--plain-http",
+                        action='store_true',
+                        dest='plain_http',
+                        help="""Connects to ES_HOSTNAME (which may include a port) using HTTP,
+                                without AWS request signing; for a local test server.
+                                """)
 
 
 ##
 ## Helper functions
 ##
 
+CLOUDTRAIL_START_DATE = "2013-11-01"
+
 FILENAME_REGEX = re.compile(r".*_CloudTrail_[^_]*_(\d{8})T\d{4}Z_.*json.gz")
 
 def include_file(filename):
@@ -111,36 +242,149 @@ def local_files(root):
     return result
 
 
+def read_local_file(filename):
+    with open(filename, mode='rb') as f:
+        return f.read()
+
+
 def s3_files(s3_helper, bucket, prefix):
-    """ Retrieves a list of files from S3 that match the provided date range.
+    """ A generator that produces the files on S3 that match the provided date range,
+        as they're listed.
+        """
+    start, finish = cloudtrail_date_range()
+    for key in list_cloudtrail_keys(s3_helper, bucket, prefix, start, finish):
+        if include_file(key):
+            yield key
+
+
+def cloudtrail_date_range():
+    """ Returns the configured date range, clamped to the range in which CloudTrail
+        could have written events.
         """
-    file_list = []
-    def select_files(b,k):
-        if include_file(k):
-            file_list.append(k)
-    s3_helper.iterate_bucket(bucket, prefix, select_files)
-    return file_list
+    start = max(args.date_range[0], CLOUDTRAIL_START_DATE)
+    finish = min(args.date_range[1], datetime.date.today().isoformat())
+    return start, finish
 
 
 ##
 ## The main event
 ##
 
-s3 = S3Helper()
-px = processor.create()
+def serial_upload(px, s3):
+    if args.local_path:
+        for filename in local_files(args.local_path):
+            for skip, progress in checkpoint_status(filename):
+                print(f"processing local file: {filename}")
+                px.process_local_file(filename, flush=False, skip=skip, progress=progress)
+        px.flush()
+    else:
+        bucket, prefix = s3_location()
+        for key in s3_files(s3, bucket, prefix):
+            for skip, progress in checkpoint_status(f"s3://{bucket}/{key}"):
+                print(f"processing S3 file: s3://{bucket}/{key}")
+                px.process_from_s3(bucket, key, flush=False, skip=skip, progress=progress)
+        px.flush()
+
+
+def pipelined_upload(px, s3):
+    if args.local_path:
+        sources = ((f"local file: {filename}", processor.index_name(filename), functools.partial(read_local_file, filename), skip, progress)
+                   for filename in local_files(args.local_path)
+                   for skip, progress in checkpoint_status(filename))
+    else:
+        bucket, prefix = s3_location()
+        sources = ((f"S3 file: s3://{bucket}/{key}", processor.index_name(key), functools.partial(s3.retrieve, bucket, key, gzipped=False), skip, progress)
+                   for key in s3_files(s3, bucket, prefix)
+                   for skip, progress in checkpoint_status(f"s3://{bucket}/{key}"))
+    Pipeline(px, args.workers).run(source for source in sources if source[1])
+
 
-if args.local_path:
-    for filename in local_files(args.local_path):
-        print(f"processing local file: {filename}")
-        px.process_local_file(filename, flush=False)
-    px.flush()
-elif args.s3_config:
+def checkpoint_status(source):
+    """ Returns a list containing a single (skip, progress) tuple for the source,
+        or an empty list if it was completed by an earlier run. This allows use in
+        a for loop or generator expression.
+        """
+    if not checkpoint:
+        return [(0, None)]
+    events, complete = checkpoint.status(source)
+    if complete:
+        print(f"skipping {source}: completed by earlier run")
+        return []
+    if events:
+        print(f"resuming {source} after {events} events")
+    return [(events, checkpoint.progress_fn(source, events))]
+
+
+def create_indexes(px):
+    """ When the user specifies a date range, we create all of the monthly indexes
+        up front, so that batches don't need to check.
+        """
+    if args.explicit_dates:
+        px.es_helper.warm_index_cache(processor.index_names(*cloudtrail_date_range()))
+
+
+def s3_location():
     bucket = args.s3_config[0]
     prefix = args.s3_config[1] if len(args.s3_config) > 1 else ""
-    for key in s3_files(s3, bucket, prefix):
-        print(f"processing S3 file: s3://{bucket}/{key}")
-        px.process_from_s3(bucket, key, flush=False)
-    px.flush()
-else:
-    print("", file=sys.stderr)
-    arg_parser.print_help()
+    return bucket, prefix
+
+
+if __name__ == "__main__":
+    # the pipeline's worker processes may import this module, so only run when invoked
+    args = arg_parser.parse_args()
+    args.explicit_dates = args.date_range is not None
+    args.date_range = args.date_range or ("0000-01-01", "9999-12-31")
+    args.date_start = args.date_range[0].replace("-", "")
+    args.date_finish = args.date_range[1].replace("-", "")
+
+    if not (args.local_path or args.s3_config):
+        print("", file=sys.stderr)
+        arg_parser.print_help()
+    else:
+        checkpoint = Checkpoint(args.checkpoint, args.resume) if args.checkpoint else None
+        metrics = Metrics() if args.metrics is not None else None
+        s3 = S3Helper(metrics)
+        es_args = {}
+        es_args['metrics'] = metrics
+        es_args['s3_helper'] = s3
+        es_args['dead_letter'] = retry.create_dead_letter(args.dead_letter, s3)
+        if args.plain_http:
+            es_args['use_aws_auth'] = False
+            es_args['use_https'] = False
+        if args.workers:
+            es_args['max_inflight'] = args.inflight_bulk
+        if args.adaptive_batch:
+            min_size, max_size = [int(mb * 1024 * 1024) for mb in args.adaptive_batch]
+            es_args['batch_sizer'] = AdaptiveBatchSizer(DEFAULT_BATCH_SIZE, min_size, max_size)
+        if args.max_batch_age is not None:
+            es_args['max_batch_age'] = args.max_batch_age
+        if args.compression_level is not None:
+            es_args['compression_level'] = args.compression_level
+            es_args['limit_compressed'] = args.limit_compressed
+        if args.field_allow or args.field_deny or args.field_budget is not None:
+            es_args['field_policy'] = FieldPolicy(args.field_allow, args.field_deny, args.field_budget)
+        if args.dedup is not None:
+            es_args['dedup_filter'] = DedupFilter(int(args.dedup * 1024 * 1024), BLOOM if args.dedup_bloom else LRU, metrics)
+        if args.parquet:
+            # pyarrow is optional, so only import the sink when it's used
+            from cloudtrail_to_elasticsearch.parquet_sink import ParquetSink
+            es_args['parquet_sink'] = ParquetSink(args.parquet, s3, metrics=metrics)
+        px = processor.create(**es_args)
+        create_indexes(px)
+        if args.workers:
+            pipelined_upload(px, s3)
+        else:
+            serial_upload(px, s3)
+        print(f"statistics: {px.es_helper.statistics()}")
+        if px.field_policy:
+            print(f"field statistics: {px.field_policy.statistics()}")
+        if px.dedup_filter:
+            print(f"dedup statistics: {px.dedup_filter.statistics()}")
+        if px.parquet_sink:
+            print(f"parquet statistics: {px.parquet_sink.statistics()}")
+        if metrics:
+            print(summary_table(metrics.snapshot()))
+            if args.metrics:
+                write_prometheus(metrics.snapshot(), args.metrics)
+        if checkpoint:
+            checkpoint.close()
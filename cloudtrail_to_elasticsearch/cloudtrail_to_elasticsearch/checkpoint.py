@@ -0,0 +1,88 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Records the progress of a bulk upload, so that it can be resumed if it's
+    interrupted.
+    """
+
+
+import sqlite3
+import threading
+
+
+class Checkpoint:
+    """ A manifest of source files, stored in a local SQLite database. For each
+        file it holds the number of events that have been acknowledged by the
+        cluster, and whether all of its events have been acknowledged.
+
+        Events are always read from a file in the same order, so a partially
+        uploaded file can be resumed by skipping the acknowledged events.
+
+        Progress is recorded from whichever thread completes a _bulk request, so
+        all access to the database is serialized.
+    """
+
+    def __init__(self, path, resume=False):
+        """
+            path      The database file; created if it doesn't exist.
+            resume    If true, retains any existing progress. If false, existing
+                      progress is discarded.
+        """
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""create table if not exists progress (
+                                 source    text primary key,
+                                 events    integer not null,
+                                 complete  integer not null
+                             )""")
+        if not resume:
+            self.conn.execute("delete from progress")
+
+
+    def status(self, source):
+        """ Returns a tuple of (acknowledged event count, complete flag) for the
+            specified source; (0, False) if it hasn't been seen.
+            """
+        with self.lock:
+            row = self.conn.execute("select events, complete from progress where source = ?", (source,)).fetchone()
+        if row:
+            return row[0], bool(row[1])
+        return 0, False
+
+
+    def record(self, source, events, complete):
+        """ Records that the first N events of the source have been acknowledged.
+            """
+        with self.lock:
+            self.conn.execute("insert or replace into progress (source, events, complete) values (?, ?, ?)",
+                              (source, events, int(complete)))
+
+
+    def progress_fn(self, source, skip=0):
+        """ Returns a function suitable for ESHelper.add_events(), which records
+            progress for the specified source. Skip is the number of events that
+            were acknowledged before the current run.
+            """
+        def fn(count, complete):
+            self.record(source, skip + count, complete)
+        return fn
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
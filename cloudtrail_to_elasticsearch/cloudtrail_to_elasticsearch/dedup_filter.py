@@ -0,0 +1,182 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Drops events whose eventID has already been seen in the same index, so that
+    duplicate deliveries don't each cost an index operation.
+    """
+
+
+import collections
+import hashlib
+import math
+
+from cloudtrail_to_elasticsearch.metrics import NULL_METRICS
+
+
+LRU = "lru"
+BLOOM = "bloom"
+
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024
+
+# approximate size of an LRU entry: the key string plus the OrderedDict's overhead
+LRU_ENTRY_BYTES = 200
+
+# the false-positive rate for each generation of a bloom filter; a false positive
+# drops an event that isn't a duplicate
+BLOOM_ERROR_RATE = 0.0001
+
+
+class DedupFilter:
+    """ Remembers recent (index, eventID) pairs, and removes events that match one.
+        This is an optimization, not a guarantee: the filter is bounded, so it only
+        catches duplicates that arrive while their first copy is remembered, and
+        Elasticsearch still overwrites any that get through (the eventID is the
+        document ID).
+
+        Two implementations are available. An LRU remembers a fixed number of recent
+        IDs, and never drops an event that isn't a duplicate. A bloom filter remembers
+        many more IDs in the same memory, at the cost of occasionally (see
+        BLOOM_ERROR_RATE) dropping an event that it hasn't seen.
+
+        This is called from the thread that adds events to a batch; it does not do
+        its own locking.
+    """
+
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY, kind=LRU, metrics=None):
+        """
+            max_memory  The approximate number of bytes used to remember IDs, shared
+                        by all indexes.
+            kind        LRU or BLOOM.
+            metrics     If provided, a metrics.Metrics instance.
+        """
+        if kind == LRU:
+            self.seen = LRUSet(max(1, max_memory // LRU_ENTRY_BYTES))
+        elif kind == BLOOM:
+            self.seen = GenerationalBloomFilter(max_memory)
+        else:
+            raise ValueError(f"unknown dedup filter: {kind}")
+        self.metrics = metrics or NULL_METRICS
+        self.duplicates = {}
+
+
+    def apply(self, events, index):
+        """ A generator that passes on events that haven't been seen in the index.
+            Events without an eventID are always passed.
+            """
+        check = self.seen.check_and_add
+        dropped = 0
+        try:
+            for event in events:
+                event_id = event.get('eventID')
+                if event_id and check(f"{index}/{event_id}"):
+                    dropped += 1
+                    continue
+                yield event
+        finally:
+            if dropped:
+                self.duplicates[index] = self.duplicates.get(index, 0) + dropped
+                self.metrics.increment('duplicates_dropped', dropped)
+
+
+    def statistics(self):
+        """ Returns a dict with the number of duplicates dropped per index, and the
+            number of IDs currently remembered.
+            """
+        return {
+            'duplicates': dict(self.duplicates),
+            'remembered': len(self.seen)
+        }
+
+
+class LRUSet:
+    """ A set of strings limited to the most recently used max_entries.
+        """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def check_and_add(self, key):
+        """ Returns True if the key was present; otherwise adds it and returns False.
+            """
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+            return True
+        entries[key] = None
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return False
+
+
+class GenerationalBloomFilter:
+    """ Two bloom filters that split the available memory. Keys are added to the
+        current generation, and checked against both; once the current generation
+        holds as many keys as it was sized for, it replaces the previous one. This
+        keeps the false-positive rate bounded no matter how many keys are added,
+        while remembering at least one generation's worth of recent keys.
+        """
+
+    def __init__(self, max_memory, error_rate=BLOOM_ERROR_RATE):
+        self.num_bits = max(64, (max_memory // 2) * 8)
+        bits_per_key = -math.log(error_rate) / (math.log(2) ** 2)
+        self.capacity = max(1, int(self.num_bits / bits_per_key))
+        self.num_hashes = max(1, round(bits_per_key * math.log(2)))
+        self.current = bytearray(self.num_bits // 8)
+        self.previous = None
+        self.count = 0
+        self.retired = 0
+
+
+    def __len__(self):
+        return self.count + self.retired
+
+
+    def check_and_add(self, key):
+        """ Returns True if the key was (probably) present; otherwise adds it and
+            returns False.
+            """
+        positions = self.positions(key)
+        current = self.current
+        if all(current[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+            return True
+        previous = self.previous
+        if previous is not None and all(previous[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+            return True
+        if self.count >= self.capacity:
+            self.previous = current
+            self.retired = self.count
+            current = self.current = bytearray(self.num_bits // 8)
+            self.count = 0
+        for pos in positions:
+            current[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        return False
+
+
+    def positions(self, key):
+        """ Returns the bit positions for a key, using double hashing of a single
+            128-bit digest.
+            """
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
@@ -15,25 +15,36 @@
 ################################################################################
 
 
+import collections
+import concurrent.futures
+import functools
 import json
 import requests
+import requests.adapters
 import os
+import threading
 import time
 
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 
+from cloudtrail_to_elasticsearch.bulk_body import BulkBody
+from cloudtrail_to_elasticsearch.metrics import NULL_METRICS
+from cloudtrail_to_elasticsearch.retry import RetryPolicy, RETRYABLE_REQUEST_STATUSES, RETRYABLE_ITEM_STATUSES
+
 DEFAULT_BATCH_SIZE = 2048 * 1024
+DEFAULT_POOL_SIZE = 4
 
 
 class ESHelper:
 
-    """ An instance of this class aggregates events into batche updates to a single
-        index, ensuring that the index exists.
+    """ An instance of this class aggregates events into batched updates, ensuring
+        that their indexes exist.
 
         To use, call add_events() as many times as needed, followed by flush(). The
         former will accumulate events into a batch, automatically calling flush if
-        the the configured batch size is exceeded or the caller starts writing to a
-        new index.
+        the the configured batch size is exceeded, or if the batch is older than an
+        optional maximum age. Each event in the batch names its own index, so one
+        batch can hold events for several indexes.
 
         By default, instances are configured to access an AWS managed Elasticsearch
         cluster, retrieving the hostname and AWS credentials from the environment.
@@ -41,9 +52,48 @@ class ESHelper:
         For testing, you can construct an instance with explicit hostname, optional
         AWS authorization credentials, and an HTTP endpoint. You can also create a
         mock instance.
+
+        Normally, flush() blocks until the batch has been written. For bulk uploads
+        you can configure a number of concurrent requests, in which case flush()
+        hands the batch to a background thread and only blocks if that many requests
+        are already in progress. Calling flush() with wait=True (the default) blocks
+        until all outstanding requests have completed.
+
+        All requests go through a single HTTP session, so connections (and their TLS
+        handshakes) are reused between requests.
+
+        Indexes that are known to exist are cached, so that we don't need to check
+        before every batch. An entry is removed if a _bulk request reports that its
+        index doesn't exist, and optionally expires after a configured time.
+
+        Throttled or unavailable requests are retried with exponential backoff, up to
+        a limit. If a _bulk request succeeds but some of its records are throttled,
+        only those records are retried. Records that fail permanently (or exhaust their
+        retries) are written to an optional dead-letter destination, as are all of the
+        records in a failed background request.
+
+        Batch size may be fixed, or adjusted according to the cluster's response times
+        and errors (see batch_sizer.AdaptiveBatchSizer). In either case, a batch that's
+        rejected as too large is split in half and retried.
+
+        _bulk requests may optionally be gzipped, in which case the batch size limit
+        can apply to either the compressed or uncompressed size.
+
+        Callers can track which events have been written by passing a progress
+        function to add_events(). Batches are numbered, and a progress function is
+        only called once its batch and all earlier batches have been written, so
+        it's safe to treat everything added before it as acknowledged. If one of
+        its batches fails in the background, and can't be dead-lettered, the
+        function is never called.
+
+        If given enabled Metrics, records the time spent serializing events, and the
+        time, size, and outcome of each _bulk request.
     """
 
-    def __init__(self, hostname=None, use_aws_auth=True, use_https=True, index_config=None, batch_size=DEFAULT_BATCH_SIZE):
+    def __init__(self, hostname=None, use_aws_auth=True, use_https=True, index_config=None, batch_size=DEFAULT_BATCH_SIZE, max_inflight=0,
+                 pool_size=DEFAULT_POOL_SIZE, keep_alive=True, index_cache_ttl=None,
+                 retry_policy=None, dead_letter=None, batch_docs=None, batch_sizer=None,
+                 compression_level=None, limit_compressed=False, max_batch_age=None, metrics=None):
         """
             hostname      If provided, the hostname of the Elasticsearch cluster. If not
                           provided, this is read from the environment variable ES_HOSTNAME.
@@ -54,6 +104,20 @@ class ESHelper:
             batch_size    if provided, defines a trigger for writing batches to Elasticsearch.
                           AWS Opensearch has been observed to reject requests > 1 MB, even
                           though the Elasticsearch docs say that it will accept up to 100 MB.
+            max_inflight  If non-zero, the number of _bulk requests that may be executing
+                          concurrently. If zero, requests are made on the calling thread.
+            pool_size     The maximum number of idle connections retained for reuse. This
+                          is increased if necessary to support max_inflight requests.
+            keep_alive    If false, connections are closed after every request. This is
+                          primarily useful for comparing performance.
+            compression_level
+                          If provided, _bulk requests are gzipped at this level (1-9).
+            limit_compressed
+                          If true, batch_size applies to the compressed size of a request
+                          rather than the uncompressed size.
+            max_batch_age If provided, the number of seconds after which a batch is written
+                          regardless of its size. This is checked as events are added.
+            metrics       If provided, a metrics.Metrics instance that records timings.
         """
         if hostname:
             self.hostname = hostname
@@ -76,59 +140,363 @@ class ESHelper:
         else:
             self.protocol = "http"
         self.index_config = index_config
-        self.max_batch_size = batch_size
-        self.current_index = None
-        self.current_batch = []
-        self.current_batch_size = 0
+        self.batch_sizer = batch_sizer
+        if batch_sizer:
+            self.max_batch_size = batch_sizer.batch_size
+            self.max_batch_docs = batch_sizer.max_docs
+        else:
+            self.max_batch_size = batch_size
+            self.max_batch_docs = batch_docs
+        self.compression_level = compression_level
+        self.limit_compressed = limit_compressed and compression_level is not None
+        self.max_batch_age = max_batch_age
+        self.current_batch = BulkBody(compression_level)
+        self.batch_started = None
+        if max_inflight:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight)
+            self.inflight = threading.BoundedSemaphore(max_inflight)
+        else:
+            self.executor = None
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, max_inflight))
+        self.session = requests.Session()
+        self.session.mount(self.protocol + "://", self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.index_cache_ttl = index_cache_ttl
+        self.known_indexes = {}
+        self.lock = threading.Lock()
+        self.outstanding = set()
+        self.failed_event_count = 0
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letter = dead_letter
+        self.retry_stats = {
+            'retried_requests': 0,
+            'retried_records': 0,
+            'backoff_seconds': 0.0,
+            'failed_records': 0,
+            'dead_lettered_records': 0
+        }
+        self.batch_sequence = 0
+        self.written_sequence = -1
+        self.written_out_of_order = set()
+        self.progress_callbacks = collections.deque()
+        self.failed_sequences = set()
+        self.progress_lock = threading.Lock()
+        self.metrics = metrics or NULL_METRICS
+
 
+    def add_events(self, events, index, progress=None):
+        """ Adds events for the specified index to the batch, first ensuring that
+            the index exists. If this causes the batch to exceed batch-size, or its
+            maximum age, it will invoke flush().
 
-    def add_events(self, events, index):
-        """ Adds events to the batch for the specified index. If this causes the
-            batch to exceed batch-size, or is for a different index than previous
-            calls, it will invoke flush().
+            If provided, progress is a function that's called with the number of
+            events from this call that have been written, and a flag that's True
+            once all of them have been. It's called whenever a batch containing
+            these events is written, possibly from a background thread.
         """
-        if self.current_index != index:
-            self.flush()  # this is a no-op first time through
-            self.current_index = index
+        # done on the calling thread, so that concurrent requests don't race to create
+        self.ensure_index_exists(index)
+        timed = self.metrics.enabled
+        serialize_time = 0.0
+        count = 0
+        first = self.batch_sequence
         for event in events:
-            prepared = self.prepare_event(event, self.current_index)
-            self.current_batch.append(prepared)
-            self.current_batch_size += len(prepared)
-            if self.current_batch_size > self.max_batch_size:
-                self.flush()
-
-
-    def prepare_event(self, event, index):
-        return "\n".join([
-            json.dumps({ "index": { "_index": index, "_id": event['eventID'] }}),
-            json.dumps(event)
-            ]) + "\n"
+            if not len(self.current_batch):
+                self.batch_started = time.monotonic()
+            if timed:
+                start = time.perf_counter()
+                self.current_batch.add(index, event)
+                serialize_time += time.perf_counter() - start
+            else:
+                self.current_batch.add(index, event)
+            count += 1
+            if self.request_size(self.current_batch) > self.max_batch_size \
+                    or (self.max_batch_docs and len(self.current_batch) >= self.max_batch_docs) \
+                    or (self.max_batch_age is not None and time.monotonic() - self.batch_started >= self.max_batch_age):
+                self.flush(wait=False)
+                if progress:
+                    self.on_written(functools.partial(progress, count, False), first)
+        if progress:
+            self.on_written(functools.partial(progress, count, True), first)
+        if timed:
+            self.metrics.observe('serialize_seconds', serialize_time)
 
 
-    def flush(self):
+    def flush(self, wait=True):
         """ Writes all events in the current batch to Elasticsearch, then clears
-            the batch.
+            the batch. If configured for concurrent requests, the write happens on
+            a background thread; if wait is True, this method will block until all
+            outstanding requests have completed.
             """
         # no-op to simplify calling code
-        if not self.current_index or not self.current_batch:
+        if self.current_batch:
+            if self.executor:
+                batch = self.current_batch
+                sequence = self.batch_sequence
+                self.current_batch = BulkBody(self.compression_level)
+                self.batch_sequence += 1
+                self.inflight.acquire()
+                future = self.executor.submit(self.background_upload, sequence, batch)
+                with self.lock:
+                    self.outstanding.add(future)
+                future.add_done_callback(self.upload_complete)
+            elif self.upload_and_acknowledge(self.batch_sequence, self.current_batch):
+                self.current_batch = BulkBody(self.compression_level)
+                self.batch_sequence += 1
+        if wait:
+            with self.lock:
+                outstanding = list(self.outstanding)
+            concurrent.futures.wait(outstanding)
+
+
+    def upload_and_acknowledge(self, sequence, batch):
+        """ Uploads a batch, and if successful, marks its sequence number as written.
+            """
+        result = self.upload_batch(batch)
+        if result:
+            self.batch_written(sequence)
+        return result
+
+
+    def on_written(self, fn, first=None):
+        """ Arranges for the passed function to be called once all events added so
+            far have been written. If they already have, it's called immediately.
+            If provided, first is the sequence number of the earliest batch that the
+            caller's events were added to; the function isn't called if that batch,
+            or any later one, has failed (see batch_failed()).
+            """
+        # if the current batch is empty, everything is in earlier batches
+        sequence = self.batch_sequence if len(self.current_batch) else self.batch_sequence - 1
+        with self.lock:
+            self.progress_callbacks.append((sequence, sequence if first is None else first, fn))
+        self.batch_written(None)
+
+
+    def batch_written(self, sequence):
+        """ Records that a batch has been written, and calls any progress functions
+            that are waiting on it or earlier batches. These are called in the order
+            that they were registered, even if batches complete out of order.
+            """
+        with self.progress_lock:
+            ready = []
+            with self.lock:
+                if sequence is not None:
+                    self.written_out_of_order.add(sequence)
+                while self.written_sequence + 1 in self.written_out_of_order:
+                    self.written_sequence += 1
+                    self.written_out_of_order.discard(self.written_sequence)
+                while self.progress_callbacks and self.progress_callbacks[0][0] <= self.written_sequence:
+                    sequence, first, fn = self.progress_callbacks.popleft()
+                    if not any(first <= failed <= sequence for failed in self.failed_sequences):
+                        ready.append(fn)
+            for fn in ready:
+                fn()
+
+
+    def batch_failed(self, sequence):
+        """ Records that a batch won't be written, but lets later batches advance the
+            watermark past it. Progress functions for calls that added events to it
+            are dropped rather than called.
+            """
+        with self.lock:
+            self.failed_sequences.add(sequence)
+        self.batch_written(sequence)
+
+
+    def discard(self):
+        """ Drops any events in the current batch, which will be there if a flush
+            failed, treating the batch as failed. Returns the number of events that
+            were dropped. This is intended for a long-lived instance that has just
+            flushed, with no background requests outstanding, so that it doesn't
+            resubmit the events with the next caller's batch.
+            """
+        count = len(self.current_batch)
+        if count:
+            sequence = self.batch_sequence
+            self.current_batch = BulkBody(self.compression_level)
+            self.batch_sequence += 1
+            self.batch_failed(sequence)
+        return count
+
+
+    def upload_batch(self, batch):
+        """ Writes a batch of events, returning True if the request succeeded (even
+            if individual records were rejected), False if it failed and the events
+            should be retained.
+            """
+        print(f'writing {len(batch)} events to index {", ".join(batch.indexes())}')
+        attempt = 0
+        while len(batch):
+            if self.compression_level is not None:
+                with self.metrics.timer('compress_seconds'):
+                    body = batch.gzip()
+                start = time.monotonic()
+                rsp = self.do_request("POST", "_bulk", body, 'application/x-ndjson', 'gzip')
+            else:
+                start = time.monotonic()
+                with batch.view() as body:
+                    rsp = self.do_request("POST", "_bulk", body, 'application/x-ndjson')
+            elapsed = time.monotonic() - start
+            self.record_metrics(batch, rsp.status_code, elapsed)
+            if rsp.status_code == 200:
+                result = json.loads(rsp.text)
+                retryable = self.process_bulk_response(batch, result)
+                self.record_request(rsp.status_code, self.request_size(batch), elapsed, result.get('took'), bool(retryable))
+                if not retryable:
+                    return True
+                batch = batch.subset(retryable)
+                retry_type = 'retried_records'
+                retry_count = len(batch)
+            elif rsp.status_code == 413:
+                self.record_request(rsp.status_code, self.request_size(batch), elapsed)
+                if len(batch) == 1:
+                    self.record_failures([(batch.item(0), 413, "record too large")])
+                    return True
+                print(f'request too large ({self.request_size(batch)} bytes); splitting batch')
+                first, second = batch.split()
+                return self.upload_batch(first) and self.upload_batch(second)
+            elif rsp.status_code in RETRYABLE_REQUEST_STATUSES:
+                self.record_request(rsp.status_code, self.request_size(batch), elapsed)
+                print(f'upload throttled (status {rsp.status_code}); retrying')
+                retry_type = 'retried_requests'
+                retry_count = 1
+            else:
+                # log the error, leave the events in queue for future attempt
+                print(f'upload failed: status {rsp.status_code}, description = {rsp.text}')
+                return False
+            attempt += 1
+            if attempt >= self.retry_policy.max_attempts:
+                if retry_type == 'retried_requests':
+                    print(f'upload failed: retries exhausted')
+                    return False
+                self.record_failures([(batch.item(idx), 429, "retries exhausted") for idx in range(len(batch))])
+                return True
+            delay = self.retry_policy.delay(attempt)
+            with self.lock:
+                self.retry_stats[retry_type] += retry_count
+                self.retry_stats['backoff_seconds'] += delay
+            time.sleep(delay)
+        return True
+
+
+    def request_size(self, batch):
+        """ Returns the size of a batch as measured against the batch size limit.
+            """
+        return batch.compressed_size if self.limit_compressed else batch.size
+
+
+    def record_metrics(self, batch, status, elapsed):
+        """ Records the size, duration, and outcome of a _bulk request.
+            """
+        if not self.metrics.enabled:
             return
-        self.ensure_index_exists(self.current_index)
-        print(f'writing {len(self.current_batch)} events to index {self.current_index}')
-        rsp = self.do_request(requests.post, "_bulk", "".join(self.current_batch), 'application/x-ndjson')
-        if rsp.status_code == 200:
-            # individual records may be rejected -- we'll assume them damaged and drop
-            self.log_record_errors(rsp)
-            self.current_batch = []
-            self.current_batch_size = 0
-        elif rsp.status_code == 429:
-            print(f'upload throttled; retrying')
-            # give the server a chance to do whatever it needs to do
-            time.sleep(1.0)
-            # we'll hope that it succeeds before we blow stack
-            self.flush()
-        else:
-            # log the error, leave the events in queue for future attempt
-            print(f'upload failed: status {rsp.status_code}, description = {rsp.text}')
+        self.metrics.observe('bulk_request_seconds', elapsed)
+        self.metrics.observe('batch_documents', len(batch))
+        self.metrics.observe('batch_bytes', batch.compressed_size if self.compression_level is not None else batch.size)
+        self.metrics.increment('bulk_requests')
+        self.metrics.increment(f'bulk_status_{status}')
+        if status == 200:
+            self.metrics.increment('documents_sent', len(batch))
+
+
+    def record_request(self, status, request_size, elapsed, took=None, throttled=False):
+        """ Passes the result of a _bulk request to the batch sizer (if any), and
+            updates the batch limits from it.
+            """
+        if not self.batch_sizer:
+            return
+        with self.lock:
+            self.batch_sizer.record(status, request_size, elapsed, took, throttled)
+            self.max_batch_size = self.batch_sizer.batch_size
+            self.max_batch_docs = self.batch_sizer.max_docs
+
+
+    def process_bulk_response(self, batch, result):
+        """ Examines the per-record results of a _bulk request, returning the positions
+            of records that should be retried. Records that failed for other reasons are
+            logged and passed to the dead-letter destination.
+            """
+        if not result.get('errors'):
+            print("no errors")
+            return []
+        retryable = []
+        failed = []
+        for idx, item in enumerate(result.get('items', [])[:len(batch)]):
+            item = next(iter(item.values()), {})
+            status = item.get('status', 500)
+            if status < 300:
+                continue
+            elif status in RETRYABLE_ITEM_STATUSES:
+                retryable.append(idx)
+            else:
+                failed.append((batch.item(idx), status, item.get('error')))
+                if item.get('error', {}).get('type') == 'index_not_found_exception':
+                    self.forget_index(item.get('_index'))
+        if failed:
+            self.record_failures(failed)
+        return retryable
+
+
+    def record_failures(self, failed):
+        """ Logs records that could not be written, and passes them to the dead-letter
+            destination if one is configured. Each element of the passed list is a
+            tuple of (serialized item, status code, error).
+            """
+        ids = []
+        failures = []
+        for prepared, status, error in failed:
+            action, document = prepared.split(b"\n", 1)
+            action = json.loads(action)['index']
+            ids.append(action['_id'])
+            failures.append({'index': action['_index'], 'id': action['_id'], 'status': status, 'error': error, 'event': json.loads(document)})
+        print(f'upload failed for {len(ids)} records: {ids[:5]}')
+        with self.lock:
+            self.retry_stats['failed_records'] += len(failures)
+        if self.dead_letter:
+            self.dead_letter.write(failures)
+            with self.lock:
+                self.retry_stats['dead_lettered_records'] += len(failures)
+
+
+    def background_upload(self, sequence, batch):
+        """ Uploads a batch on a background thread. A failed upload can't be returned
+            to the current batch (which has moved on), so its events are counted as
+            lost and passed to the dead-letter destination. If the batch was partially
+            written before failing, this may include some events that were written.
+
+            Once its events are in the dead-letter destination, a failed batch counts
+            as written for progress, as do rejected records. Without one, progress
+            functions waiting on it are dropped (see batch_failed()).
+            """
+        try:
+            if self.upload_and_acknowledge(sequence, batch):
+                return
+            error = "upload failed"
+        except Exception as ex:
+            print(f'background upload failed: {ex}')
+            error = str(ex)
+        with self.lock:
+            self.failed_event_count += len(batch)
+        dead_lettered = False
+        try:
+            self.record_failures([(batch.item(idx), None, error) for idx in range(len(batch))])
+            dead_lettered = self.dead_letter is not None
+        finally:
+            if dead_lettered:
+                self.batch_written(sequence)
+            else:
+                self.batch_failed(sequence)
+
+
+    def upload_complete(self, future):
+        """ Callback for background uploads.
+            """
+        with self.lock:
+            self.outstanding.discard(future)
+            if future.exception():
+                print(f'background upload failed: {future.exception()}')
+        self.inflight.release()
 
 
     def ensure_index_exists(self, index):
@@ -136,41 +504,123 @@ class ESHelper:
             exists, and to create it if not. This allows us to configure the index
             appropriately for CloudTrail events.
         """
-        rsp = self.do_request(requests.get, index)
-        if rsp.status_code == 200:
+        if self.is_known_index(index):
             return
+        rsp = self.do_request("GET", index)
+        if rsp.status_code == 200:
+            self.remember_index(index)
         elif rsp.status_code == 404:
-            if self.index_config:    
-                print(f"creating index: {index}")
-                rsp = self.do_request(requests.put, index, self.index_config)
-                if rsp.status_code != 200:
-                    raise Exception(f'failed to create index: {rsp.text}')
-            else:
-              pass  # first PUT will create index
+            self.create_index(index)
         else:
             print(f'failed to retrieve index status: {rsp.text}')
 
 
-    def do_request(self, fn, path, body=None, content_type='application/json'):
+    def warm_index_cache(self, indexes):
+        """ Ensures that all of the specified indexes exist, creating any that don't.
+            This makes a single request to find the existing indexes, so is cheaper
+            than calling ensure_index_exists() for each.
+        """
+        indexes = [index for index in indexes if not self.is_known_index(index)]
+        if not indexes:
+            return
+        path = ",".join(indexes) + "?ignore_unavailable=true&allow_no_indices=true&filter_path=*.settings.index.uuid"
+        rsp = self.do_request("GET", path)
+        if rsp.status_code != 200:
+            print(f'failed to retrieve index status: {rsp.text}')
+            return
+        existing = json.loads(rsp.text) if rsp.text else {}
+        for index in indexes:
+            if index in existing:
+                self.remember_index(index)
+            else:
+                self.create_index(index)
+
+
+    def create_index(self, index):
+        if self.index_config:
+            print(f"creating index: {index}")
+            rsp = self.do_request("PUT", index, self.index_config)
+            if rsp.status_code != 200:
+                raise Exception(f'failed to create index: {rsp.text}')
+        else:
+            pass  # first PUT will create index
+        self.remember_index(index)
+
+
+    def mapped_fields(self, index, pattern="*_flattened.*"):
+        """ Returns the names of fields in the index's mapping that match the
+            provided pattern; empty if the index doesn't exist.
+            """
+        rsp = self.do_request("GET", f"{index}/_mapping/field/{pattern}")
+        if rsp.status_code != 200:
+            if rsp.status_code != 404:
+                print(f'failed to retrieve mapping for {index}: {rsp.text}')
+            return []
+        result = json.loads(rsp.text) if rsp.text else {}
+        return [field for mapping in result.values() for field in mapping.get('mappings', {}).keys()]
+
+
+    def is_known_index(self, index):
+        timestamp = self.known_indexes.get(index)
+        if timestamp is None:
+            return False
+        if self.index_cache_ttl is not None and time.monotonic() - timestamp > self.index_cache_ttl:
+            self.known_indexes.pop(index, None)
+            return False
+        return True
+
+
+    def remember_index(self, index):
+        self.known_indexes[index] = time.monotonic()
+
+
+    def forget_index(self, index):
+        self.known_indexes.pop(index, None)
+
+
+    def do_request(self, method, path, body=None, content_type='application/json', content_encoding=None):
+        """ Makes a request to the cluster. If the body has been compressed, the caller
+            must identify the encoding; the request is signed over the compressed body.
+            """
         url = self.protocol + "://" + self.hostname + "/" + path
         kwargs = {}
         if body:
             kwargs['data'] = body
             kwargs['headers'] = {'Content-Type': content_type}
+            if content_encoding:
+                kwargs['headers']['Content-Encoding'] = content_encoding
         if self.auth:
             kwargs['auth'] = self.auth
-        rsp = fn(url, **kwargs)
+        rsp = self.session.request(method, url, **kwargs)
         return rsp
 
 
-    def log_record_errors(self, rsp):
-        result = json.loads(rsp.text)
-        if not result.get('errors'):
-            print("no errors")
-            return
-        failed_records = set()
-        for item in result.get('items', []):
-            item = item.get('index', {})
-            if item.get('status', 500) > 299:
-                failed_records.add(item.get('_id'))
-        print(f'upload failed for {len(failed_records)} records: {list(failed_records)[:5]}')
+    def statistics(self):
+        """ Returns a dict combining connection, retry, and batch size statistics.
+            """
+        with self.lock:
+            result = dict(self.retry_stats)
+            result['batch_size'] = self.max_batch_size
+            result['batch_docs'] = self.max_batch_docs
+        result.update(self.connection_stats())
+        return result
+
+
+    def connection_stats(self):
+        """ Returns a dict with the number of requests made, the number of connections
+            opened to make them, and the number of requests that reused an existing
+            connection.
+            """
+        requests_made = 0
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'requests': requests_made,
+            'new_connections': connections,
+            'reused_connections': requests_made - connections
+        }
@@ -0,0 +1,256 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Incremental parsing for CloudTrail files, which consist of a single JSON
+    object with a "Records" array.
+    """
+
+
+import codecs
+import functools
+import gzip
+import json
+
+from json.decoder import WHITESPACE
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# the average record length (in characters) above which with_raw() retains source
+# text; below it, scanning member-by-member costs more than re-serializing
+RAW_MIN_RECORD_SIZE = 2048
+
+# the number of records that with_raw() averages over
+RAW_WINDOW = 8
+
+WHITESPACE_CHARS = ' \t\n\r'
+
+
+def open_stream(stream):
+    """ Wraps a binary stream in a decompressor if it contains GZipped data. The
+        stream must support peek(), as do files opened in binary mode; S3 bodies
+        should be explicitly wrapped in a GzipFile.
+        """
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    return stream
+
+
+def scan_record_with_raw(scan_once, keys, buf, pos):
+    """ Parses the JSON object starting at pos one member at a time, retaining the
+        source text for members whose key is in the provided set. Returns a tuple
+        of ((record, raw), end).
+
+        This follows the contract of the JSON decoder's scan_once(): it assumes that
+        pos isn't whitespace, and raises StopIteration or IndexError if the object
+        isn't complete. It's written for speed, since it's called for every record.
+        """
+    match_whitespace = WHITESPACE.match
+    record = {}
+    raw = {}
+    if buf[pos] != '{':
+        raise StopIteration(pos)
+    pos += 1
+    if buf[pos] in WHITESPACE_CHARS:
+        pos = match_whitespace(buf, pos).end()
+    if buf[pos] == '}':
+        return (record, raw), pos + 1
+    while True:
+        key, pos = scan_once(buf, pos)
+        if buf[pos] in WHITESPACE_CHARS:
+            pos = match_whitespace(buf, pos).end()
+        if buf[pos] != ':':
+            raise StopIteration(pos)
+        pos += 1
+        if buf[pos] in WHITESPACE_CHARS:
+            pos = match_whitespace(buf, pos).end()
+        start = pos
+        record[key], pos = scan_once(buf, pos)
+        if key in keys:
+            raw[key] = buf[start:pos]
+        if buf[pos] in WHITESPACE_CHARS:
+            pos = match_whitespace(buf, pos).end()
+        c = buf[pos]
+        pos += 1
+        if c == '}':
+            return (record, raw), pos
+        if c != ',':
+            raise StopIteration(pos)
+        if buf[pos] in WHITESPACE_CHARS:
+            pos = match_whitespace(buf, pos).end()
+
+
+class EventReader:
+    """ Iterates the elements of a CloudTrail file's "Records" array, reading
+        the underlying stream one chunk at a time. This means that memory use is
+        bounded by the chunk size plus the size of the largest record, rather than
+        by the size of the file.
+
+        Keys other than "Records" are parsed and discarded. Malformed JSON raises
+        json.JSONDecodeError, although only once the reader gets to it.
+
+        Iterating the reader produces parsed records. Alternatively, with_raw() also
+        produces the source text for selected fields of large records, which saves
+        the cost of serializing them again.
+        """
+
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+            stream      A binary stream containing uncompressed UTF-8 JSON.
+            chunk_size  The number of bytes to read from the stream at one time.
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+
+    def __iter__(self):
+        return self.read_records(functools.partial(self.array, self.decoder.scan_once))
+
+
+    def with_raw(self, keys, min_size=RAW_MIN_RECORD_SIZE):
+        """ Returns a generator that yields (record, raw) tuples, where raw is a dict
+            containing the source JSON text for any of the specified top-level keys
+            that are present in the record, or None.
+
+            Retaining source text means scanning each record member-by-member in
+            Python, which is only faster than the JSON decoder (followed by the caller
+            serializing those keys) for large records. So it's only done while the
+            average length of recent records is at least min_size.
+            """
+        return self.read_records(functools.partial(self.array_with_raw, frozenset(keys), min_size))
+
+
+    def read_records(self, array_fn):
+        """ A generator that walks the top-level object, calling the provided function
+            to produce the elements of its "Records" array.
+            """
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == 'Records':
+                yield from array_fn()
+            else:
+                self.value()
+            if self.expect('}', ',') == '}':
+                return
+
+
+    def array(self, scan_fn):
+        """ A generator that yields the elements of the array at the current position.
+            """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value(scan_fn)
+            if self.expect(']', ',') == ']':
+                return
+
+
+    def array_with_raw(self, keys, min_size):
+        """ As array(), but yields (record, raw) tuples; see with_raw(). The choice of
+            scanner is revisited every RAW_WINDOW records, based on their average
+            length. This is called for every record, so it does as little as possible
+            per record.
+            """
+        scan_once = self.decoder.scan_once
+        scan_raw = functools.partial(scan_record_with_raw, scan_once, keys)
+        use_raw = min_size <= 0
+        count = 0
+        mark = self.offset + self.pos
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            if use_raw:
+                result = self.value(scan_raw)
+            else:
+                result = (self.value(scan_once), None)
+            count += 1
+            if count == RAW_WINDOW:
+                position = self.offset + self.pos
+                use_raw = position - mark >= min_size * RAW_WINDOW
+                mark = position
+                count = 0
+            yield result
+            if self.expect(']', ',') == ']':
+                return
+
+
+    def value(self, scan_fn=None):
+        """ Parses and returns the JSON value at the current position, using the
+            provided scanning function (by default, the JSON decoder's). If that value
+            isn't entirely in the buffer, reads more data and tries again. A value that
+            ends at the end of the buffer might be a truncated number, so it's also
+            re-parsed unless we're at the end of the stream.
+            """
+        scan_fn = scan_fn or self.decoder.scan_once
+        self.peek()
+        while True:
+            try:
+                result, end = scan_fn(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return result
+            except (StopIteration, IndexError, json.JSONDecodeError):
+                if self.eof:
+                    raise json.JSONDecodeError("invalid or truncated value", self.buf, self.pos)
+            self.fill()
+
+
+    def expect(self, *allowed):
+        """ Consumes the next non-whitespace character, which must be one of those
+            provided, and returns it.
+            """
+        c = self.peek()
+        if c not in allowed:
+            raise json.JSONDecodeError(f"expected one of {allowed}", self.buf, self.pos)
+        self.pos += 1
+        return c
+
+
+    def peek(self):
+        """ Skips whitespace, and returns the next character without consuming it
+            (or an empty string at end of stream).
+            """
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self.fill()
+
+
+    def fill(self):
+        """ Reads the next chunk from the stream, discarding the consumed part of the
+            buffer.
+            """
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + self.text_decoder.decode(chunk, final=self.eof)
+        self.offset += self.pos
+        self.pos = 0
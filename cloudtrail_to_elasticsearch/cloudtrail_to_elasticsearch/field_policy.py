@@ -0,0 +1,129 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Limits the number of distinct fields that flattening adds to an index.
+    """
+
+
+import fnmatch
+import re
+
+
+ALLOW = "allow"
+FOLD = "fold"
+DENY = "deny"
+
+
+class FieldPolicy:
+    """ Decides which flattened fields (eg, "requestParameters_flattened.bucketName")
+        are indexed as separate fields. Fields that match a deny pattern are removed;
+        fields that don't match an allow pattern (if any are given), or that would
+        take an index over its budget of distinct flattened fields, are folded into
+        a catch-all field for their section (eg, "requestParameters_overflow"), as a
+        list of "key=value" strings. The "_raw" fields are not affected.
+
+        The fields that have been admitted to each index are remembered, so that the
+        budget applies to new fields only, and events only introduce new fields (and
+        thus mapping updates) while an index is under budget. If given a function to
+        retrieve an index's existing fields, that's called the first time the index
+        is seen, so that the budget is enforced across runs.
+
+        This is called from the thread that adds events to a batch; it does not do
+        its own locking.
+    """
+
+    def __init__(self, allow=None, deny=None, max_fields=None, load_fields=None):
+        """
+            allow         If provided, a list of glob patterns for flattened fields that
+                          may be indexed individually; all others are folded.
+            deny          If provided, a list of glob patterns for flattened fields that
+                          are removed entirely.
+            max_fields    If provided, the maximum number of distinct flattened fields
+                          in a single index.
+            load_fields   If provided, a function that takes an index name and returns
+                          the flattened fields already mapped in that index.
+        """
+        self.allow = compile_patterns(allow)
+        self.deny = compile_patterns(deny)
+        self.max_fields = max_fields
+        self.load_fields = load_fields
+        self.index_fields = {}
+        self.classifications = {}
+        self.folded_values = 0
+        self.denied_values = 0
+
+
+    def apply(self, event, index):
+        """ Applies the policy to a transformed event, modifying and returning it.
+            """
+        fields = self.index_fields.get(index)
+        if fields is None:
+            fields = self.index_fields[index] = set(self.load_fields(index)) if self.load_fields else set()
+        for name in [name for name in event if name.endswith("_flattened")]:
+            flattened = event[name]
+            section = name[:-len("_flattened")]
+            overflow = None
+            for key in list(flattened):
+                field = f"{name}.{key}"
+                classification = self.classifications.get(field)
+                if classification is None:
+                    classification = self.classifications[field] = self.classify(field)
+                if classification is DENY:
+                    self.denied_values += len(flattened.pop(key))
+                    continue
+                if classification is ALLOW and field in fields:
+                    continue
+                if classification is FOLD or (self.max_fields is not None and len(fields) >= self.max_fields):
+                    values = flattened.pop(key)
+                    self.folded_values += len(values)
+                    if overflow is None:
+                        overflow = event.setdefault(f"{section}_overflow", [])
+                    overflow.extend(f"{key}={value}" for value in values)
+                    continue
+                fields.add(field)
+            if not flattened:
+                del event[name]
+        return event
+
+
+    def classify(self, field):
+        """ Applies the allow and deny patterns to a field name.
+            """
+        if self.deny and self.deny.match(field):
+            return DENY
+        if self.allow and not self.allow.match(field):
+            return FOLD
+        return ALLOW
+
+
+    def statistics(self):
+        """ Returns a dict with the number of distinct flattened fields per index,
+            and the number of values that were folded or removed.
+            """
+        return {
+            'flattened_fields': {index: len(fields) for index, fields in self.index_fields.items()},
+            'folded_values': self.folded_values,
+            'denied_values': self.denied_values
+        }
+
+
+def compile_patterns(patterns):
+    """ Combines a list of glob patterns into a single regex, or returns None if
+        there aren't any.
+        """
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
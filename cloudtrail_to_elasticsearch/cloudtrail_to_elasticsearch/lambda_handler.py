@@ -16,20 +16,99 @@
 
 """ Lambda function to upload CloudTrail events to Elasticsearch. This module
     decomposes the event and calls the processor module to do all the work.
+
+    The Lambda may be invoked directly by S3 bucket notifications, or by an SQS
+    queue that receives those notifications (optionally via SNS). All of the files
+    in an invocation are downloaded concurrently and written in shared batches.
+    For SQS, the response identifies the messages whose files could not be
+    processed (this requires ReportBatchItemFailures on the event source mapping),
+    so that only those are retried. For direct invocations, failures are logged.
+
+    If the environment variable DEAD_LETTER_LOCATION is set (to a value of the form
+    s3://BUCKET/PREFIX), events that Elasticsearch rejects are written there.
+
+    The environment variables FIELD_ALLOW and FIELD_DENY (comma-separated glob
+    patterns) and FIELD_BUDGET (a number) configure a FieldPolicy, which limits
+    the number of flattened fields in each index.
+
+    If the environment variable METRICS_NAMESPACE is set, the Lambda records the
+    time spent in each stage of processing, and writes it to CloudWatch at the end
+    of each invocation, in Embedded Metric Format, under that namespace.
+
+    If the environment variable PARQUET_LOCATION is set (to a value of the form
+    s3://BUCKET/PREFIX), transformed events are also written there as Parquet
+    files, one per month per invocation. This requires a layer that provides
+    pyarrow.
     """
 
 
+import json
+import os
+import urllib.parse
+
 import cloudtrail_to_elasticsearch.processor
+import cloudtrail_to_elasticsearch.retry
 
-px = cloudtrail_to_elasticsearch.processor.create()
+from cloudtrail_to_elasticsearch.field_policy import FieldPolicy
+from cloudtrail_to_elasticsearch.metrics import Metrics, emit_emf
+from cloudtrail_to_elasticsearch.s3_helper import S3Helper
+
+FIELD_ALLOW = [p.strip() for p in os.environ.get('FIELD_ALLOW', '').split(',') if p.strip()]
+FIELD_DENY = [p.strip() for p in os.environ.get('FIELD_DENY', '').split(',') if p.strip()]
+FIELD_BUDGET = int(os.environ['FIELD_BUDGET']) if os.environ.get('FIELD_BUDGET') else None
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE')
+PARQUET_LOCATION = os.environ.get('PARQUET_LOCATION')
+
+metrics = Metrics() if METRICS_NAMESPACE else None
+s3_helper = S3Helper(metrics)
+dead_letter = cloudtrail_to_elasticsearch.retry.create_dead_letter(os.environ.get('DEAD_LETTER_LOCATION'), s3_helper)
+field_policy = FieldPolicy(FIELD_ALLOW, FIELD_DENY, FIELD_BUDGET) if (FIELD_ALLOW or FIELD_DENY or FIELD_BUDGET is not None) else None
+parquet_sink = None
+if PARQUET_LOCATION:
+    from cloudtrail_to_elasticsearch.parquet_sink import ParquetSink
+    parquet_sink = ParquetSink(PARQUET_LOCATION, s3_helper, metrics=metrics)
+px = cloudtrail_to_elasticsearch.processor.create(dead_letter=dead_letter, field_policy=field_policy, metrics=metrics,
+                                                  s3_helper=s3_helper, parquet_sink=parquet_sink)
 
 def handle(event, context):
+    files = list(extract_files(event))
+    locations = list(dict.fromkeys(location for _, location in files if location))
+    failed = set(px.process_files_from_s3(locations)) if locations else set()
+    if failed:
+        print(f"failed to process {len(failed)} of {len(locations)} files")
+    if metrics:
+        metrics.increment('failed_files', len(failed))
+        emit_emf(metrics.snapshot(), METRICS_NAMESPACE, {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'unknown')})
+        metrics.reset()
+    if any(item_id for item_id, _ in files):
+        failed_items = dict.fromkeys(item_id for item_id, location in files if location is None or location in failed)
+        return {'batchItemFailures': [{'itemIdentifier': item_id} for item_id in failed_items]}
+
+
+def extract_files(event):
+    """ A generator that produces (item_id, (bucket, key)) tuples for the files in
+        an invocation. The item ID is the SQS message ID, or None if the Lambda was
+        invoked directly by S3. A message that can't be parsed has a location of
+        None, so that it's reported as a failure.
+        """
     for record in event.get('Records', []):
-        eventName = record['eventName']
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        try:
-            print(f"processing s3://{bucket}/{key}")
-            px.process_from_s3(bucket, key)
-        except Exception as ex:
-            print(f"failed to process file: {ex}")
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                body = json.loads(record['body'])
+                if 'Message' in body:
+                    body = json.loads(body['Message'])
+                locations = [s3_location(s3_record) for s3_record in body.get('Records', [])]
+            except (ValueError, KeyError, TypeError) as ex:
+                print(f"unable to parse message {record['messageId']}: {ex}")
+                locations = [None]
+            for location in locations:
+                yield record['messageId'], location
+        elif 's3' in record:
+            yield None, s3_location(record)
+
+
+def s3_location(record):
+    """ Extracts the bucket and key from an S3 notification record; the key is
+        URL-encoded in the notification.
+        """
+    return record['s3']['bucket']['name'], urllib.parse.unquote_plus(record['s3']['object']['key'])
@@ -0,0 +1,354 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Optional instrumentation: latency histograms for each stage of processing
+    (download, read, parse, transform, serialize, compress, and _bulk request),
+    counters for bytes and events, and batch statistics.
+
+    Components are given a NullMetrics instance by default, which does nothing;
+    they check its "enabled" attribute before doing any timing, so the overhead
+    when disabled is a few attribute lookups per file.
+
+    Collected metrics can be written as a Prometheus text file, a summary table,
+    or a CloudWatch Embedded Metric Format record.
+    """
+
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# histograms whose names don't end with "_seconds" need their own buckets
+HISTOGRAM_BUCKETS = {
+    'batch_documents':  (10, 50, 100, 500, 1000, 2500, 5000, 10000, 25000),
+    'batch_bytes':      (64 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024, 25 * 1024 * 1024),
+}
+
+PROMETHEUS_PREFIX = "cloudtrail_loader_"
+
+
+class NullMetrics:
+    """ The default: records nothing.
+        """
+
+    enabled = False
+
+    def observe(self, name, value):
+        pass
+
+
+    def increment(self, name, amount=1):
+        pass
+
+
+    def timer(self, name):
+        return contextlib.nullcontext()
+
+
+    def snapshot(self):
+        return {'counters': {}, 'histograms': {}}
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics:
+    """ Thread-safe counters and histograms. Histograms whose names end with
+        "_seconds" are latencies; others must have buckets in HISTOGRAM_BUCKETS.
+        Each histogram also records the sum of the observations in each bucket (plus
+        one for those above the largest bucket), for EMF.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+
+    def observe(self, name, value):
+        """ Records a single observation for the named histogram.
+            """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+                histogram = self.histograms[name] = {'buckets': buckets, 'counts': [0] * len(buckets), 'count': 0, 'sum': 0,
+                                                     'sums': [0] * (len(buckets) + 1)}
+            for idx, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][idx] += 1
+                    break
+            else:
+                idx = len(histogram['buckets'])
+            histogram['sums'][idx] += value
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ A context manager that records the time spent in its body.
+            """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+
+    def snapshot(self):
+        """ Returns a copy of the current counters and histograms.
+            """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: dict(h, counts=list(h['counts']), sums=list(h['sums'])) for name, h in self.histograms.items()}
+            }
+
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+class FileTimer:
+    """ Measures the time spent reading, decompressing, parsing, and transforming a
+        single file. These steps are chained, each pulling from the one before, so
+        the time measured for each includes its predecessors; record() subtracts
+        them. Picklable, so that it can be returned from a worker process.
+
+        Reads of the source (for S3, the download) are only measured if the caller
+        wraps the source stream with raw(), before it's decompressed.
+    """
+
+    def __init__(self):
+        self.raw_read = 0.0
+        self.read = 0.0
+        self.parse = 0.0
+        self.transform = 0.0
+        self.bytes = 0
+        self.events = 0
+
+
+    def raw(self, stream):
+        """ Wraps a source (possibly compressed) binary stream so that its reads are
+            timed. The result supports peek(), for event_reader.open_stream().
+            """
+        return TimedStream(stream, self, raw=True)
+
+
+    def stream(self, stream):
+        """ Wraps a (decompressed) binary stream so that its reads are timed.
+            """
+        return TimedStream(stream, self)
+
+
+    def records(self, records):
+        """ A generator that times the iteration of parsed records.
+            """
+        it = iter(records)
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(it)
+            except StopIteration:
+                self.parse += time.perf_counter() - start
+                return
+            self.parse += time.perf_counter() - start
+            yield record
+
+
+    def transformed(self, events):
+        """ A generator that times the iteration of transformed events, and counts them.
+            """
+        it = iter(events)
+        while True:
+            start = time.perf_counter()
+            try:
+                event = next(it)
+            except StopIteration:
+                self.transform += time.perf_counter() - start
+                return
+            self.transform += time.perf_counter() - start
+            self.events += 1
+            yield event
+
+
+    def record(self, metrics):
+        """ Adds this file's timings and counts to the provided metrics.
+            """
+        metrics.observe('raw_read_seconds', self.raw_read)
+        metrics.observe('decompress_seconds', max(0.0, self.read - self.raw_read))
+        metrics.observe('parse_seconds', max(0.0, self.parse - self.read))
+        metrics.observe('transform_seconds', max(0.0, self.transform - self.parse))
+        metrics.increment('files')
+        metrics.increment('bytes_read', self.bytes)
+        metrics.increment('events_read', self.events)
+
+
+class TimedStream:
+    """ Wraps a binary stream, accumulating the time spent in (and, for decompressed
+        streams, bytes returned by) read() in a FileTimer.
+        """
+
+    def __init__(self, stream, timer, raw=False):
+        self.stream = stream
+        self.timer = timer
+        self.raw = raw
+
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        elapsed = time.perf_counter() - start
+        if self.raw:
+            self.timer.raw_read += elapsed
+        else:
+            self.timer.read += elapsed
+            self.timer.bytes += len(data)
+        return data
+
+
+    def peek(self, size=0):
+        return self.stream.peek(size)
+
+
+def prometheus_text(snapshot):
+    """ Formats a snapshot in the Prometheus text exposition format.
+        """
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        metric = f"{PROMETHEUS_PREFIX}{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        metric = PROMETHEUS_PREFIX + name
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f"{metric}_sum {histogram['sum']}")
+        lines.append(f"{metric}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(snapshot, path):
+    """ Writes a snapshot as a Prometheus text file (eg, for the node exporter's
+        textfile collector). The file is replaced atomically.
+        """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text(snapshot))
+    os.replace(tmp, path)
+
+
+def summary_table(snapshot):
+    """ Formats a snapshot as a human-readable table: for each histogram its count,
+        total, mean, and approximate median and 99th percentile (from the buckets),
+        followed by the counters.
+        """
+    rows = [("metric", "count", "total", "mean", "p50", "p99")]
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        count = histogram['count']
+        rows.append((name, str(count), f"{histogram['sum']:.3f}", f"{histogram['sum'] / count:.4f}" if count else "-",
+                     bucket_percentile(histogram, 0.50), bucket_percentile(histogram, 0.99)))
+    for name, value in sorted(snapshot['counters'].items()):
+        rows.append((name, str(value), "", "", "", ""))
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def bucket_percentile(histogram, fraction):
+    """ Returns the upper bound of the bucket containing the given percentile, as
+        a string ("<=N"); ">N" if it's above the largest bucket.
+        """
+    if not histogram['count']:
+        return "-"
+    target = histogram['count'] * fraction
+    cumulative = 0
+    for bound, count in zip(histogram['buckets'], histogram['counts']):
+        cumulative += count
+        if cumulative >= target:
+            return f"<={bound}"
+    return f">{histogram['buckets'][-1]}"
+
+
+def emf_record(snapshot, namespace, dimensions):
+    """ Returns a CloudWatch Embedded Metric Format record (a dict, to be written
+        to stdout as JSON) for a snapshot. Latencies are reported in milliseconds.
+
+        Histograms are written in EMF's values-and-counts form, with one value per
+        non-empty bucket: the mean of the observations in that bucket. So CloudWatch
+        sees the exact number, sum, and average of observations, and percentiles are
+        accurate to within a bucket.
+        """
+    record = dict(dimensions)
+    metrics = []
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        if name.endswith("_seconds"):
+            emf_name = name[:-len("_seconds")] + "_ms"
+            record[emf_name] = emf_distribution(histogram, 1000)
+            metrics.append({'Name': emf_name, 'Unit': 'Milliseconds'})
+        else:
+            record[name] = emf_distribution(histogram)
+            metrics.append({'Name': name, 'Unit': 'Bytes' if name.endswith("_bytes") else 'Count'})
+    for name, value in sorted(snapshot['counters'].items()):
+        record[name] = value
+        metrics.append({'Name': name, 'Unit': 'Bytes' if name.startswith("bytes") or name.endswith("_bytes") else 'Count'})
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [list(dimensions.keys())],
+            'Metrics': metrics
+        }]
+    }
+    return record
+
+
+def emf_distribution(histogram, scale=1):
+    """ Returns the EMF {"Values": [...], "Counts": [...]} form of a histogram,
+        with the values multiplied by scale.
+        """
+    counts = histogram['counts'] + [histogram['count'] - sum(histogram['counts'])]
+    values = []
+    value_counts = []
+    for count, total in zip(counts, histogram['sums']):
+        if count:
+            values.append(round(total * scale / count, 3))
+            value_counts.append(count)
+    return {'Values': values, 'Counts': value_counts}
+
+
+def emit_emf(snapshot, namespace, dimensions):
+    """ Writes an EMF record to stdout, where Lambda will send it to CloudWatch Logs.
+        """
+    print(json.dumps(emf_record(snapshot, namespace, dimensions)))
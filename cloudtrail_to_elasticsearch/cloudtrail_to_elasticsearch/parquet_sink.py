@@ -0,0 +1,266 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Writes transformed events to Parquet files, partitioned by month, as well as
+    (or instead of) Elasticsearch. Requires pyarrow, which is an optional
+    dependency; only import this module if you're going to use it.
+    """
+
+
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from cloudtrail_to_elasticsearch.metrics import NULL_METRICS
+
+
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+DEFAULT_ROWS_PER_FILE = 1000000
+
+FLATTENED_TYPE = pa.map_(pa.string(), pa.list_(pa.string()))
+
+SCHEMA = pa.schema([
+    pa.field('event_id', pa.string()),
+    pa.field('request_id', pa.string()),
+    pa.field('shared_event_id', pa.string()),
+    pa.field('event_time', pa.timestamp('ms', tz='UTC')),
+    pa.field('event_name', pa.string()),
+    pa.field('event_source', pa.string()),
+    pa.field('event_version', pa.string()),
+    pa.field('event_type', pa.string()),
+    pa.field('aws_region', pa.string()),
+    pa.field('source_ip_address', pa.string()),
+    pa.field('user_agent', pa.string()),
+    pa.field('error_code', pa.string()),
+    pa.field('error_message', pa.string()),
+    pa.field('recipient_account_id', pa.string()),
+    pa.field('user_identity', pa.string()),
+    pa.field('additional_event_data', pa.string()),
+    pa.field('request_parameters', pa.string()),
+    pa.field('request_parameters_flattened', FLATTENED_TYPE),
+    pa.field('response_elements', pa.string()),
+    pa.field('response_elements_flattened', FLATTENED_TYPE),
+    pa.field('resources', pa.string()),
+    pa.field('resources_flattened', FLATTENED_TYPE),
+    pa.field('service_event_details', pa.string()),
+    pa.field('service_event_details_flattened', FLATTENED_TYPE),
+])
+
+
+def as_string(value):
+    return value if value.__class__ is str else json.dumps(value)
+
+
+def as_map(value):
+    return list(value.items())
+
+
+TRANSFORM = [
+    # src field name                    dst field name                      transform fn
+    #------------------------------------------------------------------------------------
+    ('eventID',                         'event_id',                         as_string),
+    ('requestID',                       'request_id',                       as_string),
+    ('sharedEventID',                   'shared_event_id',                  as_string),
+    ('eventTime',                       'event_time',                       as_string),
+    ('eventName',                       'event_name',                       as_string),
+    ('eventSource',                     'event_source',                     as_string),
+    ('eventVersion',                    'event_version',                    as_string),
+    ('eventType',                       'event_type',                       as_string),
+    ('awsRegion',                       'aws_region',                       as_string),
+    ('sourceIPAddress',                 'source_ip_address',                as_string),
+    ('userAgent',                       'user_agent',                       as_string),
+    ('errorCode',                       'error_code',                       as_string),
+    ('errorMessage',                    'error_message',                    as_string),
+    ('recipientAccountId',              'recipient_account_id',             as_string),
+    ('userIdentity',                    'user_identity',                    as_string),
+    ('additionalEventData',             'additional_event_data',            as_string),
+    ('requestParameters_raw',           'request_parameters',               as_string),
+    ('requestParameters_flattened',     'request_parameters_flattened',     as_map),
+    ('responseElements_raw',            'response_elements',                as_string),
+    ('responseElements_flattened',      'response_elements_flattened',      as_map),
+    ('resources_raw',                   'resources',                        as_string),
+    ('resources_flattened',             'resources_flattened',              as_map),
+    ('serviceEventDetails_raw',         'service_event_details',            as_string),
+    ('serviceEventDetails_flattened',   'service_event_details_flattened',  as_map),
+]
+
+
+class ParquetSink:
+    """ Accumulates transformed events by month (taken from the index name), and
+        writes them as row groups of a Parquet file for that month, under the
+        destination in "month=YYYY-MM/" partitions.
+
+        Files are written locally (for S3 destinations, in a temporary directory),
+        and only renamed or uploaded to their final location when closed, so readers
+        never see a partial file. A file is closed when it reaches the maximum number
+        of rows, or when flush() is called; flush() is called at the end of each
+        Lambda invocation and at the end of a bulk upload.
+
+        Events are converted to rows as soon as they're received, because they may
+        be modified afterward (eg, by a FieldPolicy). This is not thread-safe; it's
+        called from the thread that adds events to a batch.
+    """
+
+    def __init__(self, destination, s3_helper=None, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 rows_per_file=DEFAULT_ROWS_PER_FILE, metrics=None):
+        """
+            destination     A local directory, or an S3 location in the form
+                            s3://BUCKET/PREFIX.
+            s3_helper       Used to upload files for an S3 destination.
+            row_group_size  The number of rows buffered before writing a row group.
+            rows_per_file   The number of rows after which a file is closed.
+            metrics         If provided, a metrics.Metrics instance.
+        """
+        if destination.startswith("s3://"):
+            self.bucket, _, prefix = destination[5:].partition("/")
+            self.base = prefix.rstrip("/") + "/" if prefix else ""
+            self.tmpdir = tempfile.mkdtemp(prefix="parquet-")
+        else:
+            self.bucket = None
+            self.base = destination.rstrip("/") + "/"
+            self.tmpdir = None
+        self.s3_helper = s3_helper
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self.metrics = metrics or NULL_METRICS
+        self.partitions = {}
+        self.rows_written = 0
+        self.files_written = 0
+
+
+    def tee(self, events, index):
+        """ A generator that adds each event to the sink and passes it on, so that
+            the sink can share a single pass over the transformed events.
+            """
+        partition = self.partition(index)
+        for event in events:
+            partition.add(event)
+            if len(partition) >= self.row_group_size:
+                self.write_row_group(partition)
+            yield event
+
+
+    def add_events(self, events, index):
+        """ Adds events to the sink without passing them on.
+            """
+        for event in self.tee(events, index):
+            pass
+
+
+    def flush(self):
+        """ Writes all buffered events, and closes all files.
+            """
+        for partition in self.partitions.values():
+            if len(partition):
+                self.write_row_group(partition)
+            self.close_file(partition)
+
+
+    def partition(self, index):
+        partition = self.partitions.get(index)
+        if partition is None:
+            month = index[len("cloudtrail-"):] if index.startswith("cloudtrail-") else index
+            partition = self.partitions[index] = Partition(f"month={month}")
+        return partition
+
+
+    def write_row_group(self, partition):
+        with self.metrics.timer('parquet_write_seconds'):
+            table = partition.take_table()
+            if partition.writer is None:
+                partition.filename = f"{partition.name}/{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4()}.parquet"
+                partition.path = os.path.join(self.tmpdir or self.base, partition.filename + ".tmp")
+                os.makedirs(os.path.dirname(partition.path), exist_ok=True)
+                partition.writer = pq.ParquetWriter(partition.path, SCHEMA, compression='snappy')
+            partition.writer.write_table(table, row_group_size=self.row_group_size)
+            partition.file_rows += table.num_rows
+        self.rows_written += table.num_rows
+        self.metrics.increment('parquet_rows', table.num_rows)
+        if partition.file_rows >= self.rows_per_file:
+            self.close_file(partition)
+
+
+    def close_file(self, partition):
+        if partition.writer is None:
+            return
+        partition.writer.close()
+        if self.bucket:
+            key = self.base + partition.filename
+            print(f"uploading {partition.file_rows} rows to s3://{self.bucket}/{key}")
+            self.s3_helper.upload_file(partition.path, self.bucket, key)
+            os.remove(partition.path)
+        else:
+            final_path = partition.path[:-len(".tmp")]
+            print(f"wrote {partition.file_rows} rows to {final_path}")
+            os.replace(partition.path, final_path)
+        self.files_written += 1
+        partition.writer = None
+        partition.file_rows = 0
+
+
+    def statistics(self):
+        return {'parquet_rows': self.rows_written, 'parquet_files': self.files_written}
+
+
+class Partition:
+    """ The buffered rows and current file for a single month. Rows are held as
+        columns, which is how pyarrow wants them.
+        """
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = {dst: [] for _, dst, _ in TRANSFORM}
+        self.count = 0
+        self.writer = None
+        self.filename = None
+        self.path = None
+        self.file_rows = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def add(self, event):
+        get = event.get
+        columns = self.columns
+        for src, dst, fn in TRANSFORM:
+            value = get(src)
+            columns[dst].append(fn(value) if value is not None else None)
+        self.count += 1
+
+
+    def take_table(self):
+        """ Converts the buffered rows to a pyarrow Table, and clears the buffer.
+            """
+        arrays = []
+        for field in SCHEMA:
+            values = self.columns[field.name]
+            if field.name == 'event_time':
+                parsed = pc.strptime(pa.array(values, pa.string()), format="%Y-%m-%dT%H:%M:%SZ", unit="ms", error_is_null=True)
+                arrays.append(parsed.cast(field.type))
+            else:
+                arrays.append(pa.array(values, field.type))
+        self.columns = {dst: [] for _, dst, _ in TRANSFORM}
+        self.count = 0
+        return pa.Table.from_arrays(arrays, schema=SCHEMA)
@@ -0,0 +1,96 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Runs the retrieve, transform, and upload steps for a sequence of files
+    concurrently. This is used by bulk_upload; the Lambda handles fewer files per
+    invocation, and uses Processor.process_files_from_s3(), which downloads them
+    concurrently but parses them on a single thread into a shared batch.
+    """
+
+
+import collections
+import concurrent.futures
+
+from cloudtrail_to_elasticsearch import processor
+
+
+class Pipeline:
+    """ A three-stage pipeline: a thread pool retrieves file contents, a process
+        pool parses and flattens the events (so that it isn't limited by the GIL),
+        and the processor's ESHelper writes batches, with however many concurrent
+        _bulk requests it has been configured to allow.
+
+        Each of the first two stages holds at most queue_depth files, which bounds
+        memory use: if a stage falls behind, the stages upstream of it block. The
+        results of each stage are consumed in the order that files were submitted,
+        so events are added to batches in the same order as a serial upload.
+
+        If the processor has enabled Metrics, the worker processes time each file,
+        and those timings are added to the metrics as its events are uploaded.
+    """
+
+    def __init__(self, px, workers, queue_depth=None):
+        """
+            px            The Processor used to upload transformed events.
+            workers       The number of threads used to retrieve files, and the number
+                          of processes used to transform them.
+            queue_depth   The maximum number of files held by each stage. Defaults to
+                          twice the number of workers.
+        """
+        self.px = px
+        self.workers = workers
+        self.queue_depth = queue_depth or workers * 2
+
+
+    def run(self, sources):
+        """ Processes all files, then flushes the processor. Sources is an iterable
+            of (description, index, retrieve_fn, skip, progress) tuples, where
+            retrieve_fn is a no-argument function that returns the raw (possibly
+            GZipped) contents of the file, skip is the number of events to skip
+            because they were written by an earlier run, and progress is an optional
+            function to track the writes (see ESHelper.add_events()).
+            """
+        downloads = collections.deque()
+        transforms = collections.deque()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as transform_pool, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as download_pool:
+            # the worker processes are forked on first use; make sure that happens before
+            # any download threads exist, so that a child can't inherit a held lock
+            transform_pool.submit(int).result()
+            for description, index, retrieve_fn, skip, progress in sources:
+                downloads.append((description, index, skip, progress, download_pool.submit(retrieve_fn)))
+                self.advance(downloads, transforms, transform_pool, self.queue_depth)
+            self.advance(downloads, transforms, transform_pool, 0)
+        self.px.flush()
+
+
+    def advance(self, downloads, transforms, transform_pool, depth):
+        """ Moves files from one stage to the next until no more than depth files
+            remain in each stage. Blocks on the oldest file in each stage.
+            """
+        transform_fn = processor.timed_parse_and_transform if self.px.metrics.enabled else processor.parse_and_transform
+        while len(downloads) > depth:
+            description, index, skip, progress, future = downloads.popleft()
+            transformed = transform_pool.submit(transform_fn, future.result())
+            transforms.append((description, index, skip, progress, transformed))
+        while len(transforms) > depth:
+            description, index, skip, progress, future = transforms.popleft()
+            print(f"processing {description}")
+            events = future.result()
+            if self.px.metrics.enabled:
+                events, timer = events
+                timer.record(self.px.metrics)
+            self.px.add_events(events[skip:], index, progress=progress)
@@ -19,16 +19,23 @@
     """
 
 
+import concurrent.futures
 import gzip
+import io
+import itertools
 import json
 import os
 import re
 import sys
 
 from cloudtrail_to_elasticsearch.es_helper import ESHelper
+from cloudtrail_to_elasticsearch.event_reader import EventReader, open_stream
+from cloudtrail_to_elasticsearch.metrics import NULL_METRICS, FileTimer
 from cloudtrail_to_elasticsearch.s3_helper import S3Helper
 
 
+DEFAULT_DOWNLOAD_WORKERS = 8
+
 # the index configuration that we'll use
 
 DEFAULT_INDEX_CONFIG = json.dumps({
@@ -62,6 +69,12 @@ DEFAULT_INDEX_CONFIG = json.dumps({
                         'path_match': 'resources_flattened.*',
                         'mapping': { 'type': 'text' }
                 }
+            },
+            {
+                'overflow': {
+                        'match': '*_overflow',
+                        'mapping': { 'type': 'text' }
+                }
             }
         ],
         'properties': {
@@ -71,55 +84,182 @@ DEFAULT_INDEX_CONFIG = json.dumps({
 })
 
 
-def create():
-  """ Factory method to create a default instance.
+def create(field_policy=None, metrics=None, s3_helper=None, parquet_sink=None, dedup_filter=None, **es_helper_args):
+  """ Factory method to create a default instance. Any other keyword arguments
+      are passed to the ESHelper constructor. If the field policy doesn't have a
+      function to load existing fields, it's given one that queries the cluster.
+      If provided, metrics are shared by the processor and its helpers. Pass an
+      S3Helper to share its client with other callers. If provided, the Parquet
+      sink receives the same transformed events as Elasticsearch. If provided, the
+      dedup filter removes duplicate events before either sees them.
   """
-  return Processor(ESHelper(index_config=DEFAULT_INDEX_CONFIG),
-                   S3Helper())
+  es_helper = ESHelper(index_config=DEFAULT_INDEX_CONFIG, metrics=metrics, **es_helper_args)
+  if field_policy and not field_policy.load_fields:
+      field_policy.load_fields = es_helper.mapped_fields
+  return Processor(es_helper, s3_helper or S3Helper(metrics), field_policy, metrics, parquet_sink, dedup_filter)
 
 
 class Processor:
     """ Functions to extract, transform, and upload a single file's events.
         This is invoked either from the Lambda or bulk_upload.py; it is not
         normally invoked independently.
+
+        If given a FieldPolicy, it's applied to events as they're added to a batch,
+        which happens on a single thread even when transformation doesn't.
+
+        If given enabled Metrics, the time spent reading, parsing, and transforming
+        each file is recorded (see metrics.FileTimer).
+
+        If given a ParquetSink, each transformed event is passed to it on its way to
+        the ESHelper, so both share a single parse and transform. The sink receives
+        events before the field policy is applied, and is flushed with the ESHelper.
+
+        If given a DedupFilter, events that it has already seen are dropped before
+        they reach the ParquetSink or ESHelper. Progress functions count only the
+        events that are passed on, so a resumed run may re-read a few events.
     """
 
-    def __init__(self, es_helper, s3_helper):
+    def __init__(self, es_helper, s3_helper, field_policy=None, metrics=None, parquet_sink=None, dedup_filter=None):
         self.es_helper = es_helper
         self.s3_helper = s3_helper
+        self.field_policy = field_policy
+        self.metrics = metrics or NULL_METRICS
+        self.parquet_sink = parquet_sink
+        self.dedup_filter = dedup_filter
 
 
-    def process_local_file(self, pathname, flush=True):
+    def process_local_file(self, pathname, flush=True, skip=0, progress=None):
         index = index_name(pathname)
         if index:
+            timer = self.file_timer()
             with open (pathname, mode='rb') as f:
-                data = f.read()
-            if data.startswith(b'\x1f\x8b'):
-                 data = gzip.decompress(data)
-            self.process(str(data, 'utf-8'), index, flush)
+                self.process_stream(open_stream(timer.raw(f) if timer else f), index, flush, skip, progress, timer)
         else:
-            print(f'cannot extract index name from key: {key}')
+            print(f'cannot extract index name from file: {pathname}')
 
 
-    def process_from_s3(self, bucket, key, flush=True):
+    def process_from_s3(self, bucket, key, flush=True, skip=0, progress=None):
         index = index_name(key)
         if index:
-            content = self.s3_helper.retrieve(bucket, key)
-            self.process(content, index, flush)
+            timer = self.file_timer()
+            with self.s3_helper.open(bucket, key, gzipped=False) as body:
+                stream = gzip.GzipFile(fileobj=timer.raw(body) if timer else body, mode='rb')
+                self.process_stream(stream, index, flush, skip, progress, timer)
         else:
             print(f'cannot extract index name from key: {key}')
 
 
+    def process_files_from_s3(self, locations, max_workers=DEFAULT_DOWNLOAD_WORKERS):
+        """ Processes a group of files, downloading them concurrently and adding all
+            of their events to the same batch, which is flushed at the end. Returns a
+            list of the (bucket, key) locations whose events could not be read or were
+            not all written.
+
+            Failures are reported rather than raised, including a failure of the final
+            flush: files whose events had all been written by an earlier batch are not
+            affected. If the ParquetSink fails, every file that it received is.
+            Events from a failed final flush are discarded, so they aren't written
+            along with the next call's events; their files are retried instead.
+            """
+        written = set()
+        processed = []
+        def progress_fn(location):
+            def fn(count, complete):
+                if complete:
+                    written.add(location)
+            return fn
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(locations)))) as executor:
+            downloads = [(location, executor.submit(self.s3_helper.retrieve, *location, gzipped=False)) for location in locations]
+            for location, future in downloads:
+                bucket, key = location
+                index = index_name(key)
+                if not index:
+                    print(f'cannot extract index name from key: {key}')
+                    written.add(location)
+                    continue
+                try:
+                    print(f"processing s3://{bucket}/{key}")
+                    timer = self.file_timer()
+                    stream = io.BufferedReader(io.BytesIO(future.result()))
+                    stream = open_stream(timer.raw(stream) if timer else stream)
+                    self.process_stream(stream, index, flush=False, progress=progress_fn(location), timer=timer)
+                    processed.append(location)
+                except Exception as ex:
+                    print(f"failed to process s3://{bucket}/{key}: {ex}")
+        try:
+            self.es_helper.flush()
+        except Exception as ex:
+            print(f"failed to write final batch: {ex}")
+        # a failed batch stays with the ESHelper, which the Lambda reuses between invocations
+        discarded = self.es_helper.discard()
+        if discarded:
+            print(f"discarded {discarded} unwritten events")
+        if self.parquet_sink:
+            try:
+                self.parquet_sink.flush()
+            except Exception as ex:
+                print(f"failed to write Parquet files: {ex}")
+                written.difference_update(processed)
+        return [location for location in locations if location not in written]
+
+
+    def process_stream(self, stream, index, flush=True, skip=0, progress=None, timer=None):
+        """ Parses events from an uncompressed stream, transforming and adding them
+            to the current batch as they're read. Optionally skips events that were
+            written by a previous run (see ESHelper.add_events() for progress).
+
+            If metrics are enabled, the caller may pass the FileTimer from
+            file_timer(), after using it to wrap the source stream; otherwise one
+            is created here, and reading the source isn't measured separately.
+            """
+        if timer is None:
+            timer = self.file_timer()
+        if timer:
+            stream = timer.stream(stream)
+        records = EventReader(stream).with_raw(FLATTENED_KEYS)
+        if timer:
+            records = timer.records(records)
+        if skip:
+            records = itertools.islice(records, skip, None)
+        transformed = (transform_event(event, raw) for event, raw in records)
+        if timer:
+            transformed = timer.transformed(transformed)
+        self.add_events(transformed, index, flush, progress)
+        if timer:
+            timer.record(self.metrics)
+
+
+    def file_timer(self):
+        """ Returns a new FileTimer if metrics are enabled, None if not.
+            """
+        return FileTimer() if self.metrics.enabled else None
+
+
     def process(self, content, index, flush=True):
         parsed = json.loads(content)
         transformed = transform_events(parsed.get('Records', []))
-        self.es_helper.add_events(transformed, index)
+        self.add_events(transformed, index, flush)
+
+
+    def add_events(self, transformed, index, flush=False, progress=None):
+        """ Uploads events that have already been transformed. This is used by the
+            bulk-upload pipeline, which transforms events in a separate process.
+            """
+        if self.dedup_filter:
+            transformed = self.dedup_filter.apply(transformed, index)
+        if self.parquet_sink:
+            transformed = self.parquet_sink.tee(transformed, index)
+        if self.field_policy:
+            transformed = (self.field_policy.apply(event, index) for event in transformed)
+        self.es_helper.add_events(transformed, index, progress)
         if flush:
             self.flush()
 
 
     def flush(self):
         self.es_helper.flush()
+        if self.parquet_sink:
+            self.parquet_sink.flush()
 
 
 ## the following are exposed to simplify testing ... plus, there's no good
@@ -136,68 +276,128 @@ def index_name(key):
         return None
 
 
-def transform_events(events):
-    for event in events:
-        flatten(event, 'requestParameters')
-        flatten(event, 'responseElements')
-        flatten(event, 'resources')
-        flatten(event, 'serviceEventDetails')
-    return events
-
-
-def flatten(event, key):
-    src = event.pop(key, None);
-    if not src:
-        return
-    if isinstance(src, dict):
-        dst = flatten_dict(src, {})
-    elif isinstance(src, list):
-        dst = flatten_list(key, src, {})
-    else:
+def index_names(start_date, end_date):
+    """ Returns the names of the indexes for every month between the provided
+        dates (inclusive), which are strings in the form YYYY-MM-DD.
+        """
+    year, month = int(start_date[0:4]), int(start_date[5:7])
+    end_year, end_month = int(end_date[0:4]), int(end_date[5:7])
+    result = []
+    while (year, month) <= (end_year, end_month):
+        result.append(f'cloudtrail-{year:04d}-{month:02d}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def parse_and_transform(content):
+    """ Parses the (possibly GZipped) contents of a CloudTrail file and returns
+        its transformed events. This is a standalone function so that it can be
+        executed in a process pool.
+        """
+    stream = open_stream(io.BufferedReader(io.BytesIO(content)))
+    records = EventReader(stream).with_raw(FLATTENED_KEYS)
+    return [transform_event(event, raw) for event, raw in records]
+
+
+def timed_parse_and_transform(content):
+    """ As parse_and_transform(), but returns a tuple of the transformed events and
+        a FileTimer, which the caller adds to its metrics.
+        """
+    timer = FileTimer()
+    stream = timer.stream(open_stream(timer.raw(io.BufferedReader(io.BytesIO(content)))))
+    records = timer.records(EventReader(stream).with_raw(FLATTENED_KEYS))
+    return list(timer.transformed(transform_event(event, raw) for event, raw in records)), timer
+
+
+# the sub-objects that are flattened; see README for details
+
+FLATTENED_KEYS = ('requestParameters', 'responseElements', 'resources', 'serviceEventDetails')
+
+
+def transform_events(events, field_policy=None, index=None):
+    """ Transforms a list of events, optionally applying a field policy for the
+        index that they'll be written to.
+        """
+    transformed = [transform_event(event) for event in events]
+    if field_policy:
+        transformed = [field_policy.apply(event, index) for event in transformed]
+    return transformed
+
+
+def transform_event(event, raw=None):
+    """ Flattens the event's sub-objects. If provided, raw is a dict containing the
+        source JSON for those sub-objects, which is used instead of re-serializing
+        them (see EventReader.with_raw()).
+        """
+    for key in FLATTENED_KEYS:
+        # most events have null or missing sections, so check before calling flatten()
+        src = event.pop(key, None)
+        if src:
+            flatten(event, key, src, raw.get(key) if raw else None)
+    return event
+
+
+def flatten(event, key, src, raw=None):
+    """ Replaces a sub-object, which has already been removed from the event, with
+        its raw and flattened forms.
+        """
+    if not isinstance(src, (dict, list)):
         # this is something that doesn't need to be flattened; put it back
         event[key] = src
         return
-    event[key + "_raw"] = json.dumps(src)
-    event[key + "_flattened"] = transform_flattened_elements(dst)
-
-
-def flatten_dict(src, dst):
-    for key in src.keys():
-        # CloudTrail events sometimes contains blank keys; we'll skip those
-        if key:
-            flatten_item(key, src[key], dst)
-    return dst
-
+    event[key + "_raw"] = raw if raw else json.dumps(src)
+    event[key + "_flattened"] = flatten_value(key, src)
 
-def flatten_list(key, val, dst):
-    for item in val:
-        flatten_item(key, item, dst)
-    return dst
 
+def flatten_value(key, src):
+    """ Walks a nested structure, returning a dict that maps every leaf key to the
+        list of distinct values for that key, as strings. Values in a list are
+        associated with the key that holds the list.
 
-def flatten_item(key, val, dst):
-    if isinstance(val, dict):
-        flatten_dict(val, dst)
-    elif isinstance(val, list):
-        flatten_list(key, val, dst)
-    else:
-        if not key in dst:
-            dst[key] = set()
-        dst[key].add(val)
-    return dst
-
-
-def transform_flattened_elements(src):
+        This is the main CPU cost of the loader, so is written for speed: values are
+        collected into dicts (which preserve order and ignore duplicates), and the
+        type checks are inlined rather than dispatched to a per-value function.
+        """
     dst = {}
-    for (k, v) in src.items():
+    if src.__class__ is dict:
+        flatten_dict(src, dst)
+    else:
+        flatten_list(key, src, dst)
+    result = {}
+    for k, v in dst.items():
         # Elasticsearch doesn't like keys that have dots in them
-        k = k.replace(".", "_")
-        # json.dumps() doesn't like sets
-        if isinstance(v, set):
-            tmp = v
-            v = list()
-            for item in tmp:
-                v.append(str(item))
-        dst[k] = v
-    return dst
+        result[k.replace(".", "_") if "." in k else k] = list(v)
+    return result
 
+
+def flatten_dict(src, dst):
+    for k, v in src.items():
+        # CloudTrail events sometimes contains blank keys; we'll skip those
+        if not k:
+            continue
+        cls = v.__class__
+        if cls is dict:
+            flatten_dict(v, dst)
+        elif cls is list:
+            flatten_list(k, v, dst)
+        else:
+            values = dst.get(k)
+            if values is None:
+                values = dst[k] = {}
+            values[v if cls is str else str(v)] = None
+
+
+def flatten_list(key, items, dst):
+    values = None
+    for v in items:
+        cls = v.__class__
+        if cls is dict:
+            flatten_dict(v, dst)
+        elif cls is list:
+            flatten_list(key, v, dst)
+        else:
+            if values is None:
+                values = dst.get(key)
+                if values is None:
+                    values = dst[key] = {}
+            values[v if cls is str else str(v)] = None
@@ -0,0 +1,99 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Support for retrying failed Elasticsearch requests, and for recording the
+    events that couldn't be written.
+    """
+
+
+import json
+import random
+import threading
+import time
+import uuid
+
+
+# status codes for an entire request that indicate it should be retried
+RETRYABLE_REQUEST_STATUSES = frozenset([429, 502, 503, 504])
+
+# status codes for an item within a _bulk response that indicate it should be retried
+RETRYABLE_ITEM_STATUSES = frozenset([429, 503])
+
+
+class RetryPolicy:
+    """ Exponential backoff with "full jitter": the delay before retry N is a
+        random value between 0 and base_delay * 2^N, capped at max_delay. The
+        number of attempts (including the first) is bounded by max_attempts.
+        """
+
+    def __init__(self, max_attempts=8, base_delay=0.25, max_delay=20.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+
+    def delay(self, attempt):
+        """ Returns the number of seconds to wait before the specified retry, where
+            the first retry is attempt 1.
+            """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+def create_dead_letter(location, s3_helper=None):
+    """ Factory method for a dead-letter destination: location is either an S3 URL
+        (s3://BUCKET/PREFIX) or the path of a local file. Returns None if location
+        is empty.
+        """
+    if not location:
+        return None
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[5:].partition("/")
+        return S3DeadLetter(s3_helper, bucket, prefix)
+    return FileDeadLetter(location)
+
+
+class FileDeadLetter:
+    """ Appends failed records to a local file, as newline-delimited JSON.
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+
+    def write(self, failures):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for failure in failures:
+                    f.write(json.dumps(failure))
+                    f.write("\n")
+
+
+class S3DeadLetter:
+    """ Writes each group of failed records to a new S3 object, as newline-delimited
+        JSON. Object names are based on the current time, so sort chronologically.
+        """
+
+    def __init__(self, s3_helper, bucket, prefix):
+        self.s3_helper = s3_helper
+        self.bucket = bucket
+        self.prefix = prefix
+
+
+    def write(self, failures):
+        content = "".join(json.dumps(failure) + "\n" for failure in failures)
+        key = f"{self.prefix}{time.strftime('%Y/%m/%d/%H%M%S', time.gmtime())}-{uuid.uuid4()}.ndjson"
+        self.s3_helper.store(self.bucket, key, content.encode('utf-8'))
@@ -16,36 +16,196 @@
 ################################################################################
 
 import boto3
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
+import contextlib
 import gzip
+import re
+import threading
+
+from cloudtrail_to_elasticsearch.metrics import NULL_METRICS
+
+
+# enough connections for the bulk-upload download threads, each fetching parts
+DEFAULT_MAX_POOL_CONNECTIONS = 64
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+DEFAULT_PART_WORKERS = 8
+
+CONTENT_RANGE_REGEX = re.compile(r"bytes \d+-\d+/(\d+)")
 
 
 class S3Helper:
     """ Provides functions for interacting with S3. This class allows isolated unit
         testing of the operational modules.
+
+        The S3 client is created on first use and shared by all threads (boto3
+        clients are thread-safe, but creating them is not). Its connection pool is
+        sized for concurrent downloads, and it uses the "standard" retry mode.
+
+        Objects larger than the part size are retrieved as byte ranges, in parallel,
+        and assembled in a preallocated buffer. The first range is requested before
+        the object's size is known, so small objects still take a single request.
+
+        If given enabled Metrics, records the time and bytes for each retrieve().
     """
 
+    def __init__(self, metrics=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                 part_size=DEFAULT_PART_SIZE, part_workers=DEFAULT_PART_WORKERS):
+        """
+            metrics               If provided, a metrics.Metrics instance.
+            max_pool_connections  The size of the client's connection pool.
+            part_size             The size of each byte range when retrieving a large
+                                  object.
+            part_workers          The number of threads that retrieve byte ranges. These
+                                  are shared by all calls to retrieve().
+        """
+        self._client = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self.metrics = metrics or NULL_METRICS
+        self.max_pool_connections = max_pool_connections
+        self.part_size = part_size
+        self.part_workers = part_workers
+
+
+    @property
+    def client(self):
+        with self._lock:
+            if not self._client:
+                config = botocore.config.Config(max_pool_connections=self.max_pool_connections,
+                                                retries={'mode': 'standard'})
+                self._client = boto3.client('s3', config=config)
+            return self._client
+
+
+    @property
+    def executor(self):
+        with self._lock:
+            if not self._executor:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.part_workers)
+            return self._executor
+
+
     def retrieve(self, bucket, key, gzipped=True):
         """ Retrieves the contents of an S3 object, optionally un-GZipping it.
         """
-        object = boto3.resource('s3').Object(bucket, key)
-        body = object.get()['Body']
+        with self.metrics.timer('s3_download_seconds'):
+            raw = self.retrieve_parts(bucket, key)
+        self.metrics.increment('s3_bytes', len(raw))
+        if gzipped:
+            return gzip.decompress(raw)
+        else:
+            return raw
+
+
+    def retrieve_parts(self, bucket, key):
+        """ Retrieves the contents of an object, using parallel ranged GETs if it's
+            larger than the part size (in which case the result is a bytearray).
+            Later ranges must match the ETag of the first, so that we can't assemble
+            parts from different versions of the object.
+            """
+        try:
+            rsp = self.client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{self.part_size - 1}")
+        except botocore.exceptions.ClientError as ex:
+            # an empty object can't satisfy a range
+            if ex.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            return self.read_body(self.client.get_object(Bucket=bucket, Key=key)['Body'])
+        first = self.read_body(rsp['Body'])
+        match = CONTENT_RANGE_REGEX.match(rsp.get('ContentRange') or "")
+        size = int(match.group(1)) if match else len(first)
+        if size <= len(first):
+            return first
+        buf = bytearray(size)
+        buf[0:len(first)] = first
+        futures = [self.executor.submit(self.retrieve_range, bucket, key, rsp['ETag'], buf, start, min(start + self.part_size, size))
+                   for start in range(len(first), size, self.part_size)]
+        for future in futures:
+            future.result()
+        self.metrics.increment('s3_range_requests', len(futures) + 1)
+        return buf
+
+
+    def retrieve_range(self, bucket, key, etag, buf, start, end):
+        """ Retrieves the bytes from start to end (exclusive) of an object, writing
+            them into the corresponding part of the buffer.
+            """
+        body = self.client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", IfMatch=etag)['Body']
+        pos = start
+        try:
+            with memoryview(buf) as view:
+                for chunk in body.iter_chunks(1024 * 1024):
+                    view[pos:pos + len(chunk)] = chunk
+                    pos += len(chunk)
+        finally:
+            body.close()
+        if pos != end:
+            raise IOError(f"incomplete range for s3://{bucket}/{key}: expected {end - start} bytes, got {pos - start}")
+
+
+    def read_body(self, body):
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+
+    @contextlib.contextmanager
+    def open(self, bucket, key, gzipped=True):
+        """ Opens an S3 object for streaming reads, optionally un-GZipping it as it's
+            read. Use as a context manager, to ensure that the connection is released.
+        """
+        body = self.client.get_object(Bucket=bucket, Key=key)['Body']
         try:
-            raw = body.read()
             if gzipped:
-                return gzip.decompress(raw)
+                yield gzip.GzipFile(fileobj=body, mode='rb')
             else:
-                return raw
+                yield body
         finally:
             body.close()
 
 
+    def store(self, bucket, key, data):
+        """ Writes the provided bytes to an S3 object.
+        """
+        self.client.put_object(Bucket=bucket, Key=key, Body=data)
+
+
+    def upload_file(self, path, bucket, key):
+        """ Uploads a local file to an S3 object, using a multi-part upload if it's
+            large.
+        """
+        self.client.upload_file(path, bucket, key)
+
+
     def iterate_bucket(self, bucket, prefix, fn):
         """ Executes the provided function(bucket, key) for every key
             in the specified bucket with the specified prefix.
         """
-        paginator = boto3.client('s3').get_paginator('list_objects')
+        for key in self.list_keys(bucket, prefix):
+            fn(bucket, key)
+
+
+    def list_keys(self, bucket, prefix):
+        """ A generator that yields every key in the specified bucket with the
+            specified prefix, retrieving pages of keys as needed.
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
         for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            for obj in page['Contents']:
-                key = obj['Key']
-                fn(bucket, key)
+            for obj in page.get('Contents', []):
+                yield obj['Key']
 
+
+    def list_child_prefixes(self, bucket, prefix):
+        """ Returns the "directories" immediately below the specified prefix. If the
+            prefix doesn't end with a slash, this includes any that start with it.
+        """
+        result = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for child in page.get('CommonPrefixes', []):
+                result.append(child['Prefix'])
+        return result
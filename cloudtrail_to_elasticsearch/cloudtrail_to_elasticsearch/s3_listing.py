@@ -0,0 +1,114 @@
+################################################################################
+# Copyright Chariot Solutions
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+""" Lists the CloudTrail files for a date range, using the standard layout of a
+    trail's bucket:
+
+        PREFIX/AWSLogs/[ORGANIZATION_ID/]ACCOUNT_ID/CloudTrail/REGION/YYYY/MM/DD/
+
+    Rather than listing everything under PREFIX, this finds the region "directories"
+    and lists only the dates of interest under each, making concurrent requests.
+    """
+
+
+import collections
+import concurrent.futures
+import datetime
+import re
+
+
+DEFAULT_LISTING_WORKERS = 16
+
+# the "directories" that may appear between the prefix and the region
+LAYOUT_REGEX = re.compile(r"^(AWSLogs|o-[a-z0-9]{10,32}|\d{12}|CloudTrail)/$")
+
+
+def date_suffixes(start_date, end_date):
+    """ Returns the list of date "directories" that cover the range from start to
+        end date (in the form YYYY-MM-DD, inclusive), using whole years or months
+        where possible, to minimize the number of requests.
+        """
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    result = []
+    while start <= end:
+        next_month = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        if start.month == 1 and start.day == 1 and datetime.date(start.year, 12, 31) <= end:
+            result.append(f"{start.year:04d}/")
+            start = datetime.date(start.year + 1, 1, 1)
+        elif start.day == 1 and next_month - datetime.timedelta(days=1) <= end:
+            result.append(f"{start.year:04d}/{start.month:02d}/")
+            start = next_month
+        else:
+            result.append(f"{start.year:04d}/{start.month:02d}/{start.day:02d}/")
+            start += datetime.timedelta(days=1)
+    return result
+
+
+def child_name(child):
+    """ Returns the last component of a "directory" prefix, including its slash.
+        """
+    return child[child.rfind("/", 0, -1) + 1:]
+
+
+def find_region_prefixes(s3_helper, bucket, prefix, executor):
+    """ Walks the bucket's "directory" tree from the provided prefix, returning the
+        prefix of each CloudTrail region directory. Only the directories that make
+        up the standard layout are followed. Returns an empty list if the prefix
+        points below the region level, or the bucket doesn't follow the layout.
+        """
+    if re.search(r"(^|/)CloudTrail/[^/]+/$", prefix):
+        return [prefix]
+    if re.search(r"(^|/)CloudTrail/.", prefix):
+        return []
+    regions = []
+    frontier = [prefix]
+    while frontier:
+        next_frontier = []
+        children = executor.map(lambda p: s3_helper.list_child_prefixes(bucket, p), frontier)
+        for parent, parent_children in zip(frontier, children):
+            for child in parent_children:
+                if parent.endswith("CloudTrail/"):
+                    regions.append(child)
+                elif child == parent + "/" or LAYOUT_REGEX.match(child_name(child)):
+                    next_frontier.append(child)
+        frontier = next_frontier
+    return regions
+
+
+def list_cloudtrail_keys(s3_helper, bucket, prefix, start_date, end_date, max_workers=DEFAULT_LISTING_WORKERS):
+    """ A generator that yields the keys of files under the provided prefix, for
+        dates between start and end (in the form YYYY-MM-DD, inclusive). Keys are
+        produced in date order, as soon as the listings for a date are available.
+
+        If the bucket doesn't follow the standard layout, falls back to listing all
+        keys under the prefix; the caller must filter these.
+        """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        regions = find_region_prefixes(s3_helper, bucket, prefix, executor)
+        if not regions:
+            print(f"unable to find CloudTrail region prefixes under s3://{bucket}/{prefix}; listing all files")
+            yield from s3_helper.list_keys(bucket, prefix)
+            return
+        print(f"listing files for {len(regions)} account/region prefixes")
+        pending = collections.deque()
+        for suffix in date_suffixes(start_date, end_date):
+            for region in regions:
+                pending.append(executor.submit(lambda p: list(s3_helper.list_keys(bucket, p)), region + suffix))
+                if len(pending) >= max_workers * 4:
+                    yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
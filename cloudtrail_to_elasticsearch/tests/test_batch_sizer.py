@@ -0,0 +1,58 @@
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.batch_sizer import AdaptiveBatchSizer
+
+
+class TestAdaptiveBatchSizer(unittest.TestCase):
+
+    def create_sizer(self, **kwargs):
+        return AdaptiveBatchSizer(1000, 200, 2000, initial_docs=100, step=100, **kwargs)
+
+
+    def test_grows_while_fast(self):
+        sizer = self.create_sizer()
+        for ii in range(5):
+            sizer.record(200, sizer.batch_size, 0.1, took=50)
+        self.assertEqual(1500, sizer.batch_size)
+        self.assertEqual(150, sizer.max_docs)
+
+
+    def test_bounded_by_max(self):
+        sizer = self.create_sizer()
+        for ii in range(50):
+            sizer.record(200, sizer.batch_size, 0.1, took=50)
+        self.assertEqual(2000, sizer.batch_size)
+
+
+    def test_no_growth_for_partial_batches(self):
+        sizer = self.create_sizer()
+        sizer.record(200, 100, 0.1, took=50)
+        self.assertEqual(1000, sizer.batch_size)
+
+
+    def test_shrinks_when_slow(self):
+        sizer = self.create_sizer(target_latency=1.0)
+        sizer.record(200, 1000, 0.5, took=1500)
+        self.assertEqual(500, sizer.batch_size)
+
+
+    def test_shrinks_on_too_large(self):
+        sizer = self.create_sizer()
+        sizer.record(413, 600, 0.1)
+        self.assertEqual(300, sizer.batch_size)
+        sizer.record(413, 300, 0.1)
+        self.assertEqual(200, sizer.batch_size)
+
+
+    def test_shrinks_when_throttled(self):
+        sizer = self.create_sizer(throttle_window=4, max_throttle_rate=0.3)
+        sizer.record(200, 1000, 0.1)
+        sizer.record(200, 1100, 0.1)
+        sizer.record(200, 1200, 0.1)
+        self.assertEqual(1300, sizer.batch_size)
+        sizer.record(429, 1300, 0.1)
+        self.assertEqual(1300, sizer.batch_size)
+        sizer.record(200, 1300, 0.1, throttled=True)
+        self.assertEqual(650, sizer.batch_size)
@@ -0,0 +1,67 @@
+import gzip
+import json
+import unittest
+
+from unittest.mock import patch
+
+import cloudtrail_to_elasticsearch.bulk_body
+
+
+# module under test
+from cloudtrail_to_elasticsearch.bulk_body import BulkBody, encode_json
+
+
+class TestBulkBody(unittest.TestCase):
+
+    def test_add(self):
+        body = BulkBody()
+        body.add("cloudtrail-2020-03", {"eventID": "1", "userAgent": "é中文"})
+        body.add("cloudtrail-2020-03", {"eventID": "2"})
+        lines = bytes(body.view()).decode('utf-8').splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertEqual({"index": {"_index": "cloudtrail-2020-03", "_id": "1"}}, json.loads(lines[0]))
+        self.assertEqual({"eventID": "1", "userAgent": "é中文"}, json.loads(lines[1]))
+        self.assertEqual(2, len(body))
+        self.assertEqual(len("\n".join(lines).encode('utf-8')) + 1, body.size)
+
+
+    def test_items_and_subset(self):
+        body = BulkBody()
+        for ii in range(5):
+            body.add("cloudtrail-2020-03", {"eventID": str(ii)})
+        subset = body.subset([1, 3])
+        self.assertEqual(2, len(subset))
+        self.assertEqual(body.item(1), subset.item(0))
+        self.assertEqual(body.item(3), subset.item(1))
+        self.assertEqual(body.item(1) + body.item(3), bytes(subset.view()))
+        first, second = body.split()
+        self.assertEqual((2, 3), (len(first), len(second)))
+        self.assertEqual(bytes(body.view()), bytes(first.view()) + bytes(second.view()))
+
+
+    def test_encode_large_integer(self):
+        self.assertEqual({"value": 2 ** 70}, json.loads(encode_json({"value": 2 ** 70})))
+
+
+    def test_lone_surrogate(self):
+        event = json.loads('{"eventID": "1", "requestParameters": {"name": "bad\\ud800", "other": "é"}}')
+        for orjson in (cloudtrail_to_elasticsearch.bulk_body.orjson, None):
+            with self.subTest(orjson=orjson), patch.object(cloudtrail_to_elasticsearch.bulk_body, 'orjson', orjson):
+                body = BulkBody()
+                body.add("cloudtrail-2020-03", event)
+                lines = bytes(body.view()).decode('utf-8').splitlines()
+                self.assertIn('\\ud800', lines[1])
+                self.assertEqual(event, json.loads(lines[1]))
+
+
+    def test_compression(self):
+        body = BulkBody(compression_level=6)
+        for ii in range(100):
+            body.add("cloudtrail-2020-03", {"eventID": str(ii), "eventName": "Test"})
+        compressed = body.gzip()
+        self.assertEqual(bytes(body.view()), gzip.decompress(compressed))
+        self.assertEqual(len(compressed), body.compressed_size)
+        self.assertLess(body.compressed_size, body.size)
+        body.add("cloudtrail-2020-03", {"eventID": "100"})
+        self.assertEqual(bytes(body.view()), gzip.decompress(body.gzip()))
+        self.assertEqual(body.item(100), gzip.decompress(body.subset([100]).gzip()))
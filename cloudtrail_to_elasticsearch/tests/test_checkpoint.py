@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.checkpoint import Checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "checkpoint.db")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+    def test_record_and_resume(self):
+        checkpoint = Checkpoint(self.path)
+        self.assertEqual((0, False), checkpoint.status("s3://bucket/file1"))
+        checkpoint.record("s3://bucket/file1", 100, True)
+        progress = checkpoint.progress_fn("s3://bucket/file2")
+        progress(50, False)
+        checkpoint.close()
+
+        checkpoint = Checkpoint(self.path, resume=True)
+        self.assertEqual((100, True), checkpoint.status("s3://bucket/file1"))
+        self.assertEqual((50, False), checkpoint.status("s3://bucket/file2"))
+        progress = checkpoint.progress_fn("s3://bucket/file2", skip=50)
+        progress(25, True)
+        self.assertEqual((75, True), checkpoint.status("s3://bucket/file2"))
+        checkpoint.close()
+
+
+    def test_reset_without_resume(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.record("s3://bucket/file1", 100, True)
+        checkpoint.close()
+        checkpoint = Checkpoint(self.path)
+        self.assertEqual((0, False), checkpoint.status("s3://bucket/file1"))
+        checkpoint.close()
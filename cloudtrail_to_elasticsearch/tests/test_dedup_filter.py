@@ -0,0 +1,57 @@
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.dedup_filter import BLOOM, LRU, LRU_ENTRY_BYTES, DedupFilter
+from cloudtrail_to_elasticsearch.metrics import Metrics
+
+
+def events(*ids):
+    return [{"eventID": event_id} for event_id in ids]
+
+
+class TestDedupFilter(unittest.TestCase):
+
+    def test_lru(self):
+        dedup = DedupFilter(LRU_ENTRY_BYTES * 1000, LRU)
+        self.assertEqual(events("1", "2", "3"), list(dedup.apply(events("1", "2", "1", "3"), "cloudtrail-2020-03")))
+        self.assertEqual(events("4"), list(dedup.apply(events("2", "4"), "cloudtrail-2020-03")))
+        self.assertEqual(events("1"), list(dedup.apply(events("1"), "cloudtrail-2020-04")))
+        self.assertEqual({'duplicates': {"cloudtrail-2020-03": 2}, 'remembered': 5}, dedup.statistics())
+
+
+    def test_lru_eviction(self):
+        dedup = DedupFilter(LRU_ENTRY_BYTES * 2, LRU)
+        list(dedup.apply(events("1", "2", "1", "3"), "cloudtrail-2020-03"))
+        # "2" was least recently used, so was evicted when "3" was added
+        self.assertEqual(events("2"), list(dedup.apply(events("1", "2"), "cloudtrail-2020-03")))
+
+
+    def test_bloom(self):
+        dedup = DedupFilter(1024 * 1024, BLOOM)
+        ids = [str(n) for n in range(10000)]
+        self.assertEqual(events(*ids), list(dedup.apply(events(*ids), "cloudtrail-2020-03")))
+        self.assertEqual([], list(dedup.apply(events(*ids[:100]), "cloudtrail-2020-03")))
+        self.assertEqual(100, dedup.statistics()['duplicates']["cloudtrail-2020-03"])
+
+
+    def test_bloom_generations(self):
+        dedup = DedupFilter(1024, BLOOM)
+        capacity = dedup.seen.capacity
+        ids = [str(n) for n in range(capacity * 3)]
+        list(dedup.apply(events(*ids), "cloudtrail-2020-03"))
+        # the oldest generation has been discarded, the most recent are retained
+        self.assertEqual(capacity, len(list(dedup.apply(events(*ids[:capacity]), "cloudtrail-2020-03"))))
+        self.assertEqual([], list(dedup.apply(events(*ids[-capacity:]), "cloudtrail-2020-03")))
+
+
+    def test_missing_event_id(self):
+        dedup = DedupFilter()
+        self.assertEqual([{}, {}], list(dedup.apply([{}, {}], "cloudtrail-2020-03")))
+
+
+    def test_metrics(self):
+        metrics = Metrics()
+        dedup = DedupFilter(metrics=metrics)
+        list(dedup.apply(events("1", "1", "1"), "cloudtrail-2020-03"))
+        self.assertEqual({'duplicates_dropped': 2}, metrics.snapshot()['counters'])
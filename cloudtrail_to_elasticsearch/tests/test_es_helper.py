@@ -0,0 +1,340 @@
+import gzip
+import http.server
+import json
+import threading
+import unittest
+
+from unittest.mock import Mock
+
+
+# module under test
+from cloudtrail_to_elasticsearch.batch_sizer import AdaptiveBatchSizer
+from cloudtrail_to_elasticsearch.es_helper import ESHelper
+from cloudtrail_to_elasticsearch.metrics import Metrics
+from cloudtrail_to_elasticsearch.retry import RetryPolicy
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """ Implements just enough of the Elasticsearch API to exercise ESHelper. Each
+        request is recorded in the server's "requests" list; responses are taken
+        from its "responses" list if not empty, otherwise default to success.
+        """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(b"")
+
+    def do_PUT(self):
+        self.respond(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            self.server.compressed_sizes.append(len(body))
+            body = gzip.decompress(body)
+        self.respond(body)
+
+    def respond(self, body):
+        self.server.requests.append((self.command, self.path, body))
+        if self.server.responses:
+            status, rsp = self.server.responses.pop(0)
+        elif self.path == "/_bulk":
+            count = len(body.splitlines()) // 2
+            status, rsp = 200, {"took": 1, "errors": False, "items": [{"index": {"status": 201}}] * count}
+        else:
+            status, rsp = 200, {}
+        data = json.dumps(rsp).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestESHelper(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        self.server.responses = []
+        self.server.compressed_sizes = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_helper(self, **kwargs):
+        return ESHelper(hostname=f"127.0.0.1:{self.server.server_port}", use_aws_auth=False, use_https=False, **kwargs)
+
+    def events(self, count):
+        return [{"eventID": str(ii), "eventName": "Test"} for ii in range(count)]
+
+
+    def test_add_and_flush(self):
+        es = self.create_helper()
+        es.add_events(self.events(3), "cloudtrail-2020-03")
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(1, len(bulk_requests))
+        self.assertEqual(6, len(bulk_requests[0][2].splitlines()))
+
+
+    def test_connection_reuse(self):
+        es = self.create_helper()
+        for index in ["cloudtrail-2020-03", "cloudtrail-2020-04"]:
+            es.add_events(self.events(3), index)
+        es.flush()
+        stats = es.connection_stats()
+        self.assertEqual(len(self.server.requests), stats['requests'])
+        self.assertEqual(1, stats['new_connections'])
+        self.assertEqual(stats['requests'] - 1, stats['reused_connections'])
+
+
+    def test_concurrent_requests(self):
+        es = self.create_helper(batch_size=256, max_inflight=3)
+        es.add_events(self.events(100), "cloudtrail-2020-03")
+        es.flush()
+        uploaded = sum(len(r[2].splitlines()) // 2 for r in self.server.requests if r[1] == "/_bulk")
+        self.assertEqual(100, uploaded)
+        self.assertEqual(0, es.failed_event_count)
+
+
+    def test_index_existence_cached(self):
+        es = self.create_helper(batch_size=256)
+        es.add_events(self.events(20), "cloudtrail-2020-03")
+        es.flush()
+        index_requests = [r for r in self.server.requests if r[1] == "/cloudtrail-2020-03"]
+        self.assertEqual(1, len(index_requests))
+        self.assertTrue(es.is_known_index("cloudtrail-2020-03"))
+
+
+    def test_index_cache_invalidated_by_bulk_error(self):
+        es = self.create_helper()
+        self.server.responses = [
+            (200, {}),
+            (200, {"errors": True, "items": [{"index": {"_index": "cloudtrail-2020-03", "status": 404, "error": {"type": "index_not_found_exception"}}}]})
+        ]
+        es.add_events(self.events(1), "cloudtrail-2020-03")
+        es.flush()
+        self.assertFalse(es.is_known_index("cloudtrail-2020-03"))
+
+
+    def test_warm_index_cache(self):
+        es = self.create_helper(index_config='{"settings": {}}')
+        self.server.responses = [(200, {"cloudtrail-2020-03": {}})]
+        es.warm_index_cache(["cloudtrail-2020-03", "cloudtrail-2020-04"])
+        self.assertEqual(["GET", "PUT"], [r[0] for r in self.server.requests])
+        self.assertEqual("/cloudtrail-2020-04", self.server.requests[1][1])
+        self.assertTrue(es.is_known_index("cloudtrail-2020-03"))
+        self.assertTrue(es.is_known_index("cloudtrail-2020-04"))
+
+
+    def test_throttled_request_retried(self):
+        es = self.create_helper(retry_policy=RetryPolicy(base_delay=0.001))
+        self.server.responses = [(200, {}), (429, {}), (503, {})]
+        es.add_events(self.events(2), "cloudtrail-2020-03")
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(3, len(bulk_requests))
+        self.assertEqual(0, len(es.current_batch))
+        self.assertEqual(2, es.statistics()['retried_requests'])
+
+
+    def test_throttled_records_resubmitted(self):
+        dead_letter = Mock()
+        es = self.create_helper(retry_policy=RetryPolicy(base_delay=0.001), dead_letter=dead_letter)
+        self.server.responses = [
+            (200, {}),
+            (200, {"errors": True, "items": [
+                {"index": {"_id": "0", "status": 201}},
+                {"index": {"_id": "1", "status": 429}},
+                {"index": {"_id": "2", "status": 400, "error": {"type": "mapper_parsing_exception"}}}
+            ]})
+        ]
+        es.add_events(self.events(3), "cloudtrail-2020-03")
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(2, len(bulk_requests))
+        resubmitted = [json.loads(line) for line in bulk_requests[1][2].splitlines()]
+        self.assertEqual("1", resubmitted[0]['index']['_id'])
+        self.assertEqual(2, len(resubmitted))
+        dead_letter.write.assert_called_once()
+        failures = dead_letter.write.call_args[0][0]
+        self.assertEqual(["2"], [f['id'] for f in failures])
+        self.assertEqual("2", failures[0]['event']['eventID'])
+
+
+    def test_retries_exhausted(self):
+        dead_letter = Mock()
+        es = self.create_helper(retry_policy=RetryPolicy(max_attempts=2, base_delay=0.001), dead_letter=dead_letter)
+        throttled = {"errors": True, "items": [{"index": {"_id": "0", "status": 429}}]}
+        self.server.responses = [(200, {}), (200, throttled), (200, throttled)]
+        es.add_events(self.events(1), "cloudtrail-2020-03")
+        es.flush()
+        self.assertEqual(2, len([r for r in self.server.requests if r[1] == "/_bulk"]))
+        self.assertEqual(["0"], [f['id'] for f in dead_letter.write.call_args[0][0]])
+        self.assertEqual(1, es.statistics()['dead_lettered_records'])
+
+
+    def test_oversize_request_split(self):
+        es = self.create_helper()
+        self.server.responses = [(200, {}), (413, {})]
+        es.add_events(self.events(4), "cloudtrail-2020-03")
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual([8, 4, 4], [len(r[2].splitlines()) for r in bulk_requests])
+        self.assertEqual(0, len(es.current_batch))
+
+
+    def test_adaptive_batch_size(self):
+        sizer = AdaptiveBatchSizer(256, 128, 1024, step=128)
+        es = self.create_helper(batch_sizer=sizer)
+        es.add_events(self.events(50), "cloudtrail-2020-03")
+        es.flush()
+        self.assertGreater(es.statistics()['batch_size'], 256)
+        self.assertEqual(sizer.batch_size, es.max_batch_size)
+
+
+    def test_compressed_requests(self):
+        es = self.create_helper(compression_level=6)
+        es.add_events(self.events(20), "cloudtrail-2020-03")
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(1, len(bulk_requests))
+        self.assertEqual(40, len(bulk_requests[0][2].splitlines()))
+        self.assertEqual(1, len(self.server.compressed_sizes))
+        self.assertLess(self.server.compressed_sizes[0], len(bulk_requests[0][2]))
+
+
+    def test_compressed_size_limit(self):
+        # about 100 KB uncompressed, but compresses to a fraction of that
+        events = [{"eventID": str(ii), "eventName": "Test" * 50} for ii in range(400)]
+        es = self.create_helper(compression_level=6, limit_compressed=True, batch_size=16 * 1024)
+        es.add_events(events, "cloudtrail-2020-03")
+        es.flush()
+        self.assertEqual(1, len([r for r in self.server.requests if r[1] == "/_bulk"]))
+        self.server.requests = []
+        es = self.create_helper(compression_level=6, batch_size=16 * 1024)
+        es.add_events(events, "cloudtrail-2020-03")
+        es.flush()
+        self.assertLess(5, len([r for r in self.server.requests if r[1] == "/_bulk"]))
+
+
+    def test_progress_tracking(self):
+        es = self.create_helper(batch_size=256, max_inflight=3)
+        calls = []
+        es.add_events(self.events(20), "cloudtrail-2020-03", lambda count, complete: calls.append((1, count, complete)))
+        es.add_events(self.events(5), "cloudtrail-2020-03", lambda count, complete: calls.append((2, count, complete)))
+        es.flush()
+        self.assertEqual((1, 20, True), next(call for call in calls if call[0] == 1 and call[2]))
+        self.assertEqual((2, 5, True), calls[-1])
+        counts = [call[1] for call in calls if call[0] == 1]
+        self.assertEqual(sorted(counts), counts)
+
+
+    def test_progress_blocked_by_failure(self):
+        es = self.create_helper(batch_size=256, max_inflight=1)
+        calls = []
+        self.server.responses = [(200, {}), (400, {})]
+        es.add_events(self.events(20), "cloudtrail-2020-03", lambda count, complete: calls.append((count, complete)))
+        es.flush()
+        self.assertEqual([], calls)
+        self.assertGreater(es.failed_event_count, 0)
+        # later batches still advance the watermark, so nothing accumulates
+        es.add_events(self.events(20), "cloudtrail-2020-03", lambda count, complete: calls.append((count, complete)))
+        es.flush()
+        self.assertEqual((20, True), calls[-1])
+        self.assertEqual(set(), es.written_out_of_order)
+        self.assertEqual(0, len(es.progress_callbacks))
+
+
+    def test_progress_after_dead_lettered_failure(self):
+        dead_letter = Mock()
+        es = self.create_helper(batch_size=256, max_inflight=1, dead_letter=dead_letter)
+        calls = []
+        self.server.responses = [(200, {}), (400, {})]
+        es.add_events(self.events(20), "cloudtrail-2020-03", lambda count, complete: calls.append((count, complete)))
+        es.flush()
+        # the failed batch's events are in the dead-letter destination, so count as written
+        self.assertEqual((20, True), calls[-1])
+        self.assertEqual(set(), es.written_out_of_order)
+        self.assertEqual(0, len(es.progress_callbacks))
+
+
+    def test_discard_after_failed_flush(self):
+        es = self.create_helper()
+        calls = []
+        self.server.responses = [(200, {}), (400, {})]
+        es.add_events(self.events(3), "cloudtrail-2020-03", lambda count, complete: calls.append((1, count, complete)))
+        es.flush()
+        self.assertEqual(3, es.discard())
+        self.assertEqual(0, es.discard())
+        # the next caller's batch holds only its own events, and its progress isn't blocked
+        self.server.requests = []
+        es.add_events(self.events(2), "cloudtrail-2020-03", lambda count, complete: calls.append((2, count, complete)))
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(4, len(bulk_requests[0][2].splitlines()))
+        self.assertEqual([(2, 2, True)], calls)
+
+
+    def test_failed_background_upload_dead_lettered(self):
+        dead_letter = Mock()
+        es = self.create_helper(max_inflight=1, dead_letter=dead_letter)
+        self.server.responses = [(200, {}), (400, {})]
+        es.add_events(self.events(3), "cloudtrail-2020-03")
+        es.flush()
+        failures = dead_letter.write.call_args[0][0]
+        self.assertEqual(["0", "1", "2"], [f['id'] for f in failures])
+        self.assertEqual("upload failed", failures[0]['error'])
+        self.assertEqual(3, es.failed_event_count)
+        self.assertEqual(3, es.statistics()['dead_lettered_records'])
+
+
+    def test_mixed_indexes_in_one_request(self):
+        es = self.create_helper()
+        for index in ["cloudtrail-2020-03", "cloudtrail-2020-04", "cloudtrail-2020-03"]:
+            es.add_events(self.events(2), index)
+        es.flush()
+        bulk_requests = [r for r in self.server.requests if r[1] == "/_bulk"]
+        self.assertEqual(1, len(bulk_requests))
+        actions = [json.loads(line) for line in bulk_requests[0][2].splitlines()[::2]]
+        self.assertEqual(["cloudtrail-2020-03"] * 2 + ["cloudtrail-2020-04"] * 2 + ["cloudtrail-2020-03"] * 2,
+                         [action['index']['_index'] for action in actions])
+        self.assertEqual(2, len([r for r in self.server.requests if r[0] == "GET"]))
+
+
+    def test_max_batch_age(self):
+        es = self.create_helper(max_batch_age=0)
+        es.add_events(self.events(3), "cloudtrail-2020-03")
+        self.assertEqual(3, len([r for r in self.server.requests if r[1] == "/_bulk"]))
+
+
+    def test_mapped_fields(self):
+        es = self.create_helper()
+        self.server.responses = [(200, {"cloudtrail-2020-03": {"mappings": {
+            "requestParameters_flattened.bucketName": {}, "responseElements_flattened.instanceId": {}}}})]
+        self.assertEqual(["requestParameters_flattened.bucketName", "responseElements_flattened.instanceId"],
+                         es.mapped_fields("cloudtrail-2020-03"))
+        self.assertEqual("/cloudtrail-2020-03/_mapping/field/*_flattened.*", self.server.requests[0][1])
+        self.server.responses = [(404, {})]
+        self.assertEqual([], es.mapped_fields("cloudtrail-2020-04"))
+
+
+    def test_metrics(self):
+        metrics = Metrics()
+        es = self.create_helper(compression_level=6, metrics=metrics, retry_policy=RetryPolicy(base_delay=0))
+        es.add_events(self.events(5), "cloudtrail-2020-03")
+        self.server.responses = [(429, {})]
+        es.flush()
+        snapshot = metrics.snapshot()
+        self.assertEqual({'bulk_requests': 2, 'bulk_status_429': 1, 'bulk_status_200': 1, 'documents_sent': 5}, snapshot['counters'])
+        self.assertEqual(['batch_bytes', 'batch_documents', 'bulk_request_seconds', 'compress_seconds', 'serialize_seconds'],
+                         sorted(snapshot['histograms'].keys()))
+        batch_bytes = snapshot['histograms']['batch_bytes']
+        self.assertEqual((len(self.server.compressed_sizes), sum(self.server.compressed_sizes)), (batch_bytes['count'], batch_bytes['sum']))
@@ -0,0 +1,76 @@
+import gzip
+import io
+import json
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.event_reader import RAW_WINDOW, EventReader, open_stream
+
+
+class TestEventReader(unittest.TestCase):
+
+    def read_all(self, content, chunk_size=7):
+        """ Uses a tiny chunk size so that every value crosses a chunk boundary.
+            """
+        return list(EventReader(io.BytesIO(content.encode('utf-8')), chunk_size=chunk_size))
+
+
+    def test_records(self):
+        records = [{"eventID": str(ii), "requestParameters": {"names": ["a", "b"], "count": ii}} for ii in range(10)]
+        content = json.dumps({"Records": records})
+        self.assertEqual(records, self.read_all(content))
+
+
+    def test_empty_records(self):
+        self.assertEqual([], self.read_all('{"Records": []}'))
+        self.assertEqual([], self.read_all('{}'))
+
+
+    def test_other_keys_ignored(self):
+        content = '{"digestStartTime": 1234567, "Records" : [ {"eventID": "1"} ] , "other": {"x": [1, 2]}}'
+        self.assertEqual([{"eventID": "1"}], self.read_all(content))
+
+
+    def test_multibyte_characters(self):
+        records = [{"eventID": "1", "userAgent": "é中文 " * 20}]
+        content = json.dumps({"Records": records}, ensure_ascii=False)
+        self.assertEqual(records, self.read_all(content, chunk_size=3))
+
+
+    def test_malformed(self):
+        with self.assertRaises(json.JSONDecodeError):
+            self.read_all('{"Records": [{"eventID": "1"} {"eventID": "2"}]}')
+        with self.assertRaises(json.JSONDecodeError):
+            self.read_all('{"Records": [{"eventID": "1"')
+
+
+    def test_gzipped_stream(self):
+        records = [{"eventID": str(ii)} for ii in range(100)]
+        compressed = gzip.compress(json.dumps({"Records": records}).encode('utf-8'))
+        stream = open_stream(io.BufferedReader(io.BytesIO(compressed)))
+        self.assertEqual(records, list(EventReader(stream)))
+
+
+    def test_records_with_raw(self):
+        content = '{"Records": [{"eventID": "1", "requestParameters": {"a": [1, 2]}, "resources" : [ {"ARN": "x"} ] }, {}]}'
+        reader = EventReader(io.BytesIO(content.encode('utf-8')), chunk_size=5)
+        results = list(reader.with_raw(["requestParameters", "resources", "responseElements"], min_size=0))
+        self.assertEqual(2, len(results))
+        record, raw = results[0]
+        self.assertEqual({"eventID": "1", "requestParameters": {"a": [1, 2]}, "resources": [{"ARN": "x"}]}, record)
+        self.assertEqual({"requestParameters": '{"a": [1, 2]}', "resources": '[ {"ARN": "x"} ]'}, raw)
+        self.assertEqual(({}, {}), results[1])
+
+
+    def test_raw_only_for_large_records(self):
+        small = {"eventID": "1", "requestParameters": {"a": 1}}
+        large = {"eventID": "2", "requestParameters": {"a": "x" * 1000}}
+        records = [small] * RAW_WINDOW + [large] * RAW_WINDOW * 2 + [small] * RAW_WINDOW * 2
+        content = json.dumps({"Records": records}).encode('utf-8')
+        results = list(EventReader(io.BytesIO(content), chunk_size=100).with_raw(["requestParameters"], min_size=500))
+        self.assertEqual(records, [record for record, raw in results])
+        # each window of records decides whether the next one retains source text
+        used_raw = [raw is not None for record, raw in results]
+        self.assertEqual([False] * RAW_WINDOW * 2 + [True] * RAW_WINDOW * 2 + [False] * RAW_WINDOW, used_raw)
+        self.assertEqual({"requestParameters": json.dumps(large['requestParameters'])}, results[RAW_WINDOW * 2][1])
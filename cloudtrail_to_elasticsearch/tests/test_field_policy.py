@@ -0,0 +1,42 @@
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.field_policy import FieldPolicy
+from cloudtrail_to_elasticsearch.processor import transform_event
+
+
+def event(**request_parameters):
+    return transform_event({"eventID": "1", "requestParameters": request_parameters})
+
+
+class TestFieldPolicy(unittest.TestCase):
+
+    def test_no_restrictions(self):
+        policy = FieldPolicy()
+        result = policy.apply(event(bucketName="example", key="foo"), "cloudtrail-2020-03")
+        self.assertEqual({"bucketName": ["example"], "key": ["foo"]}, result['requestParameters_flattened'])
+        self.assertEqual({"cloudtrail-2020-03": 2}, policy.statistics()['flattened_fields'])
+
+
+    def test_allow_and_deny(self):
+        policy = FieldPolicy(allow=["*.bucketName", "*.key*"], deny=["*.keySecret"])
+        result = policy.apply(event(bucketName="example", keyId="foo", keySecret="bar", policy="x"), "cloudtrail-2020-03")
+        self.assertEqual({"bucketName": ["example"], "keyId": ["foo"]}, result['requestParameters_flattened'])
+        self.assertEqual(["policy=x"], result['requestParameters_overflow'])
+        self.assertIn("keySecret", result['requestParameters_raw'])
+        self.assertEqual(1, policy.statistics()['denied_values'])
+
+
+    def test_budget(self):
+        policy = FieldPolicy(max_fields=2, load_fields=lambda index: ["requestParameters_flattened.bucketName"])
+        first = policy.apply(event(bucketName="example", key="foo", size=10), "cloudtrail-2020-03")
+        self.assertEqual({"bucketName": ["example"], "key": ["foo"]}, first['requestParameters_flattened'])
+        self.assertEqual(["size=10"], first['requestParameters_overflow'])
+        # existing fields are still allowed once the budget is used up
+        second = policy.apply(event(key="bar", other="x"), "cloudtrail-2020-03")
+        self.assertEqual({"key": ["bar"]}, second['requestParameters_flattened'])
+        self.assertEqual(["other=x"], second['requestParameters_overflow'])
+        # and each index has its own budget
+        third = policy.apply(event(size=20), "cloudtrail-2020-04")
+        self.assertEqual({"size": ["20"]}, third['requestParameters_flattened'])
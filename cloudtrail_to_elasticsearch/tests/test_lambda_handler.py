@@ -33,7 +33,27 @@ class TestLambdaHandler(unittest.TestCase):
             """
         import cloudtrail_to_elasticsearch.lambda_handler
         cloudtrail_to_elasticsearch.lambda_handler.px = mock = Mock()
+        mock.process_files_from_s3.return_value = []
         with open("tests/resources/s3_test_event.json") as f:
             event = json.load(f)
-        cloudtrail_to_elasticsearch.lambda_handler.handle(event, None)
-        mock.process_from_s3.assert_called_once_with("my-s3-bucket", "HappyFace.jpg")
+        self.assertIsNone(cloudtrail_to_elasticsearch.lambda_handler.handle(event, None))
+        mock.process_files_from_s3.assert_called_once_with([("my-s3-bucket", "HappyFace.jpg")])
+
+
+    def test_sqs_partial_failure(self):
+        """ Wraps the sample S3 event in SQS messages, and verifies that only the
+            messages with failed files are reported.
+            """
+        import cloudtrail_to_elasticsearch.lambda_handler
+        cloudtrail_to_elasticsearch.lambda_handler.px = mock = Mock()
+        with open("tests/resources/s3_test_event.json") as f:
+            s3_event = json.load(f)
+        messages = []
+        for ii, key in enumerate(["file1.json.gz", "file%202.json.gz"]):
+            s3_event['Records'][0]['s3']['object']['key'] = key
+            messages.append({"messageId": f"message-{ii}", "eventSource": "aws:sqs", "body": json.dumps(s3_event)})
+        messages.append({"messageId": "message-2", "eventSource": "aws:sqs", "body": "not JSON"})
+        mock.process_files_from_s3.return_value = [("my-s3-bucket", "file 2.json.gz")]
+        result = cloudtrail_to_elasticsearch.lambda_handler.handle({"Records": messages}, None)
+        mock.process_files_from_s3.assert_called_once_with([("my-s3-bucket", "file1.json.gz"), ("my-s3-bucket", "file 2.json.gz")])
+        self.assertEqual({'batchItemFailures': [{'itemIdentifier': "message-1"}, {'itemIdentifier': "message-2"}]}, result)
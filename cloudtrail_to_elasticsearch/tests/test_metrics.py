@@ -0,0 +1,105 @@
+import gzip
+import io
+import json
+import time
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.event_reader import open_stream
+from cloudtrail_to_elasticsearch.metrics import FileTimer, Metrics, NULL_METRICS, emf_record, prometheus_text, summary_table
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_and_counters(self):
+        metrics = Metrics()
+        for value in [0.002, 0.02, 0.2, 60]:
+            metrics.observe('parse_seconds', value)
+        metrics.increment('files')
+        metrics.increment('files', 2)
+        snapshot = metrics.snapshot()
+        histogram = snapshot['histograms']['parse_seconds']
+        self.assertEqual(4, histogram['count'])
+        self.assertAlmostEqual(60.222, histogram['sum'])
+        self.assertEqual(3, sum(histogram['counts']))
+        self.assertEqual([0.002, 0.02, 0.2, 60], [total for total in histogram['sums'] if total])
+        self.assertEqual({'files': 3}, snapshot['counters'])
+        metrics.reset()
+        self.assertEqual({'counters': {}, 'histograms': {}}, metrics.snapshot())
+
+
+    def test_emf_totals(self):
+        metrics = Metrics()
+        values = [ii / 1000 for ii in range(1000)] + [45.0, 60.0]
+        for value in values:
+            metrics.observe('bulk_request_seconds', value)
+        distribution = emf_record(metrics.snapshot(), "Test", {})['bulk_request_ms']
+        self.assertLessEqual(len(distribution['Values']), 100)
+        self.assertEqual(len(values), sum(distribution['Counts']))
+        self.assertAlmostEqual(sum(values) * 1000, sum(v * c for v, c in zip(distribution['Values'], distribution['Counts'])), delta=1)
+        # the observations above the largest bucket have their own value
+        self.assertEqual((52500.0, 2), (distribution['Values'][-1], distribution['Counts'][-1]))
+
+
+    def test_null_metrics(self):
+        self.assertFalse(NULL_METRICS.enabled)
+        with NULL_METRICS.timer('parse_seconds'):
+            NULL_METRICS.increment('files')
+        self.assertEqual({'counters': {}, 'histograms': {}}, NULL_METRICS.snapshot())
+
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.observe('bulk_request_seconds', 0.003)
+        metrics.observe('bulk_request_seconds', 0.3)
+        metrics.increment('bulk_requests', 2)
+        lines = prometheus_text(metrics.snapshot()).splitlines()
+        self.assertIn("cloudtrail_loader_bulk_requests_total 2", lines)
+        self.assertIn('cloudtrail_loader_bulk_request_seconds_bucket{le="0.005"} 1', lines)
+        self.assertIn('cloudtrail_loader_bulk_request_seconds_bucket{le="0.5"} 2', lines)
+        self.assertIn('cloudtrail_loader_bulk_request_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("cloudtrail_loader_bulk_request_seconds_count 2", lines)
+
+
+    def test_emf_record(self):
+        metrics = Metrics()
+        metrics.observe('parse_seconds', 0.25)
+        metrics.observe('batch_bytes', 1024)
+        metrics.increment('events_read', 10)
+        record = json.loads(json.dumps(emf_record(metrics.snapshot(), "Test", {'FunctionName': "example"})))
+        self.assertEqual("example", record['FunctionName'])
+        self.assertEqual({'Values': [250.0], 'Counts': [1]}, record['parse_ms'])
+        self.assertEqual({'Values': [1024], 'Counts': [1]}, record['batch_bytes'])
+        self.assertEqual(10, record['events_read'])
+        directive = record['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual("Test", directive['Namespace'])
+        self.assertEqual([["FunctionName"]], directive['Dimensions'])
+        units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+        self.assertEqual({'parse_ms': 'Milliseconds', 'batch_bytes': 'Bytes', 'events_read': 'Count'}, units)
+
+
+    def test_summary_table(self):
+        metrics = Metrics()
+        metrics.observe('parse_seconds', 0.02)
+        metrics.increment('files')
+        lines = summary_table(metrics.snapshot()).splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual(["parse_seconds", "1", "0.020", "0.0200", "<=0.025", "<=0.025"], lines[1].split())
+
+
+    def test_file_timer_separates_raw_reads(self):
+        class SlowStream(io.BytesIO):
+            def readinto(self, buffer):
+                time.sleep(0.01)
+                return super().readinto(buffer)
+        content = json.dumps({"Records": [{"eventID": str(ii)} for ii in range(1000)]}).encode('utf-8')
+        timer = FileTimer()
+        stream = timer.stream(open_stream(timer.raw(io.BufferedReader(SlowStream(gzip.compress(content))))))
+        self.assertEqual(content, stream.read())
+        metrics = Metrics()
+        timer.record(metrics)
+        histograms = metrics.snapshot()['histograms']
+        self.assertGreaterEqual(histograms['raw_read_seconds']['sum'], 0.01)
+        self.assertLess(histograms['decompress_seconds']['sum'], histograms['raw_read_seconds']['sum'])
+        self.assertEqual({'files': 1, 'bytes_read': len(content), 'events_read': 0}, metrics.snapshot()['counters'])
@@ -0,0 +1,88 @@
+import datetime
+import glob
+import os
+import tempfile
+import unittest
+
+from unittest.mock import Mock
+
+import pyarrow.parquet as pq
+
+
+# module under test
+from cloudtrail_to_elasticsearch.parquet_sink import ParquetSink, SCHEMA
+from cloudtrail_to_elasticsearch.processor import Processor, transform_event
+
+
+def event(event_id, **request_parameters):
+    return transform_event({
+        "eventID": event_id,
+        "eventTime": "2020-03-31T12:34:56Z",
+        "eventName": "GetObject",
+        "userIdentity": {"type": "IAMUser"},
+        "requestParameters": request_parameters,
+    })
+
+
+class TestParquetSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+
+    def files(self):
+        return sorted(glob.glob(f"{self.tmpdir.name}/**/*.parquet", recursive=True))
+
+
+    def test_local_write(self):
+        sink = ParquetSink(self.tmpdir.name)
+        sink.add_events([event("1", bucketName="example"), event("2")], "cloudtrail-2020-03")
+        sink.add_events([event("3")], "cloudtrail-2020-04")
+        self.assertEqual([], self.files())
+        sink.flush()
+        files = self.files()
+        self.assertEqual(["month=2020-03", "month=2020-04"], [os.path.basename(os.path.dirname(f)) for f in files])
+        self.assertEqual([], glob.glob(f"{self.tmpdir.name}/**/*.tmp", recursive=True))
+        table = pq.read_table(files[0])
+        self.assertEqual(SCHEMA, table.schema)
+        rows = table.to_pylist()
+        self.assertEqual(["1", "2"], [row['event_id'] for row in rows])
+        self.assertEqual(datetime.datetime(2020, 3, 31, 12, 34, 56, tzinfo=datetime.timezone.utc), rows[0]['event_time'])
+        self.assertEqual('{"type": "IAMUser"}', rows[0]['user_identity'])
+        self.assertEqual([("bucketName", ["example"])], rows[0]['request_parameters_flattened'])
+        self.assertIsNone(rows[0]['error_code'])
+        self.assertEqual({'parquet_rows': 3, 'parquet_files': 2}, sink.statistics())
+
+
+    def test_row_groups_and_files(self):
+        sink = ParquetSink(self.tmpdir.name, row_group_size=2, rows_per_file=4)
+        sink.add_events([event(str(n)) for n in range(5)], "cloudtrail-2020-03")
+        self.assertEqual(1, len(self.files()))
+        sink.flush()
+        files = self.files()
+        self.assertEqual(2, len(files))
+        metadata = sorted((pq.ParquetFile(f).metadata for f in files), key=lambda m: m.num_rows)
+        self.assertEqual([1, 4], [m.num_rows for m in metadata])
+        self.assertEqual(2, metadata[1].num_row_groups)
+
+
+    def test_s3_write(self):
+        s3_helper = Mock()
+        sink = ParquetSink("s3://bucket/prefix/", s3_helper)
+        sink.add_events([event("1")], "cloudtrail-2020-03")
+        sink.flush()
+        path, bucket, key = s3_helper.upload_file.call_args[0]
+        self.assertEqual("bucket", bucket)
+        self.assertRegex(key, r"^prefix/month=2020-03/.*\.parquet$")
+        self.assertFalse(os.path.exists(path))
+
+
+    def test_processor_tee(self):
+        es_helper = Mock()
+        es_helper.add_events.side_effect = lambda events, index, progress: list(events)
+        sink = ParquetSink(self.tmpdir.name)
+        px = Processor(es_helper, Mock(), parquet_sink=sink)
+        px.add_events([event("1"), event("2")], "cloudtrail-2020-03", flush=True)
+        es_helper.flush.assert_called_once()
+        self.assertEqual(["1", "2"], [row['event_id'] for row in pq.read_table(self.files()[0]).to_pylist()])
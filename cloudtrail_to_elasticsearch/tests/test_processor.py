@@ -0,0 +1,162 @@
+import functools
+import gzip
+import json
+import unittest
+
+from unittest.mock import Mock
+
+
+# module under test
+from cloudtrail_to_elasticsearch.dedup_filter import DedupFilter
+from cloudtrail_to_elasticsearch.metrics import Metrics
+from cloudtrail_to_elasticsearch.processor import Processor
+
+
+class FakeESHelper:
+    """ Records added events, and reports them as written immediately.
+        """
+
+    def __init__(self):
+        self.events = []
+        self.flushed = 0
+
+    def add_events(self, events, index, progress=None):
+        events = list(events)
+        self.events += events
+        if progress:
+            progress(len(events), True)
+
+    def flush(self):
+        self.flushed += 1
+
+    def discard(self):
+        return 0
+
+
+class BatchingESHelper:
+    """ Writes events in batches of a fixed size, calling progress functions once
+        the events added before them have been written. Optionally fails on flush().
+        """
+
+    def __init__(self, batch_docs, fail_flush=False):
+        self.batch_docs = batch_docs
+        self.fail_flush = fail_flush
+        self.batch = []
+        self.pending = []
+        self.events = []
+
+    def add_events(self, events, index, progress=None):
+        count = 0
+        for event in events:
+            self.batch.append(event)
+            count += 1
+            if len(self.batch) >= self.batch_docs:
+                self.write()
+        if progress:
+            self.pending.append(functools.partial(progress, count, True))
+            if not self.batch:
+                self.write()
+
+    def write(self):
+        self.events += self.batch
+        self.batch = []
+        pending, self.pending = self.pending, []
+        for fn in pending:
+            fn()
+
+    def flush(self):
+        if self.fail_flush:
+            raise ConnectionError("connection reset")
+        self.write()
+
+    def discard(self):
+        count = len(self.batch)
+        self.batch = []
+        self.pending = []
+        return count
+
+
+class TestProcessor(unittest.TestCase):
+
+    def test_process_files_from_s3(self):
+        good_key = "AWSLogs/123456789012/CloudTrail/us-east-1/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_abcd.json.gz"
+        bad_key = good_key.replace("abcd", "efgh")
+        contents = {
+            good_key: gzip.compress(json.dumps({"Records": [{"eventID": "1"}, {"eventID": "2"}]}).encode('utf-8')),
+            bad_key: gzip.compress(b'{"Records": [{"eventID": "3"'),
+        }
+        s3_helper = Mock()
+        s3_helper.retrieve.side_effect = lambda bucket, key, gzipped: contents[key]
+        es_helper = FakeESHelper()
+        px = Processor(es_helper, s3_helper)
+        failed = px.process_files_from_s3([("bucket", good_key), ("bucket", bad_key)])
+        self.assertEqual([("bucket", bad_key)], failed)
+        self.assertEqual(["1", "2"], [event['eventID'] for event in es_helper.events])
+        self.assertEqual(1, es_helper.flushed)
+
+
+    def test_final_flush_failure(self):
+        keys = [f"AWSLogs/123456789012/CloudTrail/us-east-1/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_{name}.json.gz"
+                for name in ("abcd", "efgh")]
+        contents = {
+            keys[0]: gzip.compress(json.dumps({"Records": [{"eventID": "1"}, {"eventID": "2"}]}).encode('utf-8')),
+            keys[1]: gzip.compress(json.dumps({"Records": [{"eventID": "3"}]}).encode('utf-8')),
+        }
+        s3_helper = Mock()
+        s3_helper.retrieve.side_effect = lambda bucket, key, gzipped: contents[key]
+        es_helper = BatchingESHelper(2, fail_flush=True)
+        px = Processor(es_helper, s3_helper)
+        # the first file's events were written in a full batch, so only the second failed
+        self.assertEqual([("bucket", keys[1])], px.process_files_from_s3([("bucket", key) for key in keys]))
+        self.assertEqual(["1", "2"], [event['eventID'] for event in es_helper.events])
+
+
+    def test_invocation_after_flush_failure(self):
+        keys = [f"AWSLogs/123456789012/CloudTrail/us-east-1/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_{name}.json.gz"
+                for name in ("abcd", "efgh")]
+        contents = {
+            keys[0]: gzip.compress(json.dumps({"Records": [{"eventID": "1"}]}).encode('utf-8')),
+            keys[1]: gzip.compress(json.dumps({"Records": [{"eventID": "2"}]}).encode('utf-8')),
+        }
+        s3_helper = Mock()
+        s3_helper.retrieve.side_effect = lambda bucket, key, gzipped: contents[key]
+        es_helper = BatchingESHelper(10, fail_flush=True)
+        px = Processor(es_helper, s3_helper)
+        self.assertEqual([("bucket", keys[0])], px.process_files_from_s3([("bucket", keys[0])]))
+        # a warm Lambda reuses the processor; the failed file's events must not be written with the next one's
+        es_helper.fail_flush = False
+        self.assertEqual([], px.process_files_from_s3([("bucket", keys[1])]))
+        self.assertEqual(["2"], [event['eventID'] for event in es_helper.events])
+
+
+    def test_parquet_flush_failure(self):
+        key = "AWSLogs/123456789012/CloudTrail/us-east-1/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_abcd.json.gz"
+        s3_helper = Mock()
+        s3_helper.retrieve.return_value = gzip.compress(json.dumps({"Records": [{"eventID": "1"}]}).encode('utf-8'))
+        parquet_sink = Mock()
+        parquet_sink.flush.side_effect = IOError("disk full")
+        px = Processor(BatchingESHelper(2), s3_helper, parquet_sink=parquet_sink)
+        self.assertEqual([("bucket", key)], px.process_files_from_s3([("bucket", key)]))
+
+
+    def test_metrics(self):
+        key = "AWSLogs/123456789012/CloudTrail/us-east-1/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_abcd.json.gz"
+        content = gzip.compress(json.dumps({"Records": [{"eventID": "1"}, {"eventID": "2"}]}).encode('utf-8'))
+        s3_helper = Mock()
+        s3_helper.retrieve.return_value = content
+        metrics = Metrics()
+        px = Processor(FakeESHelper(), s3_helper, metrics=metrics)
+        px.process_files_from_s3([("bucket", key)])
+        snapshot = metrics.snapshot()
+        self.assertEqual({'files': 1, 'events_read': 2, 'bytes_read': len(gzip.decompress(content))}, snapshot['counters'])
+        self.assertEqual(['decompress_seconds', 'parse_seconds', 'raw_read_seconds', 'transform_seconds'], sorted(snapshot['histograms'].keys()))
+
+
+    def test_dedup_filter(self):
+        es_helper = FakeESHelper()
+        progress = Mock()
+        px = Processor(es_helper, Mock(), dedup_filter=DedupFilter())
+        px.add_events([{"eventID": "1"}, {"eventID": "2"}], "cloudtrail-2020-03")
+        px.add_events([{"eventID": "2"}, {"eventID": "3"}], "cloudtrail-2020-03", progress=progress)
+        self.assertEqual(["1", "2", "3"], [event['eventID'] for event in es_helper.events])
+        progress.assert_called_once_with(1, True)
@@ -0,0 +1,93 @@
+import gzip
+import io
+import os
+import threading
+import unittest
+
+import botocore.exceptions
+
+from botocore.response import StreamingBody
+
+
+# module under test
+from cloudtrail_to_elasticsearch.s3_helper import S3Helper
+
+
+class FakeS3Client:
+    """ Implements get_object() for a single object, honoring Range and IfMatch,
+        and recording the ranges that were requested.
+        """
+
+    def __init__(self, content, etag='"abc"'):
+        self.content = content
+        self.etag = etag
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        with self.lock:
+            self.ranges.append(Range)
+        if IfMatch and IfMatch != self.etag:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        if Range is None:
+            return {'Body': self.body(self.content), 'ETag': self.etag}
+        if not self.content:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+        start, end = [int(value) for value in Range[len("bytes="):].split("-")]
+        end = min(end, len(self.content) - 1)
+        return {
+            'Body': self.body(self.content[start:end + 1]),
+            'ETag': self.etag,
+            'ContentRange': f"bytes {start}-{end}/{len(self.content)}"
+        }
+
+    def body(self, data):
+        return StreamingBody(io.BytesIO(data), len(data))
+
+
+class TestS3Helper(unittest.TestCase):
+
+    def create_helper(self, content, part_size):
+        s3 = S3Helper(part_size=part_size, part_workers=3)
+        s3._client = FakeS3Client(content)
+        return s3
+
+
+    def test_small_object(self):
+        content = os.urandom(1000)
+        s3 = self.create_helper(content, 1024)
+        self.assertEqual(content, s3.retrieve("bucket", "key", gzipped=False))
+        self.assertEqual(["bytes=0-1023"], s3.client.ranges)
+
+
+    def test_ranged_retrieve(self):
+        content = os.urandom(10000)
+        s3 = self.create_helper(content, 1024)
+        self.assertEqual(content, s3.retrieve("bucket", "key", gzipped=False))
+        self.assertEqual(10, len(s3.client.ranges))
+        self.assertIn("bytes=9216-9999", s3.client.ranges)
+
+
+    def test_ranged_retrieve_gzipped(self):
+        content = os.urandom(10000)
+        s3 = self.create_helper(gzip.compress(content), 1024)
+        self.assertEqual(content, s3.retrieve("bucket", "key"))
+
+
+    def test_empty_object(self):
+        s3 = self.create_helper(b"", 1024)
+        self.assertEqual(b"", s3.retrieve("bucket", "key", gzipped=False))
+        self.assertEqual(["bytes=0-1023", None], s3.client.ranges)
+
+
+    def test_object_changed(self):
+        s3 = self.create_helper(os.urandom(3000), 1024)
+        original_get_object = s3.client.get_object
+        def get_object(**kwargs):
+            # the object is replaced after the first request
+            rsp = original_get_object(**kwargs)
+            s3.client.etag = '"def"'
+            return rsp
+        s3.client.get_object = get_object
+        with self.assertRaises(botocore.exceptions.ClientError):
+            s3.retrieve("bucket", "key", gzipped=False)
@@ -0,0 +1,66 @@
+import unittest
+
+
+# module under test
+from cloudtrail_to_elasticsearch.s3_listing import date_suffixes, list_cloudtrail_keys
+
+
+class FakeS3Helper:
+    """ Implements the listing functions of S3Helper over a list of keys, recording
+        the prefixes that were listed.
+        """
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.listed = []
+
+    def list_keys(self, bucket, prefix):
+        self.listed.append(prefix)
+        return [key for key in self.keys if key.startswith(prefix)]
+
+    def list_child_prefixes(self, bucket, prefix):
+        result = []
+        for key in self.keys:
+            if key.startswith(prefix) and "/" in key[len(prefix):]:
+                child = key[:key.index("/", len(prefix)) + 1]
+                if child not in result:
+                    result.append(child)
+        return result
+
+
+def cloudtrail_key(account, region, date):
+    return f"AWSLogs/{account}/CloudTrail/{region}/{date.replace('-', '/')}/{account}_CloudTrail_{region}_{date.replace('-', '')}T0000Z_abcd.json.gz"
+
+
+class TestS3Listing(unittest.TestCase):
+
+    def test_date_suffixes(self):
+        self.assertEqual(["2020/03/30/", "2020/03/31/", "2020/04/01/"], date_suffixes("2020-03-30", "2020-04-01"))
+        self.assertEqual(["2019/12/31/", "2020/", "2021/01/", "2021/02/01/"], date_suffixes("2019-12-31", "2021-02-01"))
+        self.assertEqual(["2020/02/"], date_suffixes("2020-02-01", "2020-02-29"))
+
+
+    def test_list_date_range(self):
+        keys = [cloudtrail_key(account, region, date)
+                for account in ["123456789012", "234567890123"]
+                for region in ["us-east-1", "us-west-2"]
+                for date in ["2020-03-30", "2020-03-31", "2020-04-01", "2020-04-02"]]
+        keys.append("AWSLogs/123456789012/CloudTrail-Digest/us-east-1/2020/03/31/digest.json.gz")
+        s3 = FakeS3Helper(keys)
+        result = list(list_cloudtrail_keys(s3, "bucket", "", "2020-03-31", "2020-04-01", max_workers=2))
+        self.assertEqual(8, len(result))
+        self.assertEqual(sorted(result), sorted(key for key in keys if "_20200331" in key or "_20200401" in key))
+        self.assertTrue(all("/03/31/" in key for key in result[:4]))
+        self.assertNotIn("AWSLogs/", s3.listed)
+
+
+    def test_organization_trail(self):
+        keys = ["trails/" + cloudtrail_key('123456789012', 'us-east-1', '2020-03-31').replace("AWSLogs/", "AWSLogs/o-abcdefghij/")]
+        s3 = FakeS3Helper(keys + ["trails/other/file.json.gz"])
+        self.assertEqual(keys, list(list_cloudtrail_keys(s3, "bucket", "trails", "2020-03-01", "2020-03-31")))
+
+
+    def test_fallback(self):
+        keys = ["logs/2020/03/31/123456789012_CloudTrail_us-east-1_20200331T0000Z_abcd.json.gz"]
+        s3 = FakeS3Helper(keys)
+        self.assertEqual(keys, list(list_cloudtrail_keys(s3, "bucket", "logs/", "2020-03-01", "2020-03-31")))
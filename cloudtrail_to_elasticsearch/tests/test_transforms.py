@@ -41,3 +41,35 @@ class TestTransforms(unittest.TestCase):
         with open("tests/resources/event_with_request_parameters-transformed.json") as f:
             expected = json.load(f)
         self.assertEqual(expected, processor.transform_events([orig])[0], "simple event, no flattening")
+
+
+    def test_index_names_for_date_range(self):
+        expected = ["cloudtrail-2019-11", "cloudtrail-2019-12", "cloudtrail-2020-01", "cloudtrail-2020-02"]
+        self.assertEqual(expected, processor.index_names("2019-11-15", "2020-02-01"))
+        self.assertEqual(["cloudtrail-2020-02"], processor.index_names("2020-02-01", "2020-02-29"))
+
+
+    def test_flatten_nested_values(self):
+        """ Leaf values are collected under their own key (or the key of the list that
+            holds them), as distinct strings in the order first seen.
+            """
+        src = {
+            "instancesSet": {"items": [{"instanceId": "i-1", "state": {"code": 16}}, {"instanceId": "i-2", "state": {"code": 16}}]},
+            "tags": ["a", "b", "a"],
+            "some.key": True,
+            "": "ignored"
+        }
+        expected = {
+            "instanceId": ["i-1", "i-2"],
+            "code": ["16"],
+            "tags": ["a", "b"],
+            "some_key": ["True"]
+        }
+        self.assertEqual(expected, processor.flatten_value("requestParameters", src))
+
+
+    def test_raw_text_reused(self):
+        event = {"eventID": "1", "requestParameters": {"a": "b"}}
+        transformed = processor.transform_event(event, {"requestParameters": '{"a":"b"}'})
+        self.assertEqual('{"a":"b"}', transformed["requestParameters_raw"])
+        self.assertEqual({"a": ["b"]}, transformed["requestParameters_flattened"])